@@ -0,0 +1,234 @@
+# src/answer_cache.py
+import os
+import re
+import time
+import asyncio
+import logging
+from collections import OrderedDict
+
+# faiss импортируется при первом использовании, чтобы импорт модуля не задерживал запуск бота
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+def normalize_question(text):
+    """Нормализует вопрос для точного совпадения: регистр, ё, пунктуация, пробелы."""
+    text = text.lower().replace('ё', 'е')
+    text = re.sub(r'[^\w\s]', ' ', text)
+    return re.sub(r'\s+', ' ', text).strip()
+
+
+class _CacheEntry:
+    __slots__ = ("key", "answer", "created_at", "latency")
+
+    def __init__(self, key, answer, created_at, latency):
+        self.key = key
+        self.answer = answer
+        self.created_at = created_at
+        self.latency = latency
+
+
+class SemanticAnswerCache:
+    """
+    Кэш ответов LLM перед этапом генерации.
+    Точное попадание ищется по нормализованному тексту вопроса, почти-дубликаты -
+    по косинусной близости эмбеддинга вопроса в собственном небольшом FAISS индексе.
+    Вытеснение - LRU и TTL; кэш сбрасывается при пересборке файлов базы знаний.
+    """
+
+    def __init__(self, dimension, max_entries=1000, ttl_seconds=3600.0, similarity_threshold=0.95,
+                 artifact_paths=(), artifact_check_interval=1.0):
+        import faiss
+        self.dimension = dimension
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.similarity_threshold = similarity_threshold
+        self.artifact_paths = tuple(artifact_paths)
+        self.artifact_check_interval = artifact_check_interval
+
+        self._entries = OrderedDict()  # id -> _CacheEntry, порядок = LRU
+        self._by_key = {}  # нормализованный вопрос -> id
+        self._index = faiss.IndexIDMap2(faiss.IndexFlatIP(dimension))
+        self._next_id = 0
+        self._artifact_signature = self._current_signature()
+        self._last_artifact_check = time.monotonic()
+
+        # Счетчики
+        self.exact_hits = 0
+        self.semantic_hits = 0
+        self.misses = 0
+        self.latency_saved = 0.0
+        self.lru_evictions = 0
+        self.ttl_evictions = 0
+        self.invalidations = 0
+
+    # --- Инвалидация по файлам базы знаний ---
+    def _current_signature(self):
+        signature = []
+        for path in self.artifact_paths:
+            try:
+                stat = os.stat(path)
+                signature.append((path, stat.st_mtime_ns, stat.st_size))
+            except FileNotFoundError:
+                signature.append((path, None, None))
+        return tuple(signature)
+
+    def _check_artifacts(self):
+        now = time.monotonic()
+        if now - self._last_artifact_check < self.artifact_check_interval:
+            return
+        self._last_artifact_check = now
+        signature = self._current_signature()
+        if signature != self._artifact_signature:
+            self._artifact_signature = signature
+            logger.info("Файлы базы знаний изменились, кэш ответов сброшен.")
+            self.clear()
+
+    def clear(self):
+        """Полностью очищает кэш (например, после обновления базы знаний)."""
+        self._entries.clear()
+        self._by_key.clear()
+        self._index.reset()
+        self.invalidations += 1
+
+    # --- Вытеснение ---
+    def _remove(self, entry_id):
+        entry = self._entries.pop(entry_id)
+        if self._by_key.get(entry.key) == entry_id:
+            del self._by_key[entry.key]
+        self._index.remove_ids(np.array([entry_id], dtype='int64'))
+
+    def _is_expired(self, entry, now):
+        return self.ttl_seconds and now - entry.created_at > self.ttl_seconds
+
+    def _evict(self, now):
+        # Записи с истекшим TTL лежат в начале LRU-очереди не обязательно, поэтому проверяем все
+        expired = [entry_id for entry_id, entry in self._entries.items() if self._is_expired(entry, now)]
+        for entry_id in expired:
+            self._remove(entry_id)
+            self.ttl_evictions += 1
+        while len(self._entries) > self.max_entries:
+            oldest_id = next(iter(self._entries))
+            self._remove(oldest_id)
+            self.lru_evictions += 1
+
+    @staticmethod
+    def _as_unit_vector(embedding):
+        import faiss
+        vector = np.asarray(embedding, dtype='float32').reshape(1, -1).copy()
+        faiss.normalize_L2(vector)
+        return vector
+
+    # --- Основной интерфейс ---
+    def _hit(self, entry_id, now, exact):
+        entry = self._entries[entry_id]
+        if self._is_expired(entry, now):
+            self._remove(entry_id)
+            self.ttl_evictions += 1
+            return None
+        self._entries.move_to_end(entry_id)
+        if exact:
+            self.exact_hits += 1
+        else:
+            self.semantic_hits += 1
+        self.latency_saved += entry.latency
+        return entry.answer
+
+    def get_exact(self, question):
+        """Ищет ответ по нормализованному тексту вопроса (без эмбеддинга)."""
+        self._check_artifacts()
+        entry_id = self._by_key.get(normalize_question(question))
+        if entry_id is None:
+            return None
+        return self._hit(entry_id, time.monotonic(), exact=True)
+
+    def get(self, question, embedding=None):
+        """Ищет ответ: сначала точное совпадение, затем ближайший по эмбеддингу вопрос."""
+        answer = self.get_exact(question)
+        if answer is not None:
+            return answer
+        if embedding is not None and self._index.ntotal > 0:
+            similarities, ids = self._index.search(self._as_unit_vector(embedding), 1)
+            if ids[0][0] != -1 and similarities[0][0] >= self.similarity_threshold:
+                answer = self._hit(int(ids[0][0]), time.monotonic(), exact=False)
+                if answer is not None:
+                    return answer
+        self.misses += 1
+        return None
+
+    def put(self, question, embedding, answer, latency=0.0):
+        """Сохраняет ответ; latency - время получения ответа, которое сэкономит попадание."""
+        self._check_artifacts()
+        now = time.monotonic()
+        key = normalize_question(question)
+        if key in self._by_key:
+            self._remove(self._by_key[key])
+        entry_id = self._next_id
+        self._next_id += 1
+        self._entries[entry_id] = _CacheEntry(key, answer, now, latency)
+        self._by_key[key] = entry_id
+        self._index.add_with_ids(self._as_unit_vector(embedding), np.array([entry_id], dtype='int64'))
+        self._evict(now)
+
+    def stats(self):
+        """Счетчики попаданий, сэкономленного времени и вытеснений."""
+        lookups = self.exact_hits + self.semantic_hits + self.misses
+        return {
+            "size": len(self._entries),
+            "max_entries": self.max_entries,
+            "exact_hits": self.exact_hits,
+            "semantic_hits": self.semantic_hits,
+            "misses": self.misses,
+            "hit_rate": ((self.exact_hits + self.semantic_hits) / lookups) if lookups else 0.0,
+            "latency_saved_seconds": self.latency_saved,
+            "lru_evictions": self.lru_evictions,
+            "ttl_evictions": self.ttl_evictions,
+            "invalidations": self.invalidations,
+        }
+
+
+class LeaderCancelledError(Exception):
+    """Ведущий запрос отменен до ответа: ожидающий должен обработать вопрос сам."""
+
+
+class RequestCoalescer:
+    """
+    Склеивает одинаковые вопросы, которые обрабатываются одновременно: первый запрос
+    (ведущий) считает ответ, остальные ждут его результат вместо своего вызова LLM.
+    """
+
+    def __init__(self):
+        self._in_flight = {}  # нормализованный вопрос -> [future, число ожидающих]
+        self.coalesced = 0
+
+    def join(self, question):
+        """Возвращает (ключ, future ведущего или None, если вызывающий сам стал ведущим)."""
+        key = normalize_question(question)
+        entry = self._in_flight.get(key)
+        if entry is not None:
+            entry[1] += 1
+            self.coalesced += 1
+            return key, entry[0]
+        self._in_flight[key] = [asyncio.get_running_loop().create_future(), 0]
+        return key, None
+
+    def finish(self, key, answer=None, error=None):
+        """
+        Ведущий сообщает результат; ожидающие получают ответ или то же исключение.
+        Отмена ведущего не отменяет ожидающих: они получают LeaderCancelledError и считают ответ сами.
+        """
+        future, followers = self._in_flight.pop(key)
+        if future.done():
+            return
+        if error is None:
+            future.set_result(answer)
+        elif not followers:
+            future.cancel()
+        else:
+            future.set_exception(LeaderCancelledError() if isinstance(error, asyncio.CancelledError) else error)
+            # Ожидающий мог быть отменен сам - исключение считается полученным, чтобы asyncio не писал о нем в лог
+            future.add_done_callback(lambda done: done.exception())
+
+    def stats(self):
+        return {"in_flight": len(self._in_flight), "coalesced": self.coalesced}
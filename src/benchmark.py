@@ -0,0 +1,286 @@
+# src/benchmark.py
+"""
+Офлайн-бенчмарк пути create_chunks -> build_vector_store -> handle_message.
+Считает качество поиска (recall@k, hit@k, MRR) по размеченным вопросам и задержки
+этапов (эмбеддинг, поиск, сборка промпта) с заглушкой вместо LLM - сеть не нужна.
+Результат сохраняется в JSON, чтобы сравнивать прогоны до и после изменений.
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+from data_processor import create_chunks, assign_chunk_ids
+from encoder import ENCODER_BACKENDS, load_encoder, resolve_model_name, warm_up
+from kb_store import open_kb_store, write_kb_store
+from lexical_index import BM25Index
+from rag_pipeline import DEFAULT_CONTEXT_TOKEN_BUDGET, build_llm_request, hybrid_retrieve, retrieve_chunks
+from reranker import load_reranker, rerank
+from stub_llm_server import StubLLM
+from vector_store import build_index, encode_passages, encode_queries
+
+DEFAULT_DATA_PATH = 'benchmarks/fixtures/programs_data.json'
+DEFAULT_QUESTIONS_PATH = 'benchmarks/fixtures/questions.json'
+DEFAULT_REPORT_PATH = 'benchmarks/report.json'
+MODEL_NAME = 'intfloat/multilingual-e5-large'
+RETRIEVERS = ('dense', 'hybrid')
+
+
+def percentiles(samples):
+    """p50/p95/p99 и среднее в миллисекундах."""
+    if not samples:
+        return {"p50_ms": 0.0, "p95_ms": 0.0, "p99_ms": 0.0, "mean_ms": 0.0, "count": 0}
+    values = np.array(samples) * 1000
+    return {
+        "p50_ms": float(np.percentile(values, 50)),
+        "p95_ms": float(np.percentile(values, 95)),
+        "p99_ms": float(np.percentile(values, 99)),
+        "mean_ms": float(values.mean()),
+        "count": len(samples),
+    }
+
+
+def is_relevant(chunk, labels):
+    """Чанк релевантен, если его программа и раздел есть в разметке вопроса."""
+    return any(chunk['source'] == label['source'] and chunk['field'] == label['field'] for label in labels)
+
+
+def evaluate_retrieval(ranked_chunks, labels, k):
+    """recall@k (доля размеченных разделов среди top-k), hit@k и обратный ранг первого попадания."""
+    top_k = ranked_chunks[:k]
+    covered = {(label['source'], label['field']) for label in labels
+               if any(chunk['source'] == label['source'] and chunk['field'] == label['field'] for chunk in top_k)}
+    reciprocal_rank = 0.0
+    for rank, chunk in enumerate(ranked_chunks, start=1):
+        if is_relevant(chunk, labels):
+            reciprocal_rank = 1.0 / rank
+            break
+    return len(covered) / len(labels), float(bool(covered)), reciprocal_rank
+
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmark(data_path, questions_path, model_name=MODEL_NAME, index_type='auto', k=3,
+                  eval_k=(1, 3, 5), min_similarity=0.0, repeat=3, backend='torch', retriever='hybrid',
+                  candidates=20, lexical_min_coverage=0.6, reranker_model=None, rerank_candidates=10,
+                  context_token_budget=DEFAULT_CONTEXT_TOKEN_BUDGET):
+    with open(data_path, 'r', encoding='utf-8') as f:
+        programs_data = json.load(f)
+    with open(questions_path, 'r', encoding='utf-8') as f:
+        questions = json.load(f)
+
+    timings = {"model_load": [], "warm_up": [], "chunking": [], "index_build": [], "lexical_build": [],
+               "embed_passages": [], "embed_query": [], "search": [], "dense": [], "lexical": [], "fusion": [],
+               "rerank": [], "prompt_assembly": [], "llm_stub": [], "end_to_end": []}
+
+    model_name = resolve_model_name(model_name, backend)
+    print(f"Загрузка модели SentenceTransformer ({model_name}, бэкенд {backend})...")
+    started = time.perf_counter()
+    model = load_encoder(model_name, backend)
+    timings["model_load"].append(time.perf_counter() - started)
+    # Прогрев, чтобы первый вопрос не учитывал ленивую инициализацию модели
+    timings["warm_up"].append(warm_up(model))
+
+    started = time.perf_counter()
+    chunks = assign_chunk_ids(create_chunks(programs_data))
+    timings["chunking"].append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    embeddings = encode_passages(model, [chunk['text'] for chunk in chunks])
+    timings["embed_passages"].append(time.perf_counter() - started)
+
+    ids = np.array([chunk['id'] for chunk in chunks], dtype='int64')
+    started = time.perf_counter()
+    index, resolved_type, params = build_index(embeddings, index_type, ids=ids)
+    timings["index_build"].append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    lexical_index = BM25Index.build([chunk['text'] for chunk in chunks], ids)
+    timings["lexical_build"].append(time.perf_counter() - started)
+    # Чанки читаются из того же формата хранилища, что и в боте
+    kb_root = tempfile.mkdtemp(prefix='kb-benchmark-')
+    write_kb_store(chunks, embeddings, kb_root, lexical_index=lexical_index)
+    store = open_kb_store(kb_root)
+    chunks_by_id = store.chunks
+
+    reranker = None
+    if reranker_model:
+        print(f"Загрузка переранжировщика ({reranker_model})...")
+        reranker = load_reranker(reranker_model)
+
+    def retrieve(question, question_embedding, top_k, threshold, record=True):
+        """Поиск выбранным способом; при record длительности этапов попадают в timings."""
+        if retriever == 'dense':
+            return retrieve_chunks(index, chunks_by_id, question_embedding, top_k, threshold)
+        stage_timings = {}
+        found = hybrid_retrieve(index, chunks_by_id, store.embeddings, store.lexical_index, question,
+                                question_embedding, max(candidates, top_k), threshold, lexical_min_coverage,
+                                timings=stage_timings)
+        if reranker is not None:
+            started = time.perf_counter()
+            found = rerank(reranker, question, found[:rerank_candidates]) + found[rerank_candidates:]
+            stage_timings["rerank"] = time.perf_counter() - started
+        if record:
+            for stage, seconds in stage_timings.items():
+                timings[stage].append(seconds)
+        return found[:top_k]
+
+    llm = StubLLM()
+    max_k = max(max(eval_k), k)
+    quality = {f"recall@{n}": [] for n in eval_k}
+    quality.update({f"hit@{n}": [] for n in eval_k})
+    quality["mrr"] = []
+    per_question = []
+    # Размер запроса к LLM: токены контекста и выбранный лимит ответа
+    context_tokens_samples = []
+    max_tokens_samples = []
+
+    for item in questions:
+        for iteration in range(repeat):
+            request_started = time.perf_counter()
+            started = time.perf_counter()
+            question_embedding = encode_queries(model, [item['question']])
+            timings["embed_query"].append(time.perf_counter() - started)
+
+            started = time.perf_counter()
+            relevant_chunks = retrieve(item['question'], question_embedding, k, min_similarity)
+            timings["search"].append(time.perf_counter() - started)
+
+            started = time.perf_counter()
+            messages, max_tokens, context_tokens = build_llm_request(
+                item['question'], [chunk for chunk, _ in relevant_chunks], context_token_budget
+            )
+            timings["prompt_assembly"].append(time.perf_counter() - started)
+            context_tokens_samples.append(context_tokens)
+            max_tokens_samples.append(max_tokens)
+
+            started = time.perf_counter()
+            llm.complete(messages)
+            timings["llm_stub"].append(time.perf_counter() - started)
+            timings["end_to_end"].append(time.perf_counter() - request_started)
+
+        # Качество считается по расширенной выдаче (без порога), чтобы видеть ранг релевантных чанков
+        ranked = [chunk for chunk, _ in retrieve(item['question'], question_embedding, max_k, -1.0, record=False)]
+        result = {"question": item['question'], "retrieved": [f"{c['source']}/{c['field']}" for c in ranked]}
+        for n in eval_k:
+            recall, hit, _ = evaluate_retrieval(ranked, item['relevant'], n)
+            quality[f"recall@{n}"].append(recall)
+            quality[f"hit@{n}"].append(hit)
+            result[f"recall@{n}"] = recall
+        result["reciprocal_rank"] = evaluate_retrieval(ranked, item['relevant'], max_k)[2]
+        quality["mrr"].append(result["reciprocal_rank"])
+        per_question.append(result)
+
+    del store, chunks_by_id
+    shutil.rmtree(kb_root, ignore_errors=True)
+
+    return {
+        "created_at": time.strftime('%Y-%m-%dT%H:%M:%S'),
+        "git_revision": git_revision(),
+        "environment": {"python": platform.python_version(), "platform": platform.platform()},
+        "config": {
+            "data_path": data_path, "questions_path": questions_path, "model_name": model_name, "backend": backend,
+            "index_type": resolved_type, "index_params": params, "k": k, "min_similarity": min_similarity,
+            "repeat": repeat, "retriever": retriever, "candidates": candidates,
+            "lexical_min_coverage": lexical_min_coverage, "reranker_model": reranker_model,
+            "context_token_budget": context_token_budget,
+        },
+        "corpus": {"programs": len(programs_data), "chunks": len(chunks), "questions": len(questions)},
+        "quality": {name: float(np.mean(values)) if values else 0.0 for name, values in quality.items()},
+        "prompt": {
+            "context_tokens_mean": float(np.mean(context_tokens_samples)) if context_tokens_samples else 0.0,
+            "context_tokens_max": int(max(context_tokens_samples, default=0)),
+            "max_tokens_mean": float(np.mean(max_tokens_samples)) if max_tokens_samples else 0.0,
+        },
+        "latency": {stage: percentiles(samples) for stage, samples in timings.items() if samples},
+        "per_question": per_question,
+    }
+
+
+def compare_with_baseline(report, baseline, max_quality_drop, max_latency_increase):
+    """Возвращает список регрессий относительно базового отчета."""
+    regressions = []
+    for name, value in baseline.get("quality", {}).items():
+        current = report["quality"].get(name)
+        if current is not None and current < value - max_quality_drop:
+            regressions.append(f"{name}: {value:.3f} -> {current:.3f}")
+    for stage in ("embed_query", "search", "prompt_assembly"):
+        base_p95 = baseline.get("latency", {}).get(stage, {}).get("p95_ms")
+        current_p95 = report["latency"][stage]["p95_ms"]
+        if base_p95 and current_p95 > base_p95 * (1 + max_latency_increase):
+            regressions.append(f"{stage} p95: {base_p95:.2f} мс -> {current_p95:.2f} мс")
+    return regressions
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description="Офлайн-бенчмарк поиска и задержек RAG-пайплайна")
+    arg_parser.add_argument('--data', default=DEFAULT_DATA_PATH, help="programs_data.json для построения базы")
+    arg_parser.add_argument('--questions', default=DEFAULT_QUESTIONS_PATH, help="Размеченные вопросы")
+    arg_parser.add_argument('--model', default=MODEL_NAME)
+    arg_parser.add_argument('--backend', default='torch', choices=ENCODER_BACKENDS, help="Бэкенд модели эмбеддингов")
+    arg_parser.add_argument('--index-type', default='auto')
+    arg_parser.add_argument('--retriever', default='hybrid', choices=RETRIEVERS, help="Векторный или гибридный (FAISS + BM25) поиск")
+    arg_parser.add_argument('--candidates', type=int, default=20, help="Кандидатов от каждого поиска в гибридном режиме")
+    arg_parser.add_argument('--lexical-min-coverage', type=float, default=0.6)
+    arg_parser.add_argument('--reranker', help="CrossEncoder-модель для переранжирования кандидатов")
+    arg_parser.add_argument('--rerank-candidates', type=int, default=10)
+    arg_parser.add_argument('--context-token-budget', type=int, default=DEFAULT_CONTEXT_TOKEN_BUDGET,
+                            help="Бюджет токенов контекста при сборке промпта")
+    arg_parser.add_argument('--k', type=int, default=3, help="Число чанков в контексте, как в боте")
+    arg_parser.add_argument('--min-similarity', type=float, default=0.0, help="Порог релевантности при сборке промпта")
+    arg_parser.add_argument('--repeat', type=int, default=3, help="Повторов каждого вопроса для замера задержек")
+    arg_parser.add_argument('--output', default=DEFAULT_REPORT_PATH, help="Куда сохранить JSON-отчет")
+    arg_parser.add_argument('--baseline', help="Базовый отчет для проверки регрессий")
+    arg_parser.add_argument('--max-quality-drop', type=float, default=0.02)
+    arg_parser.add_argument('--max-latency-increase', type=float, default=0.25, help="Допустимый рост p95 (доля)")
+    args = arg_parser.parse_args()
+
+    report = run_benchmark(args.data, args.questions, args.model, args.index_type, args.k,
+                           min_similarity=args.min_similarity, repeat=args.repeat, backend=args.backend,
+                           retriever=args.retriever, candidates=args.candidates,
+                           lexical_min_coverage=args.lexical_min_coverage, reranker_model=args.reranker,
+                           rerank_candidates=args.rerank_candidates, context_token_budget=args.context_token_budget)
+
+    os.makedirs(os.path.dirname(args.output) or '.', exist_ok=True)
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=4)
+
+    print(f"Чанков: {report['corpus']['chunks']}, вопросов: {report['corpus']['questions']}")
+    print(f"Контекст: в среднем {report['prompt']['context_tokens_mean']:.0f} токенов, "
+          f"max_tokens в среднем {report['prompt']['max_tokens_mean']:.0f}")
+    for name, value in report["quality"].items():
+        print(f"{name}: {value:.3f}")
+    for stage in ("model_load", "warm_up", "embed_query", "search", "dense", "lexical", "fusion", "rerank",
+                  "prompt_assembly", "end_to_end"):
+        latency = report["latency"].get(stage)
+        if latency is None:
+            continue
+        print(f"{stage}: p50={latency['p50_ms']:.2f} мс, p95={latency['p95_ms']:.2f} мс, p99={latency['p99_ms']:.2f} мс")
+    print(f"Отчет сохранен в {args.output}")
+
+    if args.baseline:
+        with open(args.baseline, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+        regressions = compare_with_baseline(report, baseline, args.max_quality_drop, args.max_latency_increase)
+        if regressions:
+            print("Обнаружены регрессии относительно базового отчета:")
+            for regression in regressions:
+                print(f"  - {regression}")
+            sys.exit(1)
+        print("Регрессий относительно базового отчета нет.")
+
+
+if __name__ == "__main__":
+    main()
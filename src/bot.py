@@ -1,15 +1,41 @@
 # src/bot.py
 import os
-import json
+import math
+import time
+import signal
+import asyncio
 import logging
-from telegram import Update
+import contextlib
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+import httpx
+from telegram import Bot, Update
+from telegram.constants import ChatAction
+from telegram.helpers import escape_markdown
 from telegram.ext import ApplicationBuilder, ContextTypes, CommandHandler, MessageHandler, filters, ConversationHandler
-from sentence_transformers import SentenceTransformer
-import faiss
 import numpy as np
 from dotenv import load_dotenv
+from embedding_service import EmbeddingBatcher
+from answer_cache import LeaderCancelledError, RequestCoalescer, SemanticAnswerCache
+from rate_limiter import AdmissionQueue, LLMBudget, QueueFullError, UserRateLimiter
+from context_builder import count_tokens
+from telegram_streaming import StreamInterruptedError, StreamingMessage
+from vector_store import FAISS_INDEX_PATH, INDEX_META_PATH, encode_queries
+from rag_pipeline import StageTimings, build_extractive_answer, build_llm_request, hybrid_retrieve
+from encoder import DEFAULT_MODEL_NAME, check_index_compatibility, load_encoder, resolve_model_name, warm_up
+from kb_store import KB_CURRENT_PATH
+from knowledge_base import KnowledgeBaseError, KnowledgeBaseManager
+from reranker import load_reranker, rerank
+from recommender import ANSWER_KEYS, ANSWER_TITLES, FIELD_TITLES, ProgramRecommender
 # Импорты для OpenAI
-from openai import OpenAI, APIError, RateLimitError, AuthenticationError
+from openai import AsyncOpenAI, APIError, RateLimitError, AuthenticationError
+from llm_gateway import CircuitBreaker, LLMGateway, LLMUnavailableError
+from metrics import Registry, RequestTrace, start_metrics_server, stats_samples
+from persistence import DEFAULT_PERSISTENCE_PATH, SQLitePersistence
+from webhook import create_dispatcher, remote_worker_urls, start_update_listener, wait_for_workers
+from startup import StartupState
+from conversation_memory import ConversationMemory
 
 # --- Загрузка переменных окружения ---
 load_dotenv()
@@ -17,10 +43,109 @@ load_dotenv()
 # --- Конфигурация ---
 TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
-MODEL_NAME = 'intfloat/multilingual-e5-large'
-FAISS_INDEX_PATH = 'models/faiss_index.bin'
-CHUNKS_PATH = 'models/chunks.json'
-DATA_FILE_PATH = 'data/programs_data.json'
+# Адрес OpenAI-совместимого API (например, локальной заглушки src/stub_llm_server.py); пусто - api.openai.com
+OPENAI_BASE_URL = os.getenv("OPENAI_BASE_URL") or None
+# Модель эмбеддингов и бэкенд инференса (torch, int8, onnx, small) - должны совпадать с data_processor.py
+ENCODER_BACKEND = os.getenv("ENCODER_BACKEND", "torch")
+MODEL_NAME = resolve_model_name(os.getenv("EMBEDDING_MODEL", DEFAULT_MODEL_NAME), ENCODER_BACKEND)
+ONNX_FILE_NAME = os.getenv("ONNX_FILE_NAME")  # например onnx/model_qint8_avx512_vnni.onnx
+LLM_MODEL = 'gpt-4o-mini'
+# Параметры конкурентной обработки запросов
+MAX_CONCURRENT_REQUESTS = int(os.getenv("MAX_CONCURRENT_REQUESTS", "16"))  # Лимит одновременно обрабатываемых вопросов
+MAX_QUEUED_REQUESTS = int(os.getenv("MAX_QUEUED_REQUESTS", "64"))  # Сверх этой очереди вопросы отклоняются сразу
+# Лимит вопросов одного пользователя: в минуту и допустимая серия подряд
+USER_RATE_PER_MINUTE = float(os.getenv("USER_RATE_PER_MINUTE", "6"))
+USER_BURST = int(os.getenv("USER_BURST", "3"))
+# Глобальный бюджет LLM (ниже лимитов тарифа OpenAI): запросов и токенов в минуту, 0 - без ограничения
+LLM_REQUESTS_PER_MINUTE = float(os.getenv("LLM_REQUESTS_PER_MINUTE", "400"))
+LLM_TOKENS_PER_MINUTE = float(os.getenv("LLM_TOKENS_PER_MINUTE", "150000"))
+EMBEDDING_WORKERS = int(os.getenv("EMBEDDING_WORKERS", "2"))  # Потоки для вычисления эмбеддингов
+LLM_MAX_CONNECTIONS = int(os.getenv("LLM_MAX_CONNECTIONS", "20"))  # Размер пула HTTP-соединений к OpenAI
+LLM_TIMEOUT_SECONDS = float(os.getenv("LLM_TIMEOUT_SECONDS", "20"))  # Таймаут одной попытки
+# Отказоустойчивость вызова LLM: общий дедлайн с повторами, число повторов и базовая пауза между ними
+LLM_DEADLINE_SECONDS = float(os.getenv("LLM_DEADLINE_SECONDS", "30"))
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "2"))
+LLM_BACKOFF_BASE = float(os.getenv("LLM_BACKOFF_BASE", "0.5"))
+# Предохранитель: неудач подряд до размыкания и время до пробного запроса (сек.)
+LLM_BREAKER_FAILURES = int(os.getenv("LLM_BREAKER_FAILURES", "5"))
+LLM_BREAKER_RESET_SECONDS = float(os.getenv("LLM_BREAKER_RESET_SECONDS", "30"))
+# Страхующий запрос после этого перцентиля задержки (например, 0.95; 0 - отключено)
+LLM_HEDGE_PERCENTILE = float(os.getenv("LLM_HEDGE_PERCENTILE", "0"))
+# Микро-батчинг эмбеддингов: окно ожидания и максимальный размер батча
+EMBEDDING_BATCH_WINDOW_MS = float(os.getenv("EMBEDDING_BATCH_WINDOW_MS", "10"))
+EMBEDDING_MAX_BATCH_SIZE = int(os.getenv("EMBEDDING_MAX_BATCH_SIZE", "32"))
+# Кэш ответов: размер (0 - отключен), время жизни записи и порог косинусной близости вопросов
+ANSWER_CACHE_SIZE = int(os.getenv("ANSWER_CACHE_SIZE", "1000"))
+ANSWER_CACHE_TTL_SECONDS = float(os.getenv("ANSWER_CACHE_TTL_SECONDS", "3600"))
+ANSWER_CACHE_SIMILARITY = float(os.getenv("ANSWER_CACHE_SIMILARITY", "0.95"))
+# Потоковая выдача ответа правками одного сообщения и минимальный интервал между правками (сек.)
+STREAM_ANSWERS = os.getenv("STREAM_ANSWERS", "0").lower() in ("1", "true", "yes")
+STREAM_EDIT_INTERVAL = float(os.getenv("STREAM_EDIT_INTERVAL", "1.0"))
+# Дедлайн генерации потокового ответа целиком (сек.): дедлайн шлюза LLM действует только до открытия потока
+LLM_STREAM_DEADLINE_SECONDS = float(os.getenv("LLM_STREAM_DEADLINE_SECONDS", "60"))
+# Число извлекаемых чанков и минимальная косинусная близость вопроса и чанка
+RETRIEVAL_TOP_K = int(os.getenv("RETRIEVAL_TOP_K", "3"))
+RELEVANCE_MIN_SIMILARITY = float(os.getenv("RELEVANCE_MIN_SIMILARITY", "0.8"))
+# Гибридный поиск: кандидатов от каждого поиска и минимальная доля запроса, найденная BM25 в чанке
+RETRIEVAL_CANDIDATES = int(os.getenv("RETRIEVAL_CANDIDATES", "20"))
+LEXICAL_MIN_COVERAGE = float(os.getenv("LEXICAL_MIN_COVERAGE", "0.6"))
+# Необязательный переранжировщик (CrossEncoder, пусто - отключен) и число переранжируемых кандидатов
+RERANKER_MODEL = os.getenv("RERANKER_MODEL", "")
+RERANK_CANDIDATES = int(os.getenv("RERANK_CANDIDATES", "10"))
+# /recommend: сколько программ показать (лучшая + альтернативы) и длина цитаты-причины
+RECOMMEND_TOP_N = int(os.getenv("RECOMMEND_TOP_N", "3"))
+RECOMMEND_REASON_CHARS = int(os.getenv("RECOMMEND_REASON_CHARS", "160"))
+# Бюджет токенов контекста и лимиты длины ответа (с контекстом - от min до max, без контекста - отдельный)
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "1500"))
+ANSWER_MIN_TOKENS = int(os.getenv("ANSWER_MIN_TOKENS", "200"))
+ANSWER_MAX_TOKENS = int(os.getenv("ANSWER_MAX_TOKENS", "800"))
+NO_CONTEXT_ANSWER_TOKENS = int(os.getenv("NO_CONTEXT_ANSWER_TOKENS", "150"))
+# Память диалога: ходов в буфере пользователя (0 - отключена), лимиты токенов вопроса, ответа и сводки старых ходов
+MEMORY_MAX_TURNS = int(os.getenv("MEMORY_MAX_TURNS", "3"))
+MEMORY_QUESTION_TOKENS = int(os.getenv("MEMORY_QUESTION_TOKENS", "60"))
+MEMORY_ANSWER_TOKENS = int(os.getenv("MEMORY_ANSWER_TOKENS", "120"))
+MEMORY_SUMMARY_TOKENS = int(os.getenv("MEMORY_SUMMARY_TOKENS", "100"))
+# Сколько токенов истории добавляется в запрос к LLM
+MEMORY_HISTORY_TOKEN_BUDGET = int(os.getenv("MEMORY_HISTORY_TOKEN_BUDGET", "400"))
+# Сессия без вопросов дольше этого времени удаляется (сек.); предел числа сессий в памяти
+MEMORY_IDLE_SECONDS = float(os.getenv("MEMORY_IDLE_SECONDS", "1800"))
+MEMORY_MAX_SESSIONS = int(os.getenv("MEMORY_MAX_SESSIONS", "20000"))
+# Бюджеты задержки этапов поиска (мс); переранжирование, не уложившееся в бюджет, пропускается
+RETRIEVAL_BUDGETS_MS = {
+    "dense": float(os.getenv("DENSE_SEARCH_BUDGET_MS", "30")),
+    "lexical": float(os.getenv("LEXICAL_SEARCH_BUDGET_MS", "15")),
+    "fusion": float(os.getenv("FUSION_BUDGET_MS", "5")),
+    "rerank": float(os.getenv("RERANK_BUDGET_MS", "250")),
+}
+# Период проверки файлов models/ для горячей перезагрузки базы знаний (сек., 0 - отключено)
+KB_WATCH_INTERVAL = float(os.getenv("KB_WATCH_INTERVAL", "30"))
+# Локальный эндпоинт метрик Prometheus (/metrics; порт 0 - отключен)
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9108"))
+# В лог пишутся трассы запросов не короче этого порога (мс; 0 - все запросы)
+TRACE_LOG_THRESHOLD_MS = float(os.getenv("TRACE_LOG_THRESHOLD_MS", "0"))
+# Режим работы: polling (один процесс), webhook (диспетчер и воркеры) или worker (только воркер)
+BOT_MODE = os.getenv("BOT_MODE", "polling").lower()
+# Адрес Bot API (например, локальной заглушки src/fake_updates.py); пусто - api.telegram.org
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL") or None
+# Хранилище состояния диалогов и user_data (пусто - только в памяти) и период записи в него (сек.)
+PERSISTENCE_PATH = os.getenv("PERSISTENCE_PATH", DEFAULT_PERSISTENCE_PATH)
+PERSISTENCE_UPDATE_INTERVAL = float(os.getenv("PERSISTENCE_UPDATE_INTERVAL", "5"))
+# Webhook: публичный URL (пусто - webhook у Telegram не регистрируется), адрес диспетчера и секрет
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8443"))
+WEBHOOK_PATH = urlsplit(WEBHOOK_URL).path or "/telegram"
+WEBHOOK_SECRET_TOKEN = os.getenv("WEBHOOK_SECRET_TOKEN", "")
+# Воркеры: число локальных процессов и их порты, либо готовые адреса воркеров на других хостах
+WEBHOOK_WORKERS = int(os.getenv("WEBHOOK_WORKERS", "2"))
+WEBHOOK_WORKER_URLS = [url.strip() for url in os.getenv("WEBHOOK_WORKER_URLS", "").split(",") if url.strip()]
+WORKER_HOST = os.getenv("WORKER_HOST", "127.0.0.1")
+WORKER_PORT = int(os.getenv("WORKER_PORT", "8301"))
+# Сколько вопрос, пришедший во время запуска, ждет готовности поиска (сек.); дольше - ответ "бот еще не готов"
+STARTUP_WAIT_SECONDS = float(os.getenv("STARTUP_WAIT_SECONDS", "60"))
+# Telegram ID администраторов, которым доступна команда /reload
+ADMIN_USER_IDS = {int(user_id) for user_id in os.getenv("ADMIN_USER_IDS", "").split(",") if user_id.strip()}
 
 # --- Настройка логирования ---
 logging.basicConfig(
@@ -30,12 +155,44 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 # --- Глобальные переменные ---
+# Состояние запуска: модель и база знаний грузятся в фоне, бот принимает сообщения сразу
+startup = None
+startup_task = None
 model = None
-index = None
-chunks = None
-programs_data = None
-# Инициализация клиента OpenAI
+# Текущее поколение базы знаний (индекс, чанки, данные программ)
+knowledge_base = None
+# Инициализация клиента OpenAI и шлюза с повторами и предохранителем поверх него
 client = None
+llm_gateway = None
+llm_check_task = None
+# Пул потоков для эмбеддингов и ограничитель одновременных запросов
+embedding_executor = None
+embedding_batcher = None
+request_queue = None
+answer_cache = None
+# Ограничения нагрузки: лимит на пользователя, бюджет LLM и склейка одинаковых вопросов
+user_rate_limiter = UserRateLimiter(USER_RATE_PER_MINUTE, USER_BURST)
+llm_budget = LLMBudget(LLM_REQUESTS_PER_MINUTE, LLM_TOKENS_PER_MINUTE)
+request_coalescer = RequestCoalescer()
+reranker = None
+# Последние ходы диалога каждого пользователя для уточняющих вопросов
+conversation_memory = ConversationMemory(
+    MEMORY_MAX_TURNS, MEMORY_QUESTION_TOKENS, MEMORY_ANSWER_TOKENS, MEMORY_SUMMARY_TOKENS,
+    MEMORY_IDLE_SECONDS, MEMORY_MAX_SESSIONS, LLM_MODEL
+)
+# Задержки этапов поиска и превышения бюджетов
+retrieval_timings = StageTimings(RETRIEVAL_BUDGETS_MS)
+# Метрики Prometheus: гистограммы этапов и запросов, расход токенов, ошибки по классам
+metrics_registry = Registry()
+stage_latency = metrics_registry.histogram(
+    "bot_stage_seconds", "Длительность этапов обработки вопроса", ("stage",))
+request_latency = metrics_registry.histogram(
+    "bot_request_seconds", "Полное время обработки вопроса по исходу", ("outcome",))
+llm_tokens = metrics_registry.counter("bot_llm_tokens_total", "Расход токенов LLM", ("kind",))
+request_errors = metrics_registry.counter("bot_errors_total", "Ошибки при обработке вопросов по классу", ("error",))
+metrics_server = None
+# Исходы запроса, при которых пользователь получил ответ по существу (для времени до первого ответа)
+ANSWERED_OUTCOMES = frozenset(("answered", "cache_exact", "cache_semantic", "coalesced", "degraded"))
 
 # --- Состояния для рекомендаций ---
 BACKGROUND, INTERESTS, CAREER = range(3)
@@ -62,11 +219,19 @@ RECOMMEND_RESULT_MESSAGE = (
     "- Интересы: {interests}\n"
     "- Карьерная цель: {career_goal}\n\n"
     "📊 Рекомендация: *{recommended_program}*\n"
-    "📌 Причина: {reason}\n\n"
+    "📌 Почему:\n{reasons}\n\n"
+    "{alternatives}"
     "Теперь ты можешь задать мне вопросы об этой программе!"
 )
+RECOMMEND_REASON_LINE = "- {answer} ↔ {field}: «{text}»"
+RECOMMEND_ALTERNATIVES_HEADER = "Также стоит посмотреть:\n"
 RECOMMEND_CANCEL_MESSAGE = "Рекомендация отменена. Можешь задать любой вопрос о программах."
 
+RELOAD_DONE_MESSAGE = "✅ База знаний обновлена: поколение #{generation}, {num_vectors} фрагментов."
+RELOAD_UNCHANGED_MESSAGE = "База знаний не изменилась (поколение #{generation})."
+RELOAD_FAILED_MESSAGE = "Не удалось обновить базу знаний: {error}"
+NOT_READY_MESSAGE = "Извините, бот еще не готов. Попробуйте позже."
+
 # --- Сообщение, если OpenAI API не настроен ---
 NO_LLM_MESSAGE = (
     "Бот настроен, но API-ключ для генерации ответов (OpenAI) не найден.\n"
@@ -78,12 +243,19 @@ NO_LLM_MESSAGE = (
 LLM_API_ERROR_MESSAGE = "К сожалению, возникла ошибка при обращении к сервису генерации ответов. Попробуйте задать вопрос позже."
 LLM_AUTH_ERROR_MESSAGE = "Ошибка аутентификации с API генерации ответов. Обратитесь к администратору бота."
 LLM_RATE_LIMIT_MESSAGE = "Превышен лимит запросов к сервису генерации ответов. Попробуйте задать вопрос через несколько минут."
+STREAM_INTERRUPTED_NOTE = "⚠️ Ответ прерван из-за ошибки сервиса генерации. Попробуйте задать вопрос еще раз."
+EMPTY_ANSWER_MESSAGE = "Не удалось получить ответ от сервиса генерации. Попробуйте задать вопрос еще раз."
+LLM_UNAVAILABLE_HEADER = "⚠️ Сервис генерации ответов временно недоступен, поэтому отвечаю выдержкой из материалов программ:"
+USER_RATE_LIMITED_MESSAGE = "⏳ Вы задаете вопросы слишком часто. Пожалуйста, подождите {seconds} с и спросите снова."
+OVERLOADED_MESSAGE = "😔 Сейчас бот получает очень много вопросов. Пожалуйста, повторите вопрос через минуту."
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик команды /start."""
+    # /start начинает диалог заново: уточняющие вопросы больше не ссылаются на прошлые
+    conversation_memory.clear(update.effective_user.id)
     await context.bot.send_message(chat_id=update.effective_chat.id, text=START_MESSAGE, parse_mode='Markdown')
 
-# --- Логика рекомендаций (без изменений) ---
+# --- Логика рекомендаций ---
 async def recommend_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text(RECOMMEND_START_MESSAGE)
     return BACKGROUND
@@ -100,196 +272,635 @@ async def recommend_interests(update: Update, context: ContextTypes.DEFAULT_TYPE
 
 async def recommend_career(update: Update, context: ContextTypes.DEFAULT_TYPE):
     context.user_data['career_goal'] = update.message.text
-    
-    background = context.user_data.get('background', '').lower()
-    interests = context.user_data.get('interests', '').lower()
-    career_goal = context.user_data.get('career_goal', '').lower()
-
-    ai_keywords = ['ml engineer', 'data engineer', 'data scientist', 'computer vision', 'nlp', 'reinforcement learning', 'машинное обучение', 'глубокое обучение', 'нейронные сети', 'алгоритмы', 'программирование', 'математика', 'статистика', ' middle', 'middle']
-    ai_product_keywords = ['product manager', 'ai product', 'product', 'бизнес', 'аналитик', 'data analyst', 'системный подход', 'экономика', 'менеджмент', 'управление проектами', 'developer']
-
-    ai_score = sum(1 for keyword in ai_keywords if keyword in interests or keyword in career_goal or keyword in background)
-    ai_product_score = sum(1 for keyword in ai_product_keywords if keyword in interests or keyword in career_goal or keyword in background)
-
-    if ai_score > ai_product_score:
-        recommended_program = "Искусственный интеллект"
-        reason = "так как ты упомянул роли или области, связанные с разработкой и инженерией ИИ (ML Engineer, Data Engineer, Computer Vision и т.д.)."
-    elif ai_product_score > ai_score:
-        recommended_program = "AI и ML в технических системах"
-        reason = "так как ты упомянул интерес к продуктам, бизнесу или анализу данных (AI Product Manager, Data Analyst и т.д.)."
-    else:
-        recommended_program = "Искусственный интеллект"
-        reason = "так как эта программа имеет более широкий охват технических ролей в области ИИ."
+    # Первые шаги диалога модели не требуют; к последнему она может еще загружаться
+    if startup.starting:
+        await context.bot.send_chat_action(chat_id=update.effective_chat.id, action=ChatAction.TYPING)
+        await startup.wait_ready(STARTUP_WAIT_SECONDS)
+    kb = knowledge_base.current if knowledge_base else None
+    if not startup.ready or kb is None or kb.recommender is None:
+        await update.message.reply_text(NOT_READY_MESSAGE)
+        return ConversationHandler.END
+
+    # Три ответа кодируются в одном батче и сравниваются со всеми программами одним матричным умножением
+    answers = [context.user_data.get(key, '') for key in ANSWER_KEYS]
+    answer_embeddings = await asyncio.gather(*(embedding_batcher.encode(answer) for answer in answers))
+    recommendations = kb.recommender.recommend(np.stack(answer_embeddings), top_n=RECOMMEND_TOP_N)
+    best = recommendations[0]
+    # Дальнейшие вопросы вроде "а какие там стипендии?" относятся к рекомендованной программе
+    context.user_data['recommended_program'] = best['name']
+    conversation_memory.set_focus(update.effective_user.id, best['name'])
+
+    reasons = "\n".join(
+        RECOMMEND_REASON_LINE.format(
+            answer=ANSWER_TITLES[reason['answer']],
+            field=FIELD_TITLES[reason['field']],
+            text=escape_markdown(_shorten(reason['text'], RECOMMEND_REASON_CHARS)),
+        )
+        for reason in best['reasons']
+    )
+    alternatives = ""
+    if len(recommendations) > 1:
+        alternatives = RECOMMEND_ALTERNATIVES_HEADER + "\n".join(
+            f"- {escape_markdown(program['name'])}" for program in recommendations[1:]
+        ) + "\n\n"
 
     final_message = RECOMMEND_RESULT_MESSAGE.format(
-        background=context.user_data['background'],
-        interests=context.user_data['interests'],
-        career_goal=context.user_data['career_goal'],
-        recommended_program=recommended_program,
-        reason=reason
+        background=escape_markdown(context.user_data['background']),
+        interests=escape_markdown(context.user_data['interests']),
+        career_goal=escape_markdown(context.user_data['career_goal']),
+        recommended_program=escape_markdown(best['name']),
+        reasons=reasons,
+        alternatives=alternatives,
     )
-    
+    logger.info(
+        "Рекомендация: " + ", ".join(f"{program['name']} ({program['score']:.3f})" for program in recommendations)
+    )
+
     await update.message.reply_text(final_message, parse_mode='Markdown')
     return ConversationHandler.END
 
+def _shorten(text, limit):
+    """Обрезает цитату до limit символов по границе слова."""
+    if len(text) <= limit:
+        return text
+    return text[:limit].rsplit(' ', 1)[0] + '…'
+
 async def recommend_cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text(RECOMMEND_CANCEL_MESSAGE)
     return ConversationHandler.END
 
+# --- Администрирование ---
+async def reload_knowledge_base(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Обработчик команды /reload: подгружает новую версию базы знаний без перезапуска."""
+    if update.effective_user.id not in ADMIN_USER_IDS:
+        return
+    if not startup.ready:
+        await update.message.reply_text(RELOAD_FAILED_MESSAGE.format(error=f"бот еще не запущен ({startup.status})"))
+        return
+    try:
+        swapped = await knowledge_base.reload(force=True)
+    except KnowledgeBaseError as e:
+        await update.message.reply_text(RELOAD_FAILED_MESSAGE.format(error=e))
+        return
+    current = knowledge_base.current
+    template = RELOAD_DONE_MESSAGE if swapped else RELOAD_UNCHANGED_MESSAGE
+    await update.message.reply_text(template.format(generation=current.generation, num_vectors=current.index.ntotal))
+
 # --- НОВАЯ ЛОГИКА ОБРАБОТКИ ВОПРОСОВ С ИСПОЛЬЗОВАНИЕМ LLM ---
 async def handle_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик всех текстовых сообщений."""
     user_question = update.message.text
+    chat_id = update.effective_chat.id
     logger.info(f"Получен вопрос от пользователя {update.effective_user.first_name}: {user_question}")
+    # Трасса запроса: этапы попадают в гистограммы, а по завершении трасса пишется в лог
+    trace = RequestTrace(stage_latency, request_latency, TRACE_LOG_THRESHOLD_MS,
+                         user_id=update.effective_user.id, question_chars=len(user_question))
+
+    # Вопрос, пришедший во время запуска, ждет готовности поиска в очереди, а не отклоняется сразу
+    if startup.starting:
+        await context.bot.send_chat_action(chat_id=chat_id, action=ChatAction.TYPING)
+        with trace.span("startup_wait"):
+            await startup.wait_ready(STARTUP_WAIT_SECONDS)
+
+    # Запрос целиком обрабатывается на одном поколении базы знаний, даже если оно будет подменено
+    kb = knowledge_base.current if knowledge_base else None
 
     # Проверка наличия необходимых компонентов
-    if not model or not index or not chunks:
-        await context.bot.send_message(chat_id=update.effective_chat.id, text="Извините, бот еще не готов. Попробуйте позже.")
+    if not startup.ready or kb is None:
+        await context.bot.send_message(chat_id=chat_id, text=NOT_READY_MESSAGE)
+        trace.finish("not_ready")
         return
 
-    if not client:
-        await context.bot.send_message(chat_id=update.effective_chat.id, text=NO_LLM_MESSAGE)
+    if not llm_gateway:
+        await context.bot.send_message(chat_id=chat_id, text=NO_LLM_MESSAGE)
+        trace.finish("no_llm")
         return
 
-    try:
-        # 1. Поиск релевантного контекста
-        # Создание эмбеддинга вопроса
-        question_embedding = model.encode([user_question])
-        question_embedding = np.array(question_embedding).astype('float32')
-
-        # Поиск похожих чанков
-        k = 3
-        distances, indices = index.search(question_embedding, k)
-        
-        # Фильтрация по релевантности
-        relevance_threshold = 80.0 
-        best_distance = distances[0][0] if len(distances[0]) > 0 else float('inf')
-
-        # 2. Подготовка данных для LLM
-        system_prompt = (
-            "Вы являетесь полезным помощником для абитуриентов, выбирающих магистерские программы "
-            "ИТМО 'Искусственный интеллект' и 'AI и ML в технических системах'. "
-            "Ваша задача - отвечать на вопросы абитуриентов на основе предоставленной информации. "
-            "Информация будет содержаться в разделе 'Контекст'. "
-            "Если в 'Контексте' нет информации для ответа на вопрос, вежливо сообщите, что не знаете ответа. "
-            "Всегда отвечайте на русском языке. "
-            "Не придумывайте факты, которых нет в контексте. "
-            "Если вопрос не по теме программ ИТМО, вежливо укажите на это."
-            "Отвечай приветливо и вежливо"
-        )
-
-        if best_distance > relevance_threshold:
-            # Контекст не найден - сообщаем LLM, что информации нет
-            user_prompt = (
-                f"Вопрос абитуриента: {user_question}\n\n"
-                f"Контекст: Информация по данному вопросу в базе данных не найдена. "
-                f"Пожалуйста, вежливо сообщите абитуриенту, что вы не можете ответить на этот вопрос, "
-                f"так как он не относится к программам магистратуры ИТМО по ИИ. "
-                f"Предложите задать вопросы о программах 'Искусственный интеллект' или 'AI и ML в технических системах'."
-            )
-        else:
-            # Контекст найден - формируем его для LLM
-            relevant_chunks = [chunks[idx] for i, idx in enumerate(indices[0]) if distances[0][i] <= relevance_threshold]
-            
-            # Формируем строку контекста
-            context_parts = []
-            for chunk in relevant_chunks:
-                part = f"Источник: {chunk['source']}\nРаздел: {chunk['field']}\nИнформация: {chunk['text']}"
-                context_parts.append(part)
-            context_text = "\n\n---\n\n".join(context_parts)
-
-            user_prompt = (
-                f"Вопрос абитуриента: {user_question}\n\n"
-                f"Контекст:\n{context_text}\n\n"
-                f"Пожалуйста, ответьте на вопрос абитуриента, используя только информацию из контекста. "
-                f"Если контекст не позволяет ответить, скажите, что информации недостаточно."
-            )
-
-        # 3. Вызов LLM
-        logger.info("Отправка запроса к LLM...")
-        chat_completion = client.chat.completions.create(
-            messages=[
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": user_prompt}
-            ],
-            model="gpt-4o-mini", # Используем gpt-4o-mini
-            max_tokens=1000,
-            temperature=0.2 # Низкая температура для более точных и фактических ответов
-        )
-        logger.info("Ответ от LLM получен.")
+    # Лимит на пользователя проверяется до любой тяжелой работы
+    retry_after = user_rate_limiter.try_acquire(update.effective_user.id)
+    if retry_after > 0:
+        logger.info(f"Пользователь {update.effective_user.id} превысил лимит вопросов.")
+        await context.bot.send_message(chat_id=chat_id, text=USER_RATE_LIMITED_MESSAGE.format(seconds=math.ceil(retry_after)))
+        trace.finish("rate_limited")
+        return
 
-        # 4. Отправка ответа пользователю
-        answer = chat_completion.choices[0].message.content
-        await context.bot.send_message(chat_id=update.effective_chat.id, text=answer)
+    # Уточняющий вопрос ("а на второй программе?") переписывается в самостоятельный запрос:
+    # по нему работают кэш, склейка и поиск, а LLM получает исходный вопрос и историю диалога
+    user_id = update.effective_user.id
+    program_names = [program['name'] for program in kb.programs_data or ()]
+    retrieval_query = conversation_memory.rewrite_query(
+        user_id, user_question, program_names, context.user_data.get('recommended_program')
+    )
+    if retrieval_query != user_question:
+        logger.info(f"Уточняющий вопрос переписан для поиска: {retrieval_query}")
+        trace.set(query_rewritten=True)
+    # Ответ с историей зависит от диалога этого пользователя: общий кэш ответов и склейка
+    # одинаковых вопросов используются только для вопросов без истории
+    history = conversation_memory.history_messages(user_id, MEMORY_HISTORY_TOKEN_BUDGET)
+    trace.set(history_messages=len(history))
+
+    answer = None
+    try:
+        started_at = trace.started_at
+        # 0. Точное совпадение в кэше ответов - не нужен даже эмбеддинг
+        if answer_cache and not history:
+            cached_answer = answer_cache.get_exact(retrieval_query)
+            if cached_answer is not None:
+                logger.info("Ответ найден в кэше (точное совпадение).")
+                with trace.span("telegram_send"):
+                    await context.bot.send_message(chat_id=chat_id, text=cached_answer)
+                answer = cached_answer
+                trace.finish("cache_exact")
+                return
+
+        # Такой же вопрос уже обрабатывается - ждем его ответ вместо повторной работы
+        coalesce_key, leader_answer = (None, None) if history else request_coalescer.join(retrieval_query)
+        while leader_answer is not None:
+            logger.info("Такой же вопрос уже обрабатывается, ожидаем его ответ.")
+            try:
+                # shield: отмена ожидающего запроса не должна отменять общий результат
+                with trace.span("coalesced_wait"):
+                    answer = await asyncio.shield(leader_answer)
+            except LeaderCancelledError:
+                # Ведущий отменен - вопрос обрабатывается заново, возможно этим запросом как ведущим
+                logger.info("Ведущий запрос отменен, вопрос обрабатывается заново.")
+                coalesce_key, leader_answer = request_coalescer.join(retrieval_query)
+                continue
+            with trace.span("telegram_send"):
+                await context.bot.send_message(chat_id=chat_id, text=answer or EMPTY_ANSWER_MESSAGE)
+            trace.finish("coalesced" if answer else "empty_answer")
+            return
 
-    except AuthenticationError:
+        try:
+            # Ограничиваем число одновременно обрабатываемых вопросов; при переполненной очереди
+            # вопрос сразу отклоняется, а не копится в памяти
+            queue_started = time.perf_counter()
+            async with request_queue:
+                trace.add_span("queue_wait", queue_started, time.perf_counter() - queue_started)
+                answer = await _answer_question(context, chat_id, kb, user_question, retrieval_query, history,
+                                                started_at, trace)
+        except BaseException as e:
+            if coalesce_key is not None:
+                # Ожидающие не видели начала оборванного ответа - им передается исходная ошибка
+                error = e.__cause__ if isinstance(e, StreamInterruptedError) else e
+                request_coalescer.finish(coalesce_key, error=error)
+            raise
+        if coalesce_key is not None:
+            request_coalescer.finish(coalesce_key, answer=answer)
+
+    except QueueFullError:
+        logger.warning("Очередь вопросов переполнена, вопрос отклонен.")
+        await context.bot.send_message(chat_id=chat_id, text=OVERLOADED_MESSAGE)
+        trace.finish("overloaded")
+    except StreamInterruptedError as e:
+        # Начало ответа и пометка об обрыве уже в сообщении пользователя - отдельное сообщение не нужно
+        request_errors.inc(error=type(e.__cause__).__name__)
+        logger.warning(f"Поток ответа LLM прерван: {type(e.__cause__).__name__}: {e.__cause__}")
+        trace.finish("stream_interrupted")
+    except AuthenticationError as e:
+        request_errors.inc(error=type(e).__name__)
         logger.error("Ошибка аутентификации OpenAI API.")
-        await context.bot.send_message(chat_id=update.effective_chat.id, text=LLM_AUTH_ERROR_MESSAGE)
-    except RateLimitError:
+        await context.bot.send_message(chat_id=chat_id, text=LLM_AUTH_ERROR_MESSAGE)
+    except RateLimitError as e:
+        request_errors.inc(error=type(e).__name__)
         logger.error("Превышен лимит запросов к OpenAI API.")
-        await context.bot.send_message(chat_id=update.effective_chat.id, text=LLM_RATE_LIMIT_MESSAGE)
-    except APIError as e:
-        logger.error(f"Ошибка API OpenAI: {e}")
-        await context.bot.send_message(chat_id=update.effective_chat.id, text=LLM_API_ERROR_MESSAGE)
+        await context.bot.send_message(chat_id=chat_id, text=LLM_RATE_LIMIT_MESSAGE)
+    except (APIError, httpx.HTTPError, asyncio.TimeoutError) as e:
+        request_errors.inc(error=type(e).__name__)
+        logger.error(f"Ошибка API OpenAI: {type(e).__name__}: {e}")
+        await context.bot.send_message(chat_id=chat_id, text=LLM_API_ERROR_MESSAGE)
     except Exception as e:
+        request_errors.inc(error=type(e).__name__)
         logger.error(f"Неожиданная ошибка при обработке сообщения: {e}", exc_info=True)
-        await context.bot.send_message(chat_id=update.effective_chat.id, text="Произошла непредвиденная ошибка. Попробуйте позже.")
-
-# --- Обновленная функция post_init ---
-async def post_init(application: ApplicationBuilder) -> None:
-    """Функция, вызываемая при запуске бота для загрузки модели, индекса и клиента API."""
-    global model, index, chunks, programs_data, client
-    logger.info("Загрузка модели SentenceTransformer...")
-    model = SentenceTransformer(MODEL_NAME)
-    logger.info("Модель загружена.")
-
-    logger.info("Загрузка FAISS индекса и чанков...")
-    if os.path.exists(FAISS_INDEX_PATH) and os.path.exists(CHUNKS_PATH):
-        index = faiss.read_index(FAISS_INDEX_PATH)
-        with open(CHUNKS_PATH, 'r', encoding='utf-8') as f:
-            chunks = json.load(f)
-        logger.info("FAISS индекс и чанки загружены.")
+        await context.bot.send_message(chat_id=chat_id, text="Произошла непредвиденная ошибка. Попробуйте позже.")
+    finally:
+        # Трасса, не завершенная успешным исходом выше, завершается как ошибка
+        trace.finish("error")
+        if trace.outcome in ANSWERED_OUTCOMES:
+            startup.record_first_answer()
+            conversation_memory.add_turn(user_id, user_question, answer, retrieval_query, program_names)
+
+async def _send_degraded_answer(context, chat_id, relevant_chunks, trace, header=None):
+    """Ответ без LLM - выдержка из найденных фрагментов (или просьба повторить позже)."""
+    answer = build_extractive_answer([chunk for chunk, _ in relevant_chunks], header=header) or OVERLOADED_MESSAGE
+    with trace.span("telegram_send"):
+        await context.bot.send_message(chat_id=chat_id, text=answer)
+    trace.finish("degraded")
+    return answer
+
+async def _send_empty_answer(context, chat_id, trace):
+    """LLM вернула пустой ответ: пользователь получает просьбу повторить, ответ не кэшируется и не запоминается."""
+    logger.warning("LLM вернула пустой ответ.")
+    with trace.span("telegram_send"):
+        await context.bot.send_message(chat_id=chat_id, text=EMPTY_ANSWER_MESSAGE)
+    trace.finish("empty_answer")
+    return None
+
+async def _answer_question(context, chat_id, kb, user_question, retrieval_query, history, started_at, trace):
+    """
+    Поиск контекста по retrieval_query (вопрос, дополненный темой диалога), вызов LLM
+    с исходным вопросом и историей history и отправка ответа. Возвращает отправленный текст.
+    """
+    # 1. Поиск релевантного контекста
+    # Создание эмбеддинга вопроса
+    # Вопросы объединяются в батчи и кодируются в пуле потоков, не блокируя event loop
+    with trace.span("encode"):
+        question_embedding = await embedding_batcher.encode(retrieval_query)
+    question_embedding = question_embedding.reshape(1, -1)
+
+    # Почти-дубликат уже заданного вопроса (ответ с историей диалога - личный, в общий кэш не попадает)
+    if answer_cache and not history:
+        with trace.span("semantic_cache"):
+            cached_answer = answer_cache.get(retrieval_query, question_embedding)
+        if cached_answer is not None:
+            logger.info("Ответ найден в кэше (похожий вопрос).")
+            with trace.span("telegram_send"):
+                await context.bot.send_message(chat_id=chat_id, text=cached_answer)
+            trace.finish("cache_semantic")
+            return cached_answer
+
+    # Гибридный поиск (FAISS + BM25) с фильтрацией по релевантности
+    stage_timings = {}
+    retrieval_started = time.perf_counter()
+    candidates = hybrid_retrieve(
+        kb.index, kb.chunks, kb.embeddings, kb.lexical_index, retrieval_query, question_embedding,
+        RETRIEVAL_CANDIDATES, RELEVANCE_MIN_SIMILARITY, LEXICAL_MIN_COVERAGE, timings=stage_timings
+    )
+    # Этапы гибридного поиска идут последовательно - восстанавливаем их начало по длительностям
+    stage_started = retrieval_started
+    for stage, seconds in stage_timings.items():
+        trace.add_span(stage, stage_started, seconds)
+        stage_started += seconds
+    if reranker is not None and len(candidates) > 1:
+        rerank_started = time.perf_counter()
+        try:
+            # Поток переранжирования не прерывается по таймауту, но ответ его не ждет
+            with trace.span("rerank"):
+                candidates = await asyncio.wait_for(
+                    asyncio.get_running_loop().run_in_executor(
+                        embedding_executor, rerank, reranker, retrieval_query, candidates[:RERANK_CANDIDATES]
+                    ),
+                    timeout=RETRIEVAL_BUDGETS_MS["rerank"] / 1000,
+                )
+            stage_timings["rerank"] = time.perf_counter() - rerank_started
+        except asyncio.TimeoutError:
+            logger.warning("Переранжирование не уложилось в бюджет, используется порядок гибридного поиска.")
+            retrieval_timings.record_skip("rerank")
+    retrieval_timings.record(stage_timings)
+    relevant_chunks = candidates[:RETRIEVAL_TOP_K]
+
+    # 2. Подготовка данных для LLM: контекст в пределах бюджета токенов, лимит ответа по объему контекста
+    with trace.span("prompt_build"):
+        llm_messages, max_tokens, context_tokens = build_llm_request(
+            user_question, [chunk for chunk, _ in relevant_chunks], CONTEXT_TOKEN_BUDGET,
+            ANSWER_MIN_TOKENS, ANSWER_MAX_TOKENS, NO_CONTEXT_ANSWER_TOKENS, LLM_MODEL, history
+        )
+        estimated_tokens = sum(count_tokens(message["content"], LLM_MODEL) for message in llm_messages) + max_tokens
+    trace.set(candidates=len(candidates), chunks=len(relevant_chunks), context_tokens=context_tokens,
+              max_tokens=max_tokens)
+
+    # Глобальный бюджет LLM ниже лимитов тарифа: при его исчерпании отвечаем быстро и без LLM
+    if not llm_budget.try_acquire(estimated_tokens):
+        logger.warning("Бюджет запросов к LLM исчерпан, отправляем ответ без генерации.")
+        trace.set(degraded_by="llm_budget")
+        return await _send_degraded_answer(context, chat_id, relevant_chunks, trace)
+
+    # 3. Вызов LLM
+    logger.info(f"Отправка запроса к LLM (контекст {context_tokens} токенов, max_tokens={max_tokens})...")
+    llm_started = time.perf_counter()
+    if STREAM_ANSWERS:
+        # 4. Ответ выводится по мере генерации правками одного сообщения
+        try:
+            # Низкая температура для более точных и фактических ответов
+            stream = await llm_gateway.stream(llm_messages, max_tokens=max_tokens, temperature=0.2)
+        except RateLimitError as e:
+            request_errors.inc(error=type(e).__name__)
+            llm_budget.drain()
+            logger.warning("OpenAI вернул 429, бюджет LLM обнулен; отправляем ответ без генерации.")
+            trace.set(degraded_by=type(e).__name__)
+            return await _send_degraded_answer(context, chat_id, relevant_chunks, trace)
+        except LLMUnavailableError as e:
+            request_errors.inc(error=type(e).__name__)
+            logger.warning(f"{e}; отправляем ответ без генерации.")
+            trace.set(degraded_by=type(e).__name__)
+            return await _send_degraded_answer(context, chat_id, relevant_chunks, trace, LLM_UNAVAILABLE_HEADER)
+        streaming_message = StreamingMessage(
+            context.bot, chat_id,
+            edit_interval=STREAM_EDIT_INTERVAL, started_at=started_at
+        )
+        first_token_seen = False
+        try:
+            # Дедлайн на всю генерацию: зависший посреди ответа поток не держит запрос бесконечно
+            async with asyncio.timeout(LLM_STREAM_DEADLINE_SECONDS):
+                async for chunk in stream:
+                    if chunk.choices:
+                        if not first_token_seen and chunk.choices[0].delta.content:
+                            first_token_seen = True
+                            trace.add_span("llm_first_token", llm_started, time.perf_counter() - llm_started)
+                        await streaming_message.append(chunk.choices[0].delta.content)
+                    elif getattr(chunk, "usage", None):
+                        # Последний фрагмент потока содержит расход токенов
+                        _log_token_usage(chunk.usage, trace)
+        except (APIError, httpx.HTTPError, asyncio.TimeoutError) as e:
+            with contextlib.suppress(Exception):
+                await stream.close()
+            trace.add_span("llm_total", llm_started, time.perf_counter() - llm_started, error=type(e).__name__)
+            # Часть ответа уже видна - курсор убирается, пометка об обрыве дописывается в то же сообщение
+            if await streaming_message.abort(STREAM_INTERRUPTED_NOTE):
+                raise StreamInterruptedError() from e
+            raise
+        answer = await streaming_message.finish()
+        if not answer:
+            return await _send_empty_answer(context, chat_id, trace)
+        # В потоковом режиме генерация перемежается с правками сообщения; их время - отдельным этапом
+        trace.add_span("llm_total", llm_started, time.perf_counter() - llm_started, edits=streaming_message.edits)
+        trace.add_span("telegram_send", llm_started, streaming_message.send_seconds)
+        time_to_first_visible = streaming_message.time_to_first_visible
+        logger.info(f"Ответ от LLM получен потоком ({streaming_message.edits} правок).")
     else:
-        logger.error("Не найдены файлы векторной базы знаний. Пожалуйста, сначала запустите data_processor.py")
+        try:
+            # Низкая температура для более точных и фактических ответов
+            with trace.span("llm_total"):
+                chat_completion = await llm_gateway.complete(llm_messages, max_tokens=max_tokens, temperature=0.2)
+        except RateLimitError as e:
+            request_errors.inc(error=type(e).__name__)
+            llm_budget.drain()
+            logger.warning("OpenAI вернул 429, бюджет LLM обнулен; отправляем ответ без генерации.")
+            trace.set(degraded_by=type(e).__name__)
+            return await _send_degraded_answer(context, chat_id, relevant_chunks, trace)
+        except LLMUnavailableError as e:
+            request_errors.inc(error=type(e).__name__)
+            logger.warning(f"{e}; отправляем ответ без генерации.")
+            trace.set(degraded_by=type(e).__name__)
+            return await _send_degraded_answer(context, chat_id, relevant_chunks, trace, LLM_UNAVAILABLE_HEADER)
+        logger.info("Ответ от LLM получен.")
+        _log_token_usage(chat_completion.usage, trace)
+
+        # 4. Отправка ответа пользователю
+        answer = chat_completion.choices[0].message.content
+        if not answer:
+            return await _send_empty_answer(context, chat_id, trace)
+        with trace.span("telegram_send"):
+            await context.bot.send_message(chat_id=chat_id, text=answer)
+        time_to_first_visible = time.perf_counter() - started_at
+
+    if time_to_first_visible is not None:
+        logger.info(f"Время до первого видимого текста: {time_to_first_visible:.2f} с")
+        trace.set(time_to_first_visible_ms=round(time_to_first_visible * 1000, 3))
+    if answer_cache and answer and not history:
+        answer_cache.put(retrieval_query, question_embedding, answer, latency=time.perf_counter() - started_at)
+    trace.finish("answered")
+    return answer
+
+def _log_token_usage(usage, trace=None):
+    """Расход токенов; cached - часть промпта, взятая из кэша префиксов провайдера."""
+    if usage is None:
         return
+    details = getattr(usage, "prompt_tokens_details", None)
+    cached_tokens = getattr(details, "cached_tokens", None) or 0
+    logger.info(
+        f"Токены: промпт {usage.prompt_tokens} (из кэша {cached_tokens}), ответ {usage.completion_tokens}."
+    )
+    llm_tokens.inc(usage.prompt_tokens - cached_tokens, kind="prompt")
+    llm_tokens.inc(cached_tokens, kind="prompt_cached")
+    llm_tokens.inc(usage.completion_tokens, kind="completion")
+    if trace is not None:
+        trace.set(prompt_tokens=usage.prompt_tokens, cached_tokens=cached_tokens,
+                  completion_tokens=usage.completion_tokens)
+
+def _collect_component_stats():
+    """Снимки stats() компонентов бота (очереди, кэш, лимиты, шлюз LLM) для эндпоинта метрик."""
+    if startup:
+        yield from stats_samples("bot_startup", startup.stats())
+        for stage, seconds in startup.stage_seconds.items():
+            yield "bot_startup_stage_seconds", "gauge", {"stage": stage}, seconds
+    if embedding_batcher:
+        yield from stats_samples("bot_embedding_batcher", embedding_batcher.stats())
+    if answer_cache:
+        yield from stats_samples("bot_answer_cache", answer_cache.stats())
+    if request_queue:
+        yield from stats_samples("bot_request_queue", request_queue.stats())
+    yield from stats_samples("bot_user_rate_limiter", user_rate_limiter.stats())
+    yield from stats_samples("bot_llm_budget", llm_budget.stats())
+    yield from stats_samples("bot_request_coalescer", request_coalescer.stats())
+    yield from stats_samples("bot_conversation_memory", conversation_memory.stats())
+    for stage, stage_stats in retrieval_timings.stats().items():
+        yield from stats_samples("bot_retrieval", stage_stats, {"stage": stage})
+    if llm_gateway:
+        gateway_stats = llm_gateway.stats()
+        yield from stats_samples("bot_llm_gateway", gateway_stats)
+        yield "bot_llm_breaker_open", "gauge", {}, int(gateway_stats["breaker_state"] != "closed")
+        for error, count in llm_gateway.errors.items():
+            yield "bot_llm_gateway_errors_total", "counter", {"error": error}, count
+    current = knowledge_base.current if knowledge_base else None
+    if current is not None:
+        yield "bot_knowledge_base_generation", "gauge", {}, current.generation
+        yield "bot_knowledge_base_vectors", "gauge", {}, current.index.ntotal
+
+def _on_knowledge_base_swap(new_knowledge_base):
+    """Старые ответы могли опираться на устаревшие данные - очищаем кэш."""
+    if answer_cache and new_knowledge_base.generation > 1:
+        answer_cache.clear()
+
+def _prepare_knowledge_base(new_knowledge_base):
+    """Профили программ для /recommend кодируются один раз на поколение, а не на каждый запрос."""
+    started = time.perf_counter()
+    new_knowledge_base.recommender = ProgramRecommender.build(new_knowledge_base.programs_data, model)
+    if new_knowledge_base.recommender is not None:
+        logger.info(
+            f"Профили {len(new_knowledge_base.recommender)} программ для рекомендаций закодированы "
+            f"за {time.perf_counter() - started:.2f} с."
+        )
 
-    logger.info("Загрузка данных программ для рекомендаций...")
-    if os.path.exists(DATA_FILE_PATH):
-         with open(DATA_FILE_PATH, 'r', encoding='utf-8') as f:
-             programs_data = json.load(f)
-         logger.info("Данные программ для рекомендаций загружены.")
-    else:
-         logger.warning("Файл данных программ не найден. Рекомендации будут ограничены.")
+# --- Запуск ---
+async def post_init(application: ApplicationBuilder) -> None:
+    """
+    Быстрая часть запуска: метрики, очереди и клиент LLM. Модель, база знаний и переранжировщик
+    загружаются в фоне (_load_retrieval), бот тем временем уже принимает сообщения.
+    """
+    global startup, startup_task, client, llm_gateway, llm_check_task
+    global embedding_executor, request_queue, metrics_server
+    startup = StartupState(max_waiting=MAX_QUEUED_REQUESTS)
+    embedding_executor = ThreadPoolExecutor(max_workers=EMBEDDING_WORKERS, thread_name_prefix="embedding")
+    request_queue = AdmissionQueue(MAX_CONCURRENT_REQUESTS, MAX_QUEUED_REQUESTS)
+
+    # Эндпоинт метрик поднимается первым - по нему видно и ход загрузки
+    metrics_registry.register_collector(_collect_component_stats)
+    if METRICS_PORT:
+        try:
+            metrics_server = await start_metrics_server(metrics_registry, METRICS_HOST, METRICS_PORT)
+            logger.info(f"Метрики Prometheus: http://{METRICS_HOST}:{METRICS_PORT}/metrics")
+        except OSError as e:
+            logger.error(f"Не удалось запустить эндпоинт метрик: {e}")
 
     # Инициализация клиента OpenAI
     if OPENAI_API_KEY:
-        try:
-            client = OpenAI(api_key=OPENAI_API_KEY)
-            # Проверка подключения - ИСПРАВЛЕНО
-            client.models.list() # Простой запрос для проверки
-            logger.info("Клиент OpenAI API инициализирован и подключен.")
-        except AuthenticationError:
-            logger.error("Неверный API-ключ OpenAI. Проверьте файл .env.")
-            client = None
-        except Exception as e:
-            logger.error(f"Ошибка при инициализации клиента OpenAI: {e}")
-            client = None
+        # Асинхронный клиент с общим пулом keep-alive соединений; повторы выполняет шлюз, а не клиент
+        http_client = httpx.AsyncClient(
+            limits=httpx.Limits(max_connections=LLM_MAX_CONNECTIONS, max_keepalive_connections=LLM_MAX_CONNECTIONS),
+            timeout=httpx.Timeout(LLM_TIMEOUT_SECONDS, connect=10.0),
+        )
+        client = AsyncOpenAI(api_key=OPENAI_API_KEY, base_url=OPENAI_BASE_URL, http_client=http_client, max_retries=0)
+        llm_gateway = LLMGateway(
+            client, LLM_MODEL,
+            deadline_seconds=LLM_DEADLINE_SECONDS,
+            attempt_timeout=LLM_TIMEOUT_SECONDS,
+            max_retries=LLM_MAX_RETRIES,
+            backoff_base=LLM_BACKOFF_BASE,
+            breaker=CircuitBreaker(LLM_BREAKER_FAILURES, LLM_BREAKER_RESET_SECONDS),
+            hedge_percentile=LLM_HEDGE_PERCENTILE,
+        )
+        # Проверка подключения идет в фоне и не задерживает запуск бота
+        llm_check_task = asyncio.create_task(_check_llm_connection(), name="llm-connection-check")
     else:
         logger.warning("OPENAI_API_KEY не найден в .env. Функция генерации ответов будет недоступна.")
         client = None
 
-    logger.info("✅ Бот готов к работе!")
+    startup_task = asyncio.create_task(_load_retrieval(), name="startup")
+    logger.info(f"Бот принимает сообщения ({startup.elapsed():.2f} с после запуска процесса); "
+                f"модель и база знаний загружаются в фоне.")
+
+def _load_model():
+    """Загрузка и прогрев модели (блокирующая функция, импорт sentence_transformers происходит здесь)."""
+    logger.info(f"Загрузка модели SentenceTransformer ({MODEL_NAME}, бэкенд {ENCODER_BACKEND})...")
+    loaded_model = load_encoder(MODEL_NAME, ENCODER_BACKEND, ONNX_FILE_NAME)
+    warm_up_seconds = warm_up(loaded_model)
+    logger.info(f"Модель загружена и прогрета ({warm_up_seconds:.2f} с).")
+    return loaded_model
+
+async def _start_model():
+    """Модель и все, что зависит только от нее: батчер эмбеддингов и кэш ответов."""
+    global model, embedding_batcher, answer_cache
+    model = await asyncio.get_running_loop().run_in_executor(embedding_executor, _load_model)
+    embedding_batcher = EmbeddingBatcher(
+        lambda texts: encode_queries(model, texts),
+        executor=embedding_executor,
+        max_batch_size=EMBEDDING_MAX_BATCH_SIZE,
+        max_wait_ms=EMBEDDING_BATCH_WINDOW_MS,
+    )
+    await embedding_batcher.start()
+
+    if ANSWER_CACHE_SIZE > 0:
+        # Кэш сбрасывается автоматически при пересборке файлов базы знаний
+        answer_cache = SemanticAnswerCache(
+            model.get_sentence_embedding_dimension(),
+            max_entries=ANSWER_CACHE_SIZE,
+            ttl_seconds=ANSWER_CACHE_TTL_SECONDS,
+            similarity_threshold=ANSWER_CACHE_SIMILARITY,
+            artifact_paths=(FAISS_INDEX_PATH, INDEX_META_PATH, KB_CURRENT_PATH),
+        )
 
-def main():
-    """Главная функция для запуска бота."""
-    if not TELEGRAM_BOT_TOKEN:
-        logger.error("❌ TELEGRAM_BOT_TOKEN не найден. Пожалуйста, создайте файл .env и укажите токен.")
+async def _start_reranker():
+    """Переранжировщик необязателен: ошибка его загрузки не мешает запуску."""
+    global reranker
+    try:
+        logger.info(f"Загрузка переранжировщика ({RERANKER_MODEL})...")
+        reranker = await asyncio.get_running_loop().run_in_executor(None, load_reranker, RERANKER_MODEL)
+    except Exception as e:
+        logger.error(f"Не удалось загрузить переранжировщик, он будет отключен: {e}")
+        reranker = None
+
+async def _load_retrieval():
+    """
+    Фоновая загрузка поиска. Модель, файлы базы знаний и переранжировщик грузятся параллельно;
+    проверка совместимости индекса с моделью и профили программ ждут модель.
+    """
+    global knowledge_base
+    knowledge_base = KnowledgeBaseManager(
+        on_swap=_on_knowledge_base_swap,
+        # Индекс, построенный другой моделью, не подменяет текущий
+        validator=lambda kb: check_index_compatibility(model, MODEL_NAME, kb.index_meta),
+        preparer=_prepare_knowledge_base,
+    )
+    model_ready = asyncio.ensure_future(startup.run_stage("model", _start_model()))
+    stages = [
+        model_ready,
+        # Файлы читаются сразу, проверка размерности и совместимости - после загрузки модели
+        startup.run_stage("knowledge_base", knowledge_base.reload(wait_for=model_ready)),
+    ]
+    if RERANKER_MODEL:
+        stages.append(startup.run_stage("reranker", _start_reranker()))
+    logger.info("Загрузка модели, FAISS индекса, чанков и данных программ...")
+    results = await asyncio.gather(*stages, return_exceptions=True)
+    errors = [result for result in results if isinstance(result, Exception)]
+    if errors:
+        # Ошибка загрузки модели приходит и из этапа базы знаний - сообщаем о ней один раз
+        startup.mark_failed("; ".join(dict.fromkeys(str(error) or type(error).__name__ for error in errors)))
         return
 
-    app = ApplicationBuilder().token(TELEGRAM_BOT_TOKEN).post_init(post_init).build()
+    knowledge_base.expected_dimension = model.get_sentence_embedding_dimension()
+    # Новые версии файлов в models/ подхватываются в фоне
+    knowledge_base.start_watching(KB_WATCH_INTERVAL)
+    startup.mark_ready()
+    logger.info("✅ Бот готов к работе!")
+
+async def _check_llm_connection():
+    """Пробный запрос к API; результат только логируется - запросы идут через шлюз в любом случае."""
+    try:
+        await asyncio.wait_for(client.models.list(), timeout=LLM_TIMEOUT_SECONDS)
+        logger.info("Клиент OpenAI API инициализирован и подключен.")
+    except AuthenticationError:
+        logger.error("Неверный API-ключ OpenAI. Проверьте файл .env.")
+    except Exception as e:
+        logger.error(f"Не удалось проверить подключение к OpenAI API: {e}")
+
+async def post_shutdown(application: ApplicationBuilder) -> None:
+    """Освобождает пул потоков и HTTP-соединения при остановке бота."""
+    if startup_task and not startup_task.done():
+        startup_task.cancel()
+        try:
+            await startup_task
+        except asyncio.CancelledError:
+            pass
+    if startup:
+        logger.info(f"Запуск: {startup.stats()}, этапы {startup.stage_seconds}")
+    if knowledge_base:
+        await knowledge_base.stop_watching()
+    if embedding_batcher:
+        logger.info(f"Статистика батчинга эмбеддингов: {embedding_batcher.stats()}")
+        await embedding_batcher.stop()
+    if answer_cache:
+        logger.info(f"Статистика кэша ответов: {answer_cache.stats()}")
+    logger.info(f"Задержки этапов поиска: {retrieval_timings.stats()}")
+    logger.info(
+        f"Ограничение нагрузки: пользователи {user_rate_limiter.stats()}, бюджет LLM {llm_budget.stats()}, "
+        f"очередь {request_queue.stats() if request_queue else None}, склейка {request_coalescer.stats()}"
+    )
+    logger.info(f"Память диалогов: {conversation_memory.stats()}")
+    if llm_check_task and not llm_check_task.done():
+        llm_check_task.cancel()
+    if llm_gateway:
+        logger.info(f"Статистика вызовов LLM: {llm_gateway.stats()}")
+    if client:
+        await client.close()
+    if metrics_server:
+        metrics_server.close()
+        await metrics_server.wait_closed()
+    if embedding_executor:
+        embedding_executor.shutdown(wait=False)
+
+def build_application(with_updater=True):
+    """Приложение с обработчиками; без updater обновления кладутся в очередь извне (режим webhook)."""
+    # concurrent_updates позволяет обрабатывать сообщения разных пользователей параллельно
+    builder = (
+        ApplicationBuilder()
+        .token(TELEGRAM_BOT_TOKEN)
+        .concurrent_updates(True)
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+    )
+    if TELEGRAM_API_URL:
+        builder = builder.base_url(TELEGRAM_API_URL)
+    if PERSISTENCE_PATH:
+        # Состояние диалога /recommend и user_data переживают перезапуск и доступны любому воркеру
+        builder = builder.persistence(SQLitePersistence(PERSISTENCE_PATH, update_interval=PERSISTENCE_UPDATE_INTERVAL))
+    if not with_updater:
+        builder = builder.updater(None)
+    app = builder.build()
 
     # --- Обработчики ---
     app.add_handler(CommandHandler("start", start))
+    app.add_handler(CommandHandler("reload", reload_knowledge_base))
     
     conv_handler = ConversationHandler(
         entry_points=[CommandHandler('recommend', recommend_start)],
@@ -299,14 +910,111 @@ def main():
             CAREER: [MessageHandler(filters.TEXT & ~filters.COMMAND, recommend_career)],
         },
         fallbacks=[CommandHandler('cancel', recommend_cancel)],
+        name="recommend",
+        persistent=bool(PERSISTENCE_PATH),
     )
     app.add_handler(conv_handler)
 
     app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_message))
+    return app
+
+async def _serve_worker(host, port):
+    """Воркер: то же приложение, но обновления приходят от диспетчера, а не из getUpdates."""
+    app = build_application(with_updater=False)
+    # Без updater приложение не вызывает post_init/post_shutdown само
+    await app.initialize()
+    await post_init(app)
+    await app.start()
+    listener = await start_update_listener(app, host, port, WEBHOOK_SECRET_TOKEN or None)
+    logger.info(f"🚀 Воркер принимает обновления на http://{host}:{port}")
+
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop_event.set)
+    try:
+        await stop_event.wait()
+    finally:
+        listener.close()
+        await listener.wait_closed()
+        await app.stop()
+        await app.shutdown()
+        await post_shutdown(app)
+
+def run_worker(host, port, metrics_port):
+    """Точка входа процесса-воркера."""
+    global METRICS_PORT
+    # У каждого воркера на хосте свой порт метрик
+    METRICS_PORT = metrics_port
+    asyncio.run(_serve_worker(host, port))
+
+def _raise_keyboard_interrupt(signum, frame):
+    raise KeyboardInterrupt()
+
+def run_webhook():
+    """Диспетчер webhook: принимает обновления Telegram и распределяет их по воркерам по chat id."""
+    processes = []
+    worker_urls = WEBHOOK_WORKER_URLS
+    remote_urls = remote_worker_urls(worker_urls)
+    if remote_urls and PERSISTENCE_PATH:
+        # Файл SQLite виден только воркерам этого хоста: при перераспределении чатов диалоги бы терялись
+        logger.error(f"❌ Воркеры на других хостах ({', '.join(remote_urls)}) не разделяют SQLite persistence "
+                     f"({PERSISTENCE_PATH}). Задайте пустой PERSISTENCE_PATH или общий бэкенд persistence.")
+        return
+    if not worker_urls:
+        # Локальные воркеры - отдельные процессы; базу знаний они открывают через memory-map
+        spawn = multiprocessing.get_context("spawn")
+        for i in range(WEBHOOK_WORKERS):
+            process = spawn.Process(
+                target=run_worker, name=f"bot-worker-{i}",
+                args=(WORKER_HOST, WORKER_PORT + i, METRICS_PORT + i if METRICS_PORT else 0),
+            )
+            process.start()
+            processes.append(process)
+        worker_urls = [f"http://{WORKER_HOST}:{WORKER_PORT + i}" for i in range(WEBHOOK_WORKERS)]
+
+    signal.signal(signal.SIGTERM, _raise_keyboard_interrupt)
+    dispatcher = create_dispatcher(WEBHOOK_LISTEN, WEBHOOK_PORT, worker_urls, WEBHOOK_PATH, WEBHOOK_SECRET_TOKEN or None)
+    try:
+        not_ready = wait_for_workers(worker_urls)
+        if not_ready:
+            logger.error(f"Воркеры не ответили: {', '.join(not_ready)}; обновления для них Telegram доставит повторно.")
+        if WEBHOOK_URL:
+            asyncio.run(_set_webhook())
+        logger.info(f"🚀 Диспетчер webhook слушает {WEBHOOK_LISTEN}:{WEBHOOK_PORT}{WEBHOOK_PATH}, воркеров: {len(worker_urls)}")
+        dispatcher.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        dispatcher.server_close()
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.join()
+
+async def _set_webhook():
+    bot = Bot(TELEGRAM_BOT_TOKEN, base_url=TELEGRAM_API_URL) if TELEGRAM_API_URL else Bot(TELEGRAM_BOT_TOKEN)
+    async with bot:
+        await bot.set_webhook(url=WEBHOOK_URL, secret_token=WEBHOOK_SECRET_TOKEN or None,
+                              allowed_updates=Update.ALL_TYPES)
+    logger.info(f"Webhook зарегистрирован: {WEBHOOK_URL}")
+
+def main():
+    """Главная функция для запуска бота."""
+    if not TELEGRAM_BOT_TOKEN:
+        logger.error("❌ TELEGRAM_BOT_TOKEN не найден. Пожалуйста, создайте файл .env и укажите токен.")
+        return
+
+    if BOT_MODE == "webhook":
+        run_webhook()
+        return
+    if BOT_MODE == "worker":
+        run_worker(WORKER_HOST, WORKER_PORT, METRICS_PORT)
+        return
 
+    app = build_application()
     logger.info("🚀 Бот запущен. Ожидание сообщений...")
     app.run_polling()
 
 if __name__ == '__main__':
     main()
-    
\ No newline at end of file
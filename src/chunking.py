@@ -0,0 +1,211 @@
+# src/chunking.py
+"""
+Разбиение данных программ на фрагменты (chunks) для индексации.
+Текст делится по предложениям и собирается в окна по числу токенов с перекрытием,
+списки и наборы компаний - в окна из целых элементов. Идентификатор фрагмента зависит
+только от страницы, раздела и текста, поэтому не меняется между запусками.
+Большие корпуса разбиваются в пуле процессов, фрагменты выдаются потоково.
+"""
+import functools
+import hashlib
+import multiprocessing
+import os
+import re
+
+from context_builder import count_tokens
+
+# Размер окна и перекрытие соседних окон в токенах
+CHUNK_MAX_TOKENS = int(os.getenv('CHUNK_MAX_TOKENS', '256'))
+CHUNK_OVERLAP_TOKENS = int(os.getenv('CHUNK_OVERLAP_TOKENS', '48'))
+# Окна считаются токенизатором OpenAI (или по длине текста), а не токенизатором e5 (XLM-R),
+# который режет вход на 512 токенах. На русском тексте e5 дает до ~1.5 раза больше токенов,
+# еще несколько уходит на префикс 'passage: ' и служебные токены - окно проверяется с этим запасом
+ENCODER_MAX_TOKENS = 512
+ENCODER_TOKEN_RATIO = 1.5
+ENCODER_RESERVED_TOKENS = 16
+# Процессы для разбиения (по умолчанию - число ядер); пул запускается только для корпусов от CHUNK_PARALLEL_MIN_DOCUMENTS страниц
+CHUNK_WORKERS = int(os.getenv('CHUNK_WORKERS') or os.cpu_count() or 1)
+CHUNK_PARALLEL_MIN_DOCUMENTS = int(os.getenv('CHUNK_PARALLEL_MIN_DOCUMENTS', '64'))
+
+# Поля страницы, которые не индексируются
+METADATA_FIELDS = ('name', 'url')
+# Более короткие тексты (подписи, "Подробнее") не индексируются
+MIN_TEXT_CHARS = 20
+# Стратегия по полю; для остальных полей выбирается по типу значения
+FIELD_STRATEGIES = {
+    'companies': 'set',
+    'directions': 'list',
+}
+# Подпись, с которой начинается каждый фрагмент списка
+FIELD_LABELS = {
+    'companies': 'Компании-партнеры',
+    'directions': 'Направления подготовки',
+}
+
+# Граница предложения: знак конца, пробел и заглавная буква, цифра или открывающая кавычка
+_SENTENCE_BOUNDARY = re.compile(r'(?<=[.!?…])\s+(?=[«"(]?[A-ZА-ЯЁ0-9])')
+# Сокращения, после которых точка не заканчивает предложение
+_ABBREVIATIONS = frozenset((
+    'т.е.', 'т.д.', 'т.п.', 'т.к.', 'т.ч.', 'др.', 'пр.', 'г.', 'гг.', 'им.', 'проф.', 'доц.', 'акад.',
+    'ул.', 'стр.', 'тыс.', 'млн.', 'млрд.', 'руб.', 'e.g.', 'i.e.', 'etc.', 'vs.',
+))
+_INITIAL = re.compile(r'^[A-ZА-ЯЁ]\.$')
+_LIST_SEPARATORS = re.compile(r'[,;\n]')
+
+
+def content_hash(text):
+    """Хэш текста чанка: по нему переиспользуется ранее вычисленный эмбеддинг."""
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+
+def chunk_id(url, field, text_hash):
+    """Стабильный 63-битный идентификатор фрагмента (страница, раздел и текст)."""
+    key = f"{url}\n{field}\n{text_hash}"
+    return int.from_bytes(hashlib.sha1(key.encode('utf-8')).digest()[:8], 'big') & (2 ** 63 - 1)
+
+
+def split_sentences(text):
+    """Делит текст на предложения, не разрывая его на сокращениях и инициалах."""
+    sentences = []
+    for paragraph in text.splitlines():
+        pending = ""
+        for piece in _SENTENCE_BOUNDARY.split(paragraph.strip()):
+            pending = f"{pending} {piece}".strip()
+            last_word = pending.rsplit(' ', 1)[-1]
+            if last_word.lower() in _ABBREVIATIONS or _INITIAL.match(last_word):
+                continue
+            sentences.append(pending)
+            pending = ""
+        if pending:
+            sentences.append(pending)
+    return [sentence for sentence in sentences if sentence]
+
+
+def _token_units(texts, max_tokens, overlap_tokens=0):
+    """(текст, токены) для каждого элемента; элемент длиннее окна делится по словам с перекрытием."""
+    for text in texts:
+        tokens = count_tokens(text)
+        if tokens <= max_tokens:
+            yield text, tokens
+            continue
+        words = [(word, count_tokens(word)) for word in text.split()]
+        for window, window_tokens in _pack(words, max_tokens, overlap_tokens):
+            yield ' '.join(window), window_tokens
+
+
+def _pack(units, max_tokens, overlap_tokens):
+    """
+    Собирает элементы (текст, токены) в окна не больше max_tokens. Следующее окно
+    начинается с последних элементов предыдущего общей длиной не больше overlap_tokens.
+    Выдает (элементы окна, токены окна).
+    """
+    window, window_tokens = [], 0
+    for unit in units:
+        if window and window_tokens + unit[1] > max_tokens:
+            yield [text for text, _ in window], window_tokens
+            carry, carry_tokens = [], 0
+            # Перекрытие берется целыми элементами и не равно всему окну
+            for previous in reversed(window[1:]):
+                if carry_tokens + previous[1] > overlap_tokens or carry_tokens + previous[1] + unit[1] > max_tokens:
+                    break
+                carry.insert(0, previous)
+                carry_tokens += previous[1]
+            window, window_tokens = carry, carry_tokens
+        window.append(unit)
+        window_tokens += unit[1]
+    if window:
+        yield [text for text, _ in window], window_tokens
+
+
+def _list_item_text(item):
+    if isinstance(item, dict):
+        return f"{item.get('code', '')} {item.get('name', '')}".strip()
+    return str(item).strip()
+
+
+def _text_chunks(content, max_tokens, overlap_tokens):
+    if len(content.strip()) < MIN_TEXT_CHARS:
+        return
+    units = _token_units(split_sentences(content), max_tokens, overlap_tokens)
+    for sentences, _ in _pack(units, max_tokens, overlap_tokens):
+        yield ' '.join(sentences)
+
+
+def _list_chunks(field, items, max_tokens):
+    """Элементы списка целиком, без перекрытия: каждый элемент самостоятелен."""
+    label = f"{FIELD_LABELS.get(field, field)}: "
+    units = _token_units(items, max_tokens - count_tokens(label))
+    for window, _ in _pack(units, max_tokens - count_tokens(label), 0):
+        yield label + ", ".join(window)
+
+
+def _set_items(content):
+    """Набор без повторов и в алфавитном порядке: перестановка логотипов на странице не меняет фрагменты."""
+    items = _LIST_SEPARATORS.split(content) if isinstance(content, str) else [_list_item_text(i) for i in content]
+    unique = {}
+    for item in filter(None, (item.strip() for item in items)):
+        unique.setdefault(item.casefold(), item)
+    return [unique[key] for key in sorted(unique)]
+
+
+def field_chunks(field, content, max_tokens=CHUNK_MAX_TOKENS, overlap_tokens=CHUNK_OVERLAP_TOKENS):
+    """Тексты фрагментов одного поля по стратегии поля (text, list или set)."""
+    strategy = FIELD_STRATEGIES.get(field)
+    if strategy == 'set':
+        return _list_chunks(field, _set_items(content), max_tokens)
+    if isinstance(content, str):
+        return _text_chunks(content, max_tokens, overlap_tokens)
+    if isinstance(content, list):
+        items = [text for text in map(_list_item_text, content) if text]
+        return _list_chunks(field, items, max_tokens)
+    if isinstance(content, dict):
+        text = ". ".join(f"{key}: {value}" for key, value in content.items() if value)
+        return _text_chunks(text, max_tokens, overlap_tokens)
+    return ()
+
+
+def chunk_program(program, max_tokens=CHUNK_MAX_TOKENS, overlap_tokens=CHUNK_OVERLAP_TOKENS):
+    """Фрагменты одной программы с хэшем и стабильным идентификатором."""
+    chunks = []
+    for field, content in program.items():
+        if field in METADATA_FIELDS or not content:
+            continue
+        for text in field_chunks(field, content, max_tokens, overlap_tokens):
+            text_hash = content_hash(text)
+            chunks.append({
+                "text": text,
+                "source": program['name'],
+                "field": field,
+                "url": program['url'],
+                "hash": text_hash,
+                "id": chunk_id(program['url'], field, text_hash),
+            })
+    return chunks
+
+
+def chunk_workers(num_documents):
+    """Число процессов для корпуса: на маленьком корпусе запуск пула дороже самого разбиения."""
+    return CHUNK_WORKERS if num_documents >= CHUNK_PARALLEL_MIN_DOCUMENTS else 1
+
+
+def iter_chunks(programs, max_tokens=CHUNK_MAX_TOKENS, overlap_tokens=CHUNK_OVERLAP_TOKENS, workers=1,
+                batch_size=8):
+    """
+    Потоково выдает фрагменты программ (programs - любой итерируемый объект, например генератор
+    страниц краулера) в порядке входа. При workers > 1 страницы разбиваются в пуле процессов,
+    и следующий этап может обрабатывать фрагменты, пока разбиваются остальные страницы.
+    """
+    if max_tokens <= overlap_tokens:
+        raise ValueError(f"Перекрытие ({overlap_tokens}) должно быть меньше окна ({max_tokens} токенов)")
+    if max_tokens * ENCODER_TOKEN_RATIO + ENCODER_RESERVED_TOKENS > ENCODER_MAX_TOKENS:
+        limit = int((ENCODER_MAX_TOKENS - ENCODER_RESERVED_TOKENS) / ENCODER_TOKEN_RATIO)
+        raise ValueError(f"Окно {max_tokens} токенов может не поместиться в {ENCODER_MAX_TOKENS} токенов e5 "
+                         f"и будет обрезано моделью, допустимо не больше {limit}")
+    chunk_one = functools.partial(chunk_program, max_tokens=max_tokens, overlap_tokens=overlap_tokens)
+    if workers <= 1:
+        for program in programs:
+            yield from chunk_one(program)
+        return
+    with multiprocessing.Pool(workers) as pool:
+        for chunks in pool.imap(chunk_one, programs, chunksize=batch_size):
+            yield from chunks
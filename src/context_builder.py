@@ -0,0 +1,129 @@
+# src/context_builder.py
+"""
+Сборка контекста для LLM в пределах бюджета токенов: подсчет токенов,
+удаление дублирующихся и перекрывающихся фрагментов, упаковка самых релевантных.
+"""
+import functools
+import logging
+import math
+import re
+
+logger = logging.getLogger(__name__)
+
+try:
+    # Необязательная зависимость: точный подсчет токенов токенизатором модели OpenAI
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+# Без tiktoken: русский текст в токенизаторах OpenAI - примерно 3 символа на токен (оценка с запасом)
+CHARS_PER_TOKEN = 3
+# Доля общих словесных триграмм, начиная с которой меньший фрагмент считается перекрытым большим
+OVERLAP_THRESHOLD = 0.8
+_WORD_PATTERN = re.compile(r'\w+')
+
+
+@functools.lru_cache(maxsize=None)
+def _encoding(model_name):
+    if tiktoken is None:
+        # Бюджеты контекста и max_tokens становятся приближенными - сообщаем один раз (lru_cache)
+        logger.warning("tiktoken не установлен, токены считаются по длине текста (pip install tiktoken).")
+        return None
+    try:
+        return tiktoken.encoding_for_model(model_name)
+    except KeyError:
+        return tiktoken.get_encoding('o200k_base')
+    except Exception as e:
+        # Файлы словаря скачиваются при первом использовании - без сети считаем приближенно
+        logger.warning(f"Токенизатор tiktoken недоступен, используется оценка по длине текста: {e}")
+        return None
+
+
+def count_tokens(text, model_name='gpt-4o-mini'):
+    encoding = _encoding(model_name)
+    if encoding is not None:
+        return len(encoding.encode(text))
+    return math.ceil(len(text) / CHARS_PER_TOKEN)
+
+
+def truncate_to_tokens(text, max_tokens, model_name='gpt-4o-mini'):
+    """Обрезает текст до max_tokens токенов (по границе слова, если считаем приближенно)."""
+    if max_tokens <= 0:
+        return ""
+    encoding = _encoding(model_name)
+    if encoding is not None:
+        tokens = encoding.encode(text)
+        return text if len(tokens) <= max_tokens else encoding.decode(tokens[:max_tokens])
+    limit = max_tokens * CHARS_PER_TOKEN
+    if len(text) <= limit:
+        return text
+    cut = text.rfind(' ', 0, limit)
+    return text[:cut if cut > 0 else limit]
+
+
+def _shingles(text):
+    words = _WORD_PATTERN.findall(text.lower())
+    if len(words) < 3:
+        return {tuple(words)}
+    return {tuple(words[i:i + 3]) for i in range(len(words) - 2)}
+
+
+def dedupe_chunks(chunks, overlap_threshold=OVERLAP_THRESHOLD):
+    """
+    Убирает повторы из списка чанков (в порядке релевантности).
+    Одинаковый текст разных программ сливается в один фрагмент с перечислением источников;
+    фрагмент, почти целиком содержащийся в более релевантном, отбрасывается.
+    """
+    kept = []
+    for chunk in chunks:
+        shingles = _shingles(chunk['text'])
+        duplicate_of = None
+        for kept_chunk, kept_shingles in kept:
+            if chunk['text'] == kept_chunk['text']:
+                duplicate_of = kept_chunk
+                break
+            common = len(shingles & kept_shingles)
+            if common and common / min(len(shingles), len(kept_shingles)) >= overlap_threshold:
+                duplicate_of = kept_chunk
+                break
+        if duplicate_of is None:
+            kept.append((dict(chunk), shingles))
+        elif chunk['text'] == duplicate_of['text'] and chunk['source'] not in duplicate_of['source'].split('; '):
+            duplicate_of['source'] = f"{duplicate_of['source']}; {chunk['source']}"
+    return [chunk for chunk, _ in kept]
+
+
+def format_chunk(chunk):
+    return f"Источник: {chunk['source']}\nРаздел: {chunk['field']}\nИнформация: {chunk['text']}"
+
+
+def pack_context(chunks, token_budget, model_name='gpt-4o-mini'):
+    """
+    Жадно упаковывает фрагменты (в порядке релевантности) в бюджет токенов.
+    Не поместившийся фрагмент пропускается, но следующие, более короткие, еще пробуются;
+    самый релевантный фрагмент при необходимости обрезается, чтобы контекст не был пустым.
+    Возвращает (список отформатированных фрагментов, число токенов).
+    """
+    parts = []
+    used_tokens = 0
+    for chunk in chunks:
+        part = format_chunk(chunk)
+        tokens = count_tokens(part, model_name)
+        if used_tokens + tokens <= token_budget:
+            parts.append(part)
+            used_tokens += tokens
+        elif not parts:
+            part = truncate_to_tokens(part, token_budget, model_name)
+            parts.append(part)
+            used_tokens += count_tokens(part, model_name)
+    return parts, used_tokens
+
+
+def choose_max_tokens(context_tokens, has_context, min_tokens, max_tokens, no_context_tokens):
+    """
+    Лимит длины ответа: без контекста бот лишь вежливо отказывает, а с контекстом
+    ответ редко длиннее половины найденного текста.
+    """
+    if not has_context:
+        return no_context_tokens
+    return max(min_tokens, min(max_tokens, context_tokens // 2))
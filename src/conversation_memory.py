@@ -0,0 +1,261 @@
+# src/conversation_memory.py
+"""
+Короткая память диалога для каждого пользователя. Последние вопросы и ответы хранятся в кольцевом
+буфере и обрезаются по токенам, вытесненные из буфера вопросы сворачиваются в краткую сводку
+ограниченной длины. Поэтому размер сессии фиксирован, и в памяти помещаются десятки тысяч чатов.
+Неактивные сессии вытесняются. Уточняющие вопросы ("а на второй программе?") переписываются
+в самостоятельный поисковый запрос по предыдущему вопросу и программе, о которой шла речь.
+"""
+import functools
+import re
+import time
+from collections import OrderedDict, deque
+
+from context_builder import count_tokens, truncate_to_tokens
+
+SUMMARY_PREFIX = "Ранее в диалоге абитуриент спрашивал: "
+SUMMARY_SEPARATOR = "; "
+
+# Уточняющий вопрос начинается с союза или ссылается на уже упомянутое
+_FOLLOW_UP_START = re.compile(r'^(а|и|но|ну а|тогда|еще|ещё|также|а если|а что|а как|а где|а сколько)\b', re.IGNORECASE)
+_ANAPHORA = re.compile(
+    r'\b(она|он|оно|они|ее|её|ей|ней|нее|неё|ним|них|их|эт(а|о|от|и|ой|ом|у|ого|их)|'
+    r'там|тут|туда|такая|такой|тоже|туда же|перв\w*|втор\w*|друг(ой|ая|ую|ом|ие|их)|обе|обеих|обоих)\b',
+    re.IGNORECASE,
+)
+_WORD = re.compile(r'\w+')
+# Ссылка на программу без названия ("на второй программе", "этой программы") - не часть темы вопроса
+_PROGRAM_REFERENCE = re.compile(
+    r'\b(?:(?:на|в|о|об|про|по|для|у)\s+)?(?:(?:перв|втор|друг|эт)\w*\s+)?(?:программ|магистратур)\w*'
+    r'|\b(?:на|в|о|об|про|по|для|у)\s+(?:перв|втор|друг)\w*(?!\w)',
+    re.IGNORECASE,
+)
+# Вопрос из стольких слов и короче без упоминания программы относится к программе, о которой шла речь
+SHORT_QUESTION_WORDS = 5
+# Служебные слова и ссылки на программу: уточнение только из них ("а на второй?") наследует тему прошлого вопроса
+_REFERENCE_WORDS = frozenset((
+    'а', 'и', 'но', 'ну', 'тогда', 'еще', 'ещё', 'также', 'тоже', 'если', 'что', 'как', 'там', 'тут', 'на', 'в', 'во',
+    'по', 'про', 'о', 'об', 'у', 'с', 'для', 'этой', 'этом', 'эта', 'это', 'этот', 'она', 'ней', 'нее', 'неё',
+    'них', 'их', 'обе', 'обеих', 'обоих', 'другой', 'другая', 'другую', 'другом', 'первой', 'первая', 'первую',
+    'первом', 'второй', 'вторая', 'вторую', 'втором', 'программа', 'программе', 'программу', 'программы',
+    'программах', 'магистратура', 'магистратуре', 'насчет', 'насчёт', 'такой', 'такая', 'же',
+))
+
+
+@functools.lru_cache(maxsize=16)
+def program_aliases(program_names):
+    """
+    Способы упомянуть программу: название, его части через "/" и аббревиатура ("ИИ").
+    program_names - кортеж (кэшируется на набор программ). Возвращает [(название, шаблон)]
+    от длинных вариантов к коротким.
+    """
+    aliases = []
+    for name in program_names:
+        variants = {name, *(part.strip() for part in name.split('/') if part.strip())}
+        initials = ''.join(word[0] for word in _WORD.findall(name) if len(word) > 2).upper()
+        # Аббревиатура только из букв одного алфавита: "ИИ", но не "УПP" из "... / AI Product"
+        if len(initials) >= 2 and (re.fullmatch(r'[А-ЯЁ]+', initials) or re.fullmatch(r'[A-Z]+', initials)):
+            variants.add(initials)
+        aliases.extend((name, variant) for variant in variants if len(variant) >= 2)
+    aliases.sort(key=lambda alias: len(alias[1]), reverse=True)
+    return [(name, re.compile(r'(?<!\w)' + re.escape(variant) + r'(?!\w)', re.IGNORECASE)) for name, variant in aliases]
+
+
+def _find_programs(text, program_names):
+    """(упомянутые программы, текст без упоминаний). Длинные названия вырезаются первыми,
+    чтобы "ИИ" из "Управление ИИ-продуктами" не считалось упоминанием "Искусственного интеллекта"."""
+    found = set()
+    for name, pattern in program_aliases(tuple(program_names)):
+        text, count = pattern.subn(' ', text)
+        if count:
+            found.add(name)
+    return [name for name in program_names if name in found], text
+
+
+def mentioned_programs(text, program_names):
+    """Названия программ, упомянутых в тексте, в порядке списка программ."""
+    return _find_programs(text, program_names)[0]
+
+
+def _topic(text, program_names):
+    """Тема вопроса без упоминаний программ, вводного союза и завершающих знаков: "Какие стипендии есть"."""
+    text = _PROGRAM_REFERENCE.sub(' ', _find_programs(text, program_names)[1])
+    text = _FOLLOW_UP_START.sub('', text.strip())
+    return ' '.join(text.split()).rstrip(' ?!.,')
+
+
+def _inherits_topic(question, program_names):
+    """Уточнение без своей темы: после вырезания программ остались только служебные слова."""
+    words = _WORD.findall(_find_programs(question, program_names)[1].lower())
+    return all(word in _REFERENCE_WORDS for word in words)
+
+
+class ConversationSession:
+    """Сессия одного пользователя; __slots__ - без словаря атрибутов на каждую из десятков тысяч сессий."""
+    __slots__ = ('turns', 'summary', 'focus', 'topic', 'last_active')
+
+    def __init__(self, max_turns):
+        self.turns = deque(maxlen=max_turns)  # (вопрос, ответ), обрезанные по токенам
+        self.summary = ""  # свернутые вопросы, вытесненные из буфера
+        self.focus = None  # программа, о которой шла речь
+        self.topic = None  # тема последнего самостоятельного вопроса
+        self.last_active = time.monotonic()
+
+
+class ConversationMemory:
+    """
+    Сессии по id пользователя в порядке последней активности (OrderedDict): вытеснение
+    неактивных и сверх max_sessions - с начала, за O(1) на сессию.
+    """
+
+    def __init__(self, max_turns=3, question_tokens=60, answer_tokens=120, summary_tokens=100,
+                 idle_seconds=1800.0, max_sessions=20000, model_name='gpt-4o-mini'):
+        self.max_turns = max_turns
+        self.question_tokens = question_tokens
+        self.answer_tokens = answer_tokens
+        self.summary_tokens = summary_tokens
+        self.idle_seconds = idle_seconds
+        self.max_sessions = max_sessions
+        self.model_name = model_name
+        self._sessions = OrderedDict()
+
+        # Счетчики
+        self.rewritten = 0
+        self.idle_evictions = 0
+        self.lru_evictions = 0
+
+    def _evict(self, now):
+        while self._sessions:
+            user_id, session = next(iter(self._sessions.items()))
+            if now - session.last_active > self.idle_seconds:
+                self.idle_evictions += 1
+            elif len(self._sessions) > self.max_sessions:
+                self.lru_evictions += 1
+            else:
+                break
+            del self._sessions[user_id]
+
+    def _session(self, user_id, create=False):
+        now = time.monotonic()
+        self._evict(now)
+        session = self._sessions.get(user_id)
+        if session is None and create:
+            session = self._sessions[user_id] = ConversationSession(self.max_turns)
+        if session is not None:
+            session.last_active = now
+            self._sessions.move_to_end(user_id)
+        return session
+
+    def clear(self, user_id):
+        self._sessions.pop(user_id, None)
+
+    def set_focus(self, user_id, program_name):
+        """Программа, о которой дальше пойдет речь (например, рекомендованная /recommend)."""
+        if self.max_turns > 0:
+            self._session(user_id, create=True).focus = program_name
+
+    def rewrite_query(self, user_id, question, program_names, fallback_focus=None):
+        """
+        Самостоятельный поисковый запрос для вопроса. Уточняющий вопрос ("а на второй?",
+        "что там со стипендиями?") дополняется программой, на которую он ссылается: первой,
+        второй, другой, обеими или той, о которой шла речь (без истории - fallback_focus,
+        например рекомендованной программой); короткое уточнение - еще и темой прошлого вопроса.
+        Короткий вопрос без упоминания программы тоже относится к программе, о которой шла речь.
+        """
+        session = self._session(user_id)
+        focus = (session.focus if session else None) or fallback_focus
+        program_names = list(program_names or ())
+        mentioned = mentioned_programs(question, program_names)
+        explicit = bool(_FOLLOW_UP_START.match(question.strip()) or _ANAPHORA.search(question))
+        short = len(_WORD.findall(question)) <= SHORT_QUESTION_WORDS
+        if not explicit and not (short and focus and not mentioned):
+            return question
+
+        referenced = mentioned
+        if not referenced and program_names:
+            lowered = question.lower()
+            if re.search(r'\b(обе|обеих|обоих)\b', lowered):
+                referenced = program_names
+            elif re.search(r'\bперв\w*', lowered):
+                referenced = program_names[:1]
+            elif re.search(r'\bвтор\w*', lowered) and len(program_names) > 1:
+                referenced = program_names[1:2]
+            elif re.search(r'\bдруг(ой|ая|ую|ом)\b', lowered):
+                referenced = [name for name in program_names if name != focus][:1]
+            elif focus:
+                referenced = [focus]
+
+        parts = []
+        if explicit and session is not None and session.topic and _inherits_topic(question, program_names):
+            # Короткое уточнение наследует тему: "а на второй?" после вопроса о стипендиях
+            parts.append(session.topic)
+        parts.append(question)
+        missing = [name for name in referenced if name not in mentioned]
+        if missing:
+            parts.append(", ".join(missing))
+        query = " ".join(parts)
+        if query != question:
+            self.rewritten += 1
+        return query
+
+    def add_turn(self, user_id, question, answer, query=None, program_names=()):
+        """Запоминает ответ; вопрос, вытесненный из буфера, сворачивается в сводку."""
+        if self.max_turns <= 0:
+            return
+        session = self._session(user_id, create=True)
+        if len(session.turns) == session.turns.maxlen:
+            self._fold_into_summary(session, session.turns[0][0])
+        session.turns.append((
+            truncate_to_tokens(question, self.question_tokens, self.model_name),
+            truncate_to_tokens(answer or "", self.answer_tokens, self.model_name),
+        ))
+        # Тема уточнения без своей темы - тема прошлого вопроса; переписанный запрос не накапливается
+        if not (session.topic and _inherits_topic(question, program_names)):
+            session.topic = truncate_to_tokens(_topic(question, program_names), self.question_tokens, self.model_name)
+        # Фокус - программа из поискового запроса (в нем уже разрешены ссылки "вторая", "эта")
+        mentioned = mentioned_programs(query or question, program_names) if program_names else []
+        if len(mentioned) == 1:
+            session.focus = mentioned[0]
+
+    def _fold_into_summary(self, session, question):
+        parts = [part for part in session.summary[len(SUMMARY_PREFIX):].split(SUMMARY_SEPARATOR) if part]
+        parts.append(question)
+        # Сводка ограничена: самые старые вопросы отбрасываются
+        while parts and count_tokens(SUMMARY_PREFIX + SUMMARY_SEPARATOR.join(parts), self.model_name) > self.summary_tokens:
+            parts.pop(0)
+        session.summary = SUMMARY_PREFIX + SUMMARY_SEPARATOR.join(parts) if parts else ""
+
+    def history_messages(self, user_id, token_budget):
+        """
+        Сообщения истории для LLM в пределах token_budget: сводка и последние ходы
+        (более свежие важнее - при нехватке бюджета отбрасываются старые).
+        """
+        session = self._session(user_id)
+        if session is None or token_budget <= 0:
+            return []
+        messages, used = [], 0
+        for question, answer in reversed(session.turns):
+            turn_tokens = count_tokens(question, self.model_name) + count_tokens(answer, self.model_name)
+            if used + turn_tokens > token_budget:
+                break
+            messages[:0] = [{"role": "user", "content": question}, {"role": "assistant", "content": answer}]
+            used += turn_tokens
+        if session.summary and used + count_tokens(session.summary, self.model_name) <= token_budget:
+            messages.insert(0, {"role": "user", "content": session.summary})
+        return messages
+
+    def stats(self):
+        turns = sum(len(session.turns) for session in self._sessions.values())
+        # Оценка памяти по текстам (символ кириллицы в str - 2 байта) без накладных расходов объектов
+        text_bytes = sum(
+            2 * (len(session.summary) + len(session.topic or "") + sum(len(q) + len(a) for q, a in session.turns))
+            for session in self._sessions.values()
+        )
+        return {
+            "sessions": len(self._sessions),
+            "turns": turns,
+            "text_bytes": text_bytes,
+            "rewritten": self.rewritten,
+            "idle_evictions": self.idle_evictions,
+            "lru_evictions": self.lru_evictions,
+        }
@@ -1,13 +1,34 @@
 # src/data_processor.py
 import json
 import os
-from sentence_transformers import SentenceTransformer
-import faiss
+import time
+import argparse
 import numpy as np
+from dotenv import load_dotenv
+
+# Те же настройки .env, что и у бота (модель, бэкенд, разбиение); модули читают их при импорте
+load_dotenv()
+
+from chunking import chunk_id, chunk_workers, content_hash, iter_chunks
+from encoder import DEFAULT_MODEL_NAME, load_encoder, probe_embedding, resolve_model_name
+from kb_store import open_kb_store, write_kb_store
+from lexical_index import BM25Index
+from vector_store import (
+    FAISS_INDEX_PATH, INDEX_META_PATH, build_index, encode_passages, load_index, make_index_meta,
+    resolve_index_type, save_index, update_index,
+)
 
 # Убедимся, что папка models существует
 os.makedirs('models', exist_ok=True)
 
+# Тип индекса: auto (flat для небольших баз, hnsw для больших), flat, hnsw или ivfpq
+INDEX_TYPE = os.getenv('INDEX_TYPE', 'auto')
+# Модель эмбеддингов и бэкенд: torch, int8, onnx или small (должны совпадать с ботом)
+EMBEDDING_MODEL = os.getenv('EMBEDDING_MODEL', DEFAULT_MODEL_NAME)
+ENCODER_BACKEND = os.getenv('ENCODER_BACKEND', 'torch')
+# Тип хранения эмбеддингов в базе знаний: float16 (вдвое компактнее) или float32
+KB_EMBEDDING_DTYPE = os.getenv('KB_EMBEDDING_DTYPE', 'float16')
+
 def load_programs_data(filepath='data/programs_data.json'):
     """Загружает данные программ из JSON файла."""
     if not os.path.exists(filepath):
@@ -15,77 +36,136 @@ def load_programs_data(filepath='data/programs_data.json'):
     with open(filepath, 'r', encoding='utf-8') as f:
         return json.load(f)
 
-def create_chunks(programs_data):
-    """Разбивает данные на фрагменты (chunks) для индексации."""
-    chunks = []
-    for program in programs_data:
-        program_name = program['name']
-        program_url = program['url']
-        
-        # Создаем чанки для каждого поля
-        for field, content in program.items():
-            if isinstance(content, str) and len(content) > 50: # Игнорируем короткие строки и не-строки
-                 # Простое разбиение по предложениям для примера. Можно улучшить.
-                 sentences = content.split('. ')
-                 current_chunk = ""
-                 for sentence in sentences:
-                     if len(current_chunk) + len(sentence) < 800: # Примерный размер чанка
-                         current_chunk += sentence + ". "
-                     else:
-                         if current_chunk:
-                             chunks.append({
-                                 "text": current_chunk.strip(),
-                                 "source": program_name,
-                                 "field": field,
-                                 "url": program_url
-                             })
-                         current_chunk = sentence + ". "
-                 if current_chunk: # Добавляем последний оставшийся чанк
-                     chunks.append({
-                         "text": current_chunk.strip(),
-                         "source": program_name,
-                         "field": field,
-                         "url": program_url
-                     })
-            elif isinstance(content, list): # Например, направления подготовки
-                list_text = f"{field}: " + ", ".join([f"{item.get('code', '')} {item.get('name', '')}" for item in content if isinstance(item, dict)])
-                chunks.append({
-                    "text": list_text,
-                    "source": program_name,
-                    "field": field,
-                    "url": program_url
-                })
-            # Можно добавить обработку других типов данных (например, companies)
-    return chunks
-
-def build_vector_store(chunks, model_name='intfloat/multilingual-e5-large'):
-    """Создает векторную базу знаний с использованием SentenceTransformer и FAISS."""
-    print("Загрузка модели SentenceTransformer...")
-    model = SentenceTransformer(model_name)
-    print("Модель загружена.")
-
-    print("Создание эмбеддингов...")
-    texts = [chunk['text'] for chunk in chunks]
-    embeddings = model.encode(texts, show_progress_bar=True)
-    print(f"Создано {len(embeddings)} эмбеддингов.")
-
-    # Создание FAISS индекса
-    dimension = embeddings.shape[1]
-    index = faiss.IndexFlatL2(dimension) # Используем L2 distance
-    index.add(np.array(embeddings).astype('float32')) # FAISS требует float32
-    
-    # Сохранение индекса и чанков
-    faiss.write_index(index, 'models/faiss_index.bin')
-    with open('models/chunks.json', 'w', encoding='utf-8') as f:
-        json.dump(chunks, f, ensure_ascii=False, indent=4)
-    
-    print("Векторная база знаний сохранена в models/")
+def create_chunks(programs_data, workers=None):
+    """Разбивает данные на фрагменты (chunks) для индексации (см. chunking.py)."""
+    if workers is None:
+        workers = chunk_workers(len(programs_data))
+    return list(iter_chunks(programs_data, workers=workers))
+
+def assign_chunk_ids(chunks):
+    """
+    Проставляет чанкам хэш содержимого и стабильный 63-битный идентификатор
+    (зависит от страницы, раздела и текста), если их еще нет. Полные дубликаты отбрасываются.
+    Принимает и список, и поток фрагментов из chunking.iter_chunks.
+    """
+    unique_chunks = {}
+    for chunk in chunks:
+        if 'id' not in chunk:
+            chunk['hash'] = content_hash(chunk['text'])
+            chunk['id'] = chunk_id(chunk['url'], chunk['field'], chunk['hash'])
+        unique_chunks.setdefault(chunk['id'], chunk)
+    return list(unique_chunks.values())
+
+def load_previous_store(model_name, backend):
+    """Загружает предыдущую версию базы знаний, если она построена той же моделью и бэкендом."""
+    if not all(os.path.exists(path) for path in (FAISS_INDEX_PATH, INDEX_META_PATH)):
+        return None
+    with open(INDEX_META_PATH, 'r', encoding='utf-8') as f:
+        meta = json.load(f)
+    if meta.get('model_name') != model_name or meta.get('encoder_backend', 'torch') != backend:
+        print(f"Индекс построен другой моделью ({meta.get('model_name')}, {meta.get('encoder_backend')}), требуется полная переиндексация.")
+        return None
+    try:
+        store = open_kb_store()
+    except (OSError, ValueError) as e:
+        print(f"Предыдущая база знаний не читается ({e}), требуется полная переиндексация.")
+        return None
+    if store is None or meta.get('kb_generation') != store.generation:
+        return None
+    return store, meta
+
+def build_vector_store(chunks, model_name=EMBEDDING_MODEL, index_type=INDEX_TYPE, incremental=True,
+                       backend=ENCODER_BACKEND):
+    """
+    Создает векторную базу знаний с использованием SentenceTransformer и FAISS.
+    В инкрементальном режиме эмбеддинги неизменившихся чанков берутся из предыдущей
+    версии базы, а индекс обновляется удалением и добавлением отдельных чанков.
+    """
+    started = time.perf_counter()
+    chunks = assign_chunk_ids(chunks)
+    if not chunks:
+        # Пустую базу нельзя ни проиндексировать, ни использовать в боте - старая версия остается на месте
+        raise ValueError("Нет ни одного фрагмента для индексации: проверьте data/programs_data.json "
+                         "(парсер мог не получить страницы программ).")
+    model_name = resolve_model_name(model_name, backend)
+    previous = load_previous_store(model_name, backend) if incremental else None
+    # Отпечаток модели для проверки совместимости на стороне бота
+    probe = previous[1].get('probe_embedding') if previous else None
+
+    # Эмбеддинги, которые можно переиспользовать, по хэшу текста
+    cached_embeddings = {}
+    if previous:
+        previous_store, _ = previous
+        for text_hash, embedding in zip(previous_store.chunks.hashes, previous_store.embeddings):
+            cached_embeddings[text_hash.decode('ascii')] = embedding
+
+    texts_to_embed = list(dict.fromkeys(chunk['text'] for chunk in chunks if chunk['hash'] not in cached_embeddings))
+    print(f"Чанков: {len(chunks)}, новых или измененных текстов для эмбеддинга: {len(texts_to_embed)}.")
+    if texts_to_embed:
+        print(f"Загрузка модели SentenceTransformer ({model_name}, бэкенд {backend})...")
+        model = load_encoder(model_name, backend)
+        print("Модель загружена.")
+        probe = probe_embedding(model).tolist()
+
+        print("Создание эмбеддингов...")
+        # Нормированные эмбеддинги с префиксом 'passage: ', как требует e5
+        new_embeddings = encode_passages(model, texts_to_embed, show_progress_bar=True)
+        print(f"Создано {len(new_embeddings)} эмбеддингов.")
+        for text, embedding in zip(texts_to_embed, new_embeddings):
+            cached_embeddings[content_hash(text)] = embedding
+
+    embeddings = np.stack([cached_embeddings[chunk['hash']] for chunk in chunks]).astype('float32')
+    ids = np.array([chunk['id'] for chunk in chunks], dtype='int64')
+
+    index = None
+    if previous:
+        previous_store, previous_meta = previous
+        resolved_type = resolve_index_type(index_type, len(chunks))
+        if resolved_type == previous_meta['index_type']:
+            # Точечное обновление индекса по идентификаторам чанков
+            index, _ = load_index()
+            previous_ids = set(previous_store.chunks.ids.tolist())
+            current_ids = set(ids.tolist())
+            removed_ids = sorted(previous_ids - current_ids)
+            added_rows = [i for i, chunk_id in enumerate(ids) if chunk_id not in previous_ids]
+            if update_index(index, removed_ids, embeddings[added_rows], ids[added_rows]):
+                index_type, params = previous_meta['index_type'], previous_meta['params']
+                print(f"Индекс обновлен: удалено {len(removed_ids)}, добавлено {len(added_rows)} чанков.")
+            else:
+                print(f"Индекс типа '{resolved_type}' не поддерживает удаление, он будет пересобран из сохраненных эмбеддингов.")
+                index = None
+
+    if index is None:
+        # Создание FAISS индекса (скалярное произведение нормированных векторов = косинусная близость)
+        index, index_type, params = build_index(embeddings, index_type, ids=ids)
+        print(f"Построен индекс типа '{index_type}' с параметрами {params}.")
+
+    # Лексический индекс дешев в построении - пересобирается целиком при каждом запуске
+    lexical_index = BM25Index.build([chunk['text'] for chunk in chunks], ids)
+    print(f"Построен лексический индекс BM25: {len(lexical_index.terms)} терминов.")
+
+    # Сохранение чанков с эмбеддингами и лексическим индексом (новое поколение), затем индекса
+    # и его параметров - все атомарно, бот может подхватить их на лету
+    directory = write_kb_store(chunks, embeddings, embedding_dtype=KB_EMBEDDING_DTYPE,
+                               extra_manifest={"model_name": model_name, "encoder_backend": backend},
+                               lexical_index=lexical_index)
+    meta = make_index_meta(model_name, index_type, params, len(embeddings), embeddings.shape[1],
+                           encoder_backend=backend, probe_embedding=probe,
+                           kb_generation=os.path.basename(directory))
+    save_index(index, meta)
+
+    print(f"Векторная база знаний сохранена в models/ за {time.perf_counter() - started:.1f} с")
 
 def main():
     """Главная функция для обработки данных и создания векторной базы."""
+    arg_parser = argparse.ArgumentParser(description="Построение векторной базы знаний")
+    arg_parser.add_argument('--full', action='store_true', help="Пересчитать все эмбеддинги и пересобрать индекс с нуля")
+    args = arg_parser.parse_args()
+
     programs_data = load_programs_data()
-    chunks = create_chunks(programs_data)
-    build_vector_store(chunks)
+    # Фрагменты идут потоком: дубликаты отбрасываются, пока остальные страницы еще разбиваются
+    chunks = iter_chunks(programs_data, workers=chunk_workers(len(programs_data)))
+    build_vector_store(chunks, incremental=not args.full)
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,126 @@
+# src/embedding_service.py
+import asyncio
+import logging
+import time
+from collections import deque
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+class EmbeddingBatcher:
+    """
+    Микро-батчинг эмбеддингов: собирает вопросы, пришедшие в течение короткого окна
+    (или до заполнения батча), кодирует их одним вызовом модели и возвращает
+    каждый вектор ожидающей корутине.
+    """
+
+    def __init__(self, encode_fn, executor=None, max_batch_size=32, max_wait_ms=10.0, stats_window=1000):
+        # encode_fn принимает список строк и возвращает матрицу эмбеддингов
+        self.encode_fn = encode_fn
+        self.executor = executor
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.0
+        self._queue = None
+        self._worker = None
+        # Метрики
+        self.batches = 0
+        self.items = 0
+        self.max_batch_seen = 0
+        self._recent_waits = deque(maxlen=stats_window)
+        self._recent_sizes = deque(maxlen=stats_window)
+
+    async def start(self):
+        """Запускает фоновую задачу, формирующую батчи."""
+        if self._worker is None:
+            self._queue = asyncio.Queue()
+            self._worker = asyncio.create_task(self._run(), name="embedding-batcher")
+
+    async def stop(self):
+        """Останавливает фоновую задачу; ожидающие запросы получают ошибку."""
+        if self._worker is not None:
+            self._worker.cancel()
+            try:
+                await self._worker
+            except asyncio.CancelledError:
+                pass
+            self._worker = None
+        while self._queue is not None and not self._queue.empty():
+            _, future, _ = self._queue.get_nowait()
+            if not future.done():
+                future.set_exception(RuntimeError("Сервис эмбеддингов остановлен"))
+
+    async def encode(self, text):
+        """Возвращает эмбеддинг одного текста (одномерный float32 вектор)."""
+        if self._worker is None:
+            raise RuntimeError("EmbeddingBatcher не запущен")
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((text, future, time.perf_counter()))
+        return await future
+
+    async def _collect_batch(self):
+        """Ждет первый элемент, затем добирает батч до окна или максимального размера."""
+        batch = [await self._queue.get()]
+        deadline = time.perf_counter() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.perf_counter()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self._collect_batch()
+            # Отменённые вызывающие стороной запросы не кодируем
+            batch = [item for item in batch if not item[1].done()]
+            if not batch:
+                continue
+            started = time.perf_counter()
+            texts = [text for text, _, _ in batch]
+            try:
+                embeddings = await loop.run_in_executor(self.executor, self.encode_fn, texts)
+                embeddings = np.asarray(embeddings, dtype='float32')
+            except Exception as e:
+                logger.error(f"Ошибка при вычислении батча эмбеддингов: {e}", exc_info=True)
+                for _, future, _ in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+
+            for i, (_, future, enqueued_at) in enumerate(batch):
+                self._recent_waits.append(started - enqueued_at)
+                if not future.done():
+                    future.set_result(embeddings[i])
+            self.batches += 1
+            self.items += len(batch)
+            self.max_batch_seen = max(self.max_batch_seen, len(batch))
+            self._recent_sizes.append(len(batch))
+            logger.debug(f"Батч эмбеддингов: {len(batch)} шт. за {time.perf_counter() - started:.3f} с")
+
+    def stats(self):
+        """Метрики заполненности батчей и времени ожидания в очереди."""
+        waits = sorted(self._recent_waits)
+        sizes = list(self._recent_sizes)
+
+        def percentile(values, q):
+            return values[min(len(values) - 1, int(q * len(values)))] if values else 0.0
+
+        return {
+            "batches": self.batches,
+            "items": self.items,
+            "queue_size": self._queue.qsize() if self._queue is not None else 0,
+            "max_batch_size": self.max_batch_size,
+            "max_wait_ms": self.max_wait * 1000,
+            "avg_batch_size": (sum(sizes) / len(sizes)) if sizes else 0.0,
+            "max_batch_seen": self.max_batch_seen,
+            "batch_occupancy": (sum(sizes) / (len(sizes) * self.max_batch_size)) if sizes else 0.0,
+            "queue_wait_p50_ms": percentile(waits, 0.50) * 1000,
+            "queue_wait_p95_ms": percentile(waits, 0.95) * 1000,
+            "queue_wait_max_ms": (waits[-1] * 1000) if waits else 0.0,
+        }
@@ -0,0 +1,85 @@
+# src/encoder.py
+import logging
+import time
+
+import numpy as np
+
+from vector_store import encode_passages, encode_queries
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MODEL_NAME = 'intfloat/multilingual-e5-large'
+# Дистиллированная модель того же семейства: в разы меньше и быстрее, но требует переиндексации
+SMALL_MODEL_NAME = 'intfloat/multilingual-e5-small'
+
+# torch - полная fp32 модель, int8 - динамическое квантование линейных слоев,
+# onnx - ONNX Runtime, small - дистиллированная e5-small
+ENCODER_BACKENDS = ('torch', 'int8', 'onnx', 'small')
+
+# Фиксированный текст, эмбеддинг которого сохраняется вместе с индексом для проверки совместимости
+PROBE_TEXT = "Сколько бюджетных мест на магистерской программе по искусственному интеллекту?"
+# Минимальная косинусная близость эмбеддингов пробного текста у индексатора и бота
+PROBE_MIN_SIMILARITY = 0.95
+
+
+def resolve_model_name(model_name, backend):
+    """Бэкенд small подменяет модель на дистиллированную."""
+    return SMALL_MODEL_NAME if backend == 'small' else model_name
+
+
+def load_encoder(model_name=DEFAULT_MODEL_NAME, backend='torch', onnx_file_name=None):
+    """Загружает модель эмбеддингов с выбранным бэкендом инференса."""
+    # sentence_transformers (и torch) импортируются здесь: импорт занимает секунды и не должен задерживать запуск бота
+    from sentence_transformers import SentenceTransformer
+
+    if backend not in ENCODER_BACKENDS:
+        raise ValueError(f"Неизвестный бэкенд '{backend}'. Допустимые значения: {', '.join(ENCODER_BACKENDS)}")
+    model_name = resolve_model_name(model_name, backend)
+
+    if backend == 'onnx':
+        # Для квантованной ONNX-модели можно указать файл, например onnx/model_qint8_avx512_vnni.onnx
+        model_kwargs = {"file_name": onnx_file_name} if onnx_file_name else None
+        return SentenceTransformer(model_name, backend='onnx', model_kwargs=model_kwargs)
+
+    if backend == 'int8':
+        import torch
+        model = SentenceTransformer(model_name, device='cpu')
+        # Веса линейных слоев хранятся в int8: примерно в 3-4 раза меньше памяти и быстрее на CPU
+        torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+        return model
+
+    return SentenceTransformer(model_name)
+
+
+def warm_up(model, batch_size=8):
+    """Прогревочный проход: первая реальная выдача не платит за ленивую инициализацию. Возвращает время (сек.)."""
+    started = time.perf_counter()
+    encode_queries(model, [PROBE_TEXT] * batch_size)
+    return time.perf_counter() - started
+
+
+def probe_embedding(model):
+    """Эмбеддинг пробного текста (как документа) - отпечаток модели, которой построен индекс."""
+    return encode_passages(model, [PROBE_TEXT])[0]
+
+
+def check_index_compatibility(model, model_name, index_meta):
+    """
+    Проверяет, что модель бота совпадает с моделью, которой построен индекс.
+    Возвращает список проблем (пустой, если все в порядке).
+    """
+    problems = []
+    dimension = model.get_sentence_embedding_dimension()
+    if index_meta.get('dimension') not in (None, dimension):
+        problems.append(f"размерность индекса {index_meta['dimension']} != размерности модели {dimension}")
+    if index_meta.get('model_name') != model_name:
+        problems.append(f"индекс построен моделью {index_meta.get('model_name')}, а бот использует {model_name}")
+    stored_probe = index_meta.get('probe_embedding')
+    if stored_probe is not None and not problems:
+        # Квантование и ONNX слегка меняют эмбеддинги - допускаем небольшое расхождение
+        similarity = float(np.dot(probe_embedding(model), np.asarray(stored_probe, dtype='float32')))
+        if similarity < PROBE_MIN_SIMILARITY:
+            problems.append(f"эмбеддинги модели расходятся с индексом (близость пробного текста {similarity:.3f})")
+        else:
+            logger.info(f"Модель совместима с индексом (близость пробного текста {similarity:.4f}).")
+    return problems
@@ -0,0 +1,234 @@
+# src/fake_updates.py
+"""
+Локальная проверка режима webhook без Telegram: генератор поддельных обновлений
+и заглушка Bot API, которая принимает sendMessage/editMessageText и запоминает ответы бота.
+
+Пример (диспетчер и воркеры запущены с TELEGRAM_API_URL=http://127.0.0.1:8081/bot):
+    python src/fake_updates.py --target http://127.0.0.1:8443/telegram --users 20 --questions 3
+"""
+import argparse
+import itertools
+import json
+import random
+import threading
+import time
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+from webhook import SECRET_TOKEN_HEADER, wait_for_workers
+
+FAKE_BOT_USER = {"id": 1000000001, "is_bot": True, "first_name": "ITMO QA Bot", "username": "itmo_qa_fake_bot"}
+
+SAMPLE_QUESTIONS = (
+    "Какие стипендии доступны?",
+    "Где смогу работать после выпуска?",
+    "Какие направления подготовки есть у программы ИИ?",
+    "Чем отличаются программы ИИ и AI Product?",
+    "Какие международные возможности предоставляет ИТМО?",
+    "Сколько стоит обучение?",
+    "Какие экзамены нужно сдавать?",
+)
+RECOMMEND_ANSWERS = ("программирование, математика", "Computer Vision, NLP", "ML Engineer")
+
+_update_ids = itertools.count(1)
+_message_ids = itertools.count(1)
+
+
+def make_message_update(user_id, text, chat_id=None, first_name=None, update_id=None):
+    """Обновление с текстовым сообщением в личном чате; команды размечаются как bot_command."""
+    chat_id = chat_id if chat_id is not None else user_id
+    user = {"id": user_id, "is_bot": False, "first_name": first_name or f"User{user_id}", "language_code": "ru"}
+    message = {
+        "message_id": next(_message_ids),
+        "date": int(time.time()),
+        "chat": {"id": chat_id, "type": "private", "first_name": user["first_name"]},
+        "from": user,
+        "text": text,
+    }
+    if text.startswith("/"):
+        message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+    return {"update_id": update_id if update_id is not None else next(_update_ids), "message": message}
+
+
+def user_session(user_id, questions=3, recommend=True, rng=random):
+    """Последовательность сообщений одного пользователя: /start, вопросы и, возможно, диалог /recommend."""
+    texts = ["/start"] + [rng.choice(SAMPLE_QUESTIONS) for _ in range(questions)]
+    if recommend:
+        texts += ["/recommend", *RECOMMEND_ANSWERS]
+    return [make_message_update(user_id, text) for text in texts]
+
+
+class _FakeBotAPIHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _parameters(self):
+        length = int(self.headers.get("Content-Length", 0))
+        body = self.rfile.read(length).decode("utf-8") if length else ""
+        if self.headers.get("Content-Type", "").startswith("application/json"):
+            return json.loads(body or "{}")
+        parameters = {}
+        for name, values in parse_qs(body, keep_blank_values=True).items():
+            # Bot API клиент кодирует нестроковые параметры в JSON, строки передает как есть
+            try:
+                parameters[name] = values[0] if name in ("text", "parse_mode") else json.loads(values[0])
+            except ValueError:
+                parameters[name] = values[0]
+        return parameters
+
+    def do_POST(self):
+        method = self.path.rsplit("/", 1)[-1]
+        parameters = self._parameters()
+        result = self.server.api.handle(method, parameters)
+        body = json.dumps({"ok": True, "result": result}, ensure_ascii=False).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    do_GET = do_POST
+
+
+class FakeBotAPI:
+    """Заглушка Bot API: отвечает на вызовы бота и записывает отправленные сообщения по чатам."""
+
+    def __init__(self):
+        self.sent = {}  # chat_id -> [(время, текст)]
+        self.edits = 0
+        self._condition = threading.Condition()
+        self._message_ids = itertools.count(1)
+        self.server = None
+
+    def handle(self, method, parameters):
+        if method == "getMe":
+            return FAKE_BOT_USER
+        if method in ("sendMessage", "editMessageText"):
+            chat_id = int(parameters["chat_id"])
+            with self._condition:
+                if method == "sendMessage":
+                    self.sent.setdefault(chat_id, []).append((time.monotonic(), parameters.get("text", "")))
+                    self._condition.notify_all()
+                else:
+                    self.edits += 1
+            return {
+                "message_id": int(parameters.get("message_id") or next(self._message_ids)),
+                "date": int(time.time()),
+                "chat": {"id": chat_id, "type": "private"},
+                "from": FAKE_BOT_USER,
+                "text": parameters.get("text", ""),
+            }
+        # setWebhook, deleteWebhook, sendChatAction и прочее - просто успех
+        return True
+
+    def replies(self, chat_id):
+        with self._condition:
+            return len(self.sent.get(chat_id, []))
+
+    def wait_for_reply(self, chat_id, seen, timeout):
+        """Ждет, пока в чат придет больше seen сообщений; False по таймауту."""
+        with self._condition:
+            return self._condition.wait_for(lambda: len(self.sent.get(chat_id, [])) > seen, timeout)
+
+    def start(self, host="127.0.0.1", port=8081):
+        self.server = ThreadingHTTPServer((host, port), _FakeBotAPIHandler)
+        self.server.daemon_threads = True
+        self.server.api = self
+        threading.Thread(target=self.server.serve_forever, name="fake-bot-api", daemon=True).start()
+        return self
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+
+
+def post_update(target_url, update, secret_token=None, timeout=10.0):
+    """Отправляет обновление как Telegram: POST JSON на адрес webhook; возвращает HTTP-статус."""
+    headers = {"Content-Type": "application/json"}
+    if secret_token:
+        headers[SECRET_TOKEN_HEADER] = secret_token
+    request = urllib.request.Request(target_url, data=json.dumps(update).encode("utf-8"), headers=headers, method="POST")
+    with urllib.request.urlopen(request, timeout=timeout) as response:
+        return response.status
+
+
+def run_session(api, target_url, session, secret_token=None, reply_timeout=30.0, think_time=0.2):
+    """
+    Проигрывает сессию пользователя как живой человек: следующее сообщение - после ответа бота
+    и паузы think_time. Без паузы шаг диалога /recommend мог бы прийти раньше, чем обработчик
+    предыдущего шага (уже отправивший ответ) сменит состояние. Возвращает задержки ответов (сек.).
+    """
+    chat_id = session[0]["message"]["chat"]["id"]
+    latencies = []
+    for update in session:
+        seen = api.replies(chat_id)
+        sent_at = time.monotonic()
+        try:
+            post_update(target_url, update, secret_token)
+        except OSError as e:
+            print(f"Ошибка доставки обновления {update['update_id']}: {e}")
+            continue
+        if api.wait_for_reply(chat_id, seen, reply_timeout):
+            latencies.append(time.monotonic() - sent_at)
+        time.sleep(think_time)
+    return latencies
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description="Поддельные обновления Telegram для проверки режима webhook")
+    arg_parser.add_argument('--target', default='http://127.0.0.1:8443/telegram', help="Адрес webhook диспетчера")
+    arg_parser.add_argument('--secret', default='', help="WEBHOOK_SECRET_TOKEN диспетчера")
+    arg_parser.add_argument('--users', type=int, default=10)
+    arg_parser.add_argument('--questions', type=int, default=3, help="Вопросов на пользователя")
+    arg_parser.add_argument('--no-recommend', action='store_true', help="Без диалога /recommend")
+    arg_parser.add_argument('--api-port', type=int, default=8081, help="Порт заглушки Bot API (TELEGRAM_API_URL)")
+    arg_parser.add_argument('--startup-timeout', type=float, default=300.0,
+                            help="Сколько ждать готовности диспетчера (заглушку Bot API можно запустить раньше бота)")
+    arg_parser.add_argument('--reply-timeout', type=float, default=30.0, help="Сколько ждать ответа бота (сек.)")
+    arg_parser.add_argument('--think-time', type=float, default=0.2, help="Пауза пользователя между сообщениями (сек.)")
+    arg_parser.add_argument('--seed', type=int, default=0)
+    args = arg_parser.parse_args()
+
+    api = FakeBotAPI().start(port=args.api_port)
+    target = urlsplit(args.target)
+    print(f"Заглушка Bot API: TELEGRAM_API_URL=http://127.0.0.1:{args.api_port}/bot; ждем {target.netloc}...")
+    if wait_for_workers([f"{target.scheme}://{target.netloc}"], timeout=args.startup_timeout):
+        print("Диспетчер webhook не ответил.")
+        api.stop()
+        return
+    rng = random.Random(args.seed)
+    sessions = [user_session(10000 + i, args.questions, not args.no_recommend, rng) for i in range(args.users)]
+
+    # Пользователи работают параллельно, сообщения одного пользователя - по очереди
+    results = [None] * len(sessions)
+
+    def worker(i):
+        results[i] = run_session(api, args.target, sessions[i], args.secret or None, args.reply_timeout,
+                                 args.think_time)
+
+    started = time.monotonic()
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(len(sessions))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.monotonic() - started
+    api.stop()
+
+    latencies = sorted(latency for session_latencies in results for latency in session_latencies)
+    total = sum(len(session) for session in sessions)
+    print(f"Ответов получено: {len(latencies)} из {total} за {elapsed:.1f} с (правок сообщений: {api.edits})")
+    if latencies:
+        print(f"Задержка ответа: p50 {latencies[len(latencies) // 2]:.2f} с, "
+              f"p95 {latencies[min(len(latencies) - 1, int(0.95 * len(latencies)))]:.2f} с")
+    chat_id = sessions[0][0]["message"]["chat"]["id"]
+    for _, text in api.sent.get(chat_id, [])[-2:]:
+        print(f"  чат {chat_id}: {text[:200]}")
+
+
+if __name__ == "__main__":
+    main()
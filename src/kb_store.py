@@ -0,0 +1,194 @@
+# src/kb_store.py
+import json
+import os
+import shutil
+import time
+
+import numpy as np
+
+from lexical_index import BM25Index
+
+# Каталог компактной базы знаний: каждое поколение в своем подкаталоге,
+# файл CURRENT атомарно указывает на актуальное
+KB_STORE_DIR = 'models/kb'
+KB_CURRENT_PATH = os.path.join(KB_STORE_DIR, 'CURRENT')
+KB_FORMAT_VERSION = 1
+# Сколько последних поколений хранить на диске (старые могут быть еще открыты работающими ботами)
+KEEP_GENERATIONS = 3
+
+# Категориальные колонки: значения хранятся словарем, а для чанков - номера в словаре
+CATEGORICAL_COLUMNS = ('source', 'field', 'url')
+
+
+class ChunkStore:
+    """
+    Колоночное хранилище чанков поверх memory-mapped файлов.
+    Ведет себя как словарь {идентификатор чанка: чанк}; чанк собирается при обращении,
+    поэтому загрузка не разбирает JSON, а несколько процессов делят одни страницы памяти.
+    """
+
+    def __init__(self, directory, manifest):
+        self.directory = directory
+        self.manifest = manifest
+        self.ids = np.load(os.path.join(directory, 'ids.npy'), mmap_mode='r')  # отсортированы по возрастанию
+        self.hashes = np.load(os.path.join(directory, 'hashes.npy'), mmap_mode='r')
+        self.text_offsets = np.load(os.path.join(directory, 'text_offsets.npy'), mmap_mode='r')
+        self.text_blob = np.memmap(os.path.join(directory, 'text.bin'), dtype='uint8', mode='r') \
+            if manifest['text_bytes'] else np.zeros(0, dtype='uint8')
+        self.codes = {column: np.load(os.path.join(directory, f'{column}_codes.npy'), mmap_mode='r')
+                      for column in CATEGORICAL_COLUMNS}
+        self.vocabularies = manifest['vocabularies']
+
+    def __len__(self):
+        return len(self.ids)
+
+    def row_of(self, chunk_id):
+        """Номер строки чанка или -1, если такого идентификатора нет."""
+        row = int(np.searchsorted(self.ids, chunk_id))
+        return row if row < len(self.ids) and self.ids[row] == chunk_id else -1
+
+    def __contains__(self, chunk_id):
+        return self.row_of(chunk_id) != -1
+
+    def text(self, row):
+        start, end = self.text_offsets[row], self.text_offsets[row + 1]
+        return self.text_blob[start:end].tobytes().decode('utf-8')
+
+    def chunk(self, row):
+        """Собирает чанк в привычном виде (dict) по номеру строки."""
+        chunk = {"text": self.text(row)}
+        for column in CATEGORICAL_COLUMNS:
+            chunk[column] = self.vocabularies[column][int(self.codes[column][row])]
+        chunk["id"] = int(self.ids[row])
+        chunk["hash"] = self.hashes[row].decode('ascii')
+        return chunk
+
+    def __getitem__(self, chunk_id):
+        row = self.row_of(chunk_id)
+        if row == -1:
+            raise KeyError(chunk_id)
+        return self.chunk(row)
+
+    def get(self, chunk_id, default=None):
+        row = self.row_of(chunk_id)
+        return self.chunk(row) if row != -1 else default
+
+    def __iter__(self):
+        return (int(chunk_id) for chunk_id in self.ids)
+
+    def values(self):
+        return (self.chunk(row) for row in range(len(self.ids)))
+
+
+class KnowledgeBaseStore:
+    """Поколение компактной базы знаний: чанки и матрица их эмбеддингов (memory-mapped)."""
+
+    def __init__(self, directory):
+        self.directory = directory
+        with open(os.path.join(directory, 'manifest.json'), 'r', encoding='utf-8') as f:
+            self.manifest = json.load(f)
+        if self.manifest.get('format_version') != KB_FORMAT_VERSION:
+            raise ValueError(f"Неподдерживаемая версия формата базы знаний: {self.manifest.get('format_version')}")
+        self.chunks = ChunkStore(directory, self.manifest)
+        # Строки матрицы в том же порядке, что и ids
+        self.embeddings = np.load(os.path.join(directory, 'embeddings.npy'), mmap_mode='r')
+        # Лексический индекс BM25 (в поколениях, записанных до его появления, отсутствует)
+        self.lexical_index = BM25Index.load(directory) if self.manifest.get('lexical') else None
+
+    @property
+    def generation(self):
+        return self.manifest['generation']
+
+
+def current_generation_dir(root=KB_STORE_DIR):
+    """Каталог актуального поколения или None, если база еще не создана."""
+    current_path = os.path.join(root, 'CURRENT')
+    if not os.path.exists(current_path):
+        return None
+    with open(current_path, 'r', encoding='utf-8') as f:
+        name = f.read().strip()
+    return os.path.join(root, name) if name else None
+
+
+def open_kb_store(root=KB_STORE_DIR):
+    """Открывает актуальное поколение базы знаний (или None)."""
+    directory = current_generation_dir(root)
+    if directory is None or not os.path.isdir(directory):
+        return None
+    return KnowledgeBaseStore(directory)
+
+
+def _save_npy(directory, name, array):
+    np.save(os.path.join(directory, name), array)
+
+
+def write_kb_store(chunks, embeddings, root=KB_STORE_DIR, embedding_dtype='float16', extra_manifest=None,
+                   lexical_index=None):
+    """
+    Записывает новое поколение базы знаний и атомарно делает его актуальным.
+    chunks - список словарей с полями text, source, field, url, id, hash; embeddings - в том же порядке.
+    lexical_index (BM25Index) сохраняется в то же поколение, чтобы не расходиться с чанками.
+    Возвращает каталог поколения.
+    """
+    os.makedirs(root, exist_ok=True)
+    # Имя поколения сортируется хронологически
+    name = f"gen-{time.strftime('%Y%m%d-%H%M%S')}-{time.time_ns() % 1_000_000_000:09d}"
+    directory = os.path.join(root, name)
+    os.makedirs(directory)
+
+    # Строки упорядочиваются по идентификатору - поиск чанка по id без словаря в памяти
+    order = sorted(range(len(chunks)), key=lambda i: chunks[i]['id'])
+    chunks = [chunks[i] for i in order]
+    embeddings = np.asarray(embeddings)[order] if len(chunks) else np.asarray(embeddings)
+
+    _save_npy(directory, 'ids.npy', np.array([chunk['id'] for chunk in chunks], dtype='int64'))
+    _save_npy(directory, 'hashes.npy', np.array([chunk['hash'] for chunk in chunks], dtype='S40'))
+    _save_npy(directory, 'embeddings.npy', np.ascontiguousarray(embeddings, dtype=embedding_dtype))
+
+    encoded_texts = [chunk['text'].encode('utf-8') for chunk in chunks]
+    offsets = np.zeros(len(chunks) + 1, dtype='int64')
+    offsets[1:] = np.cumsum([len(text) for text in encoded_texts])
+    _save_npy(directory, 'text_offsets.npy', offsets)
+    with open(os.path.join(directory, 'text.bin'), 'wb') as f:
+        f.write(b''.join(encoded_texts))
+
+    vocabularies = {}
+    for column in CATEGORICAL_COLUMNS:
+        vocabulary = list(dict.fromkeys(chunk[column] for chunk in chunks))
+        positions = {value: i for i, value in enumerate(vocabulary)}
+        _save_npy(directory, f'{column}_codes.npy', np.array([positions[chunk[column]] for chunk in chunks], dtype='int32'))
+        vocabularies[column] = vocabulary
+
+    if lexical_index is not None:
+        lexical_index.save(directory)
+
+    manifest = {
+        **(extra_manifest or {}),
+        "format_version": KB_FORMAT_VERSION,
+        "generation": name,
+        "count": len(chunks),
+        "dimension": int(embeddings.shape[1]) if embeddings.ndim == 2 else 0,
+        "embedding_dtype": embedding_dtype,
+        "text_bytes": int(offsets[-1]),
+        "vocabularies": vocabularies,
+        "lexical": lexical_index is not None,
+        "created_at": time.strftime('%Y-%m-%dT%H:%M:%S'),
+    }
+    with open(os.path.join(directory, 'manifest.json'), 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=4)
+
+    # Переключение на новое поколение - атомарная замена файла-указателя
+    current_path = os.path.join(root, 'CURRENT')
+    with open(current_path + '.tmp', 'w', encoding='utf-8') as f:
+        f.write(name)
+    os.replace(current_path + '.tmp', current_path)
+    _prune_generations(root, keep=KEEP_GENERATIONS)
+    return directory
+
+
+def _prune_generations(root, keep):
+    """Удаляет старые поколения; открытые через mmap файлы остаются доступны читающим процессам."""
+    generations = sorted(entry for entry in os.listdir(root)
+                         if entry.startswith('gen-') and os.path.isdir(os.path.join(root, entry)))
+    for name in generations[:-keep]:
+        shutil.rmtree(os.path.join(root, name), ignore_errors=True)
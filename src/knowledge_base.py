@@ -0,0 +1,179 @@
+# src/knowledge_base.py
+import asyncio
+import json
+import logging
+import os
+import time
+
+# faiss импортируется при первом использовании, чтобы импорт модуля не задерживал запуск бота
+import numpy as np
+
+from kb_store import KB_CURRENT_PATH, KB_STORE_DIR, open_kb_store
+from vector_store import FAISS_INDEX_PATH, INDEX_META_PATH, load_index
+
+logger = logging.getLogger(__name__)
+
+DATA_FILE_PATH = 'data/programs_data.json'
+
+
+class KnowledgeBaseError(Exception):
+    """Файлы базы знаний отсутствуют или не согласованы между собой."""
+
+
+class KnowledgeBase:
+    """
+    Одно поколение базы знаний: индекс, чанки и данные программ.
+    Объект не изменяется после загрузки - запрос, получивший ссылку на поколение,
+    дорабатывает на нем даже после подмены на новое.
+    """
+
+    def __init__(self, generation, index, index_meta, chunks, programs_data, signature, embeddings=None,
+                 lexical_index=None):
+        self.generation = generation
+        self.index = index
+        self.index_meta = index_meta
+        self.chunks = chunks  # идентификатор чанка -> чанк (ChunkStore поверх memory-mapped файлов)
+        self.embeddings = embeddings  # эмбеддинги чанков в порядке строк ChunkStore
+        self.lexical_index = lexical_index  # BM25 или None
+        self.programs_data = programs_data
+        self.recommender = None  # ProgramRecommender, строится KnowledgeBaseManager.preparer до подмены
+        self.signature = signature
+        self.loaded_at = time.time()
+
+
+def artifact_signature(paths):
+    """Отпечаток файлов (время изменения и размер), по которому отслеживается пересборка."""
+    signature = []
+    for path in paths:
+        try:
+            stat = os.stat(path)
+            signature.append((path, stat.st_mtime_ns, stat.st_size))
+        except FileNotFoundError:
+            signature.append((path, None, None))
+    return tuple(signature)
+
+
+def load_knowledge_base(generation, expected_dimension=None, index_path=FAISS_INDEX_PATH,
+                        meta_path=INDEX_META_PATH, kb_root=KB_STORE_DIR, data_path=DATA_FILE_PATH):
+    """Загружает и проверяет новое поколение базы знаний (блокирующая функция)."""
+    import faiss
+    current_path = os.path.join(kb_root, 'CURRENT')
+    signature = artifact_signature((index_path, meta_path, current_path, data_path))
+    if not (os.path.exists(index_path) and os.path.exists(current_path)):
+        raise KnowledgeBaseError("Не найдены файлы векторной базы знаний. Пожалуйста, сначала запустите data_processor.py")
+
+    # Индекс отображается в память: процессы бота на одной машине делят его страницы
+    index, index_meta = load_index(index_path, meta_path, mmap=True)
+    if index_meta is None:
+        raise KnowledgeBaseError("Индекс построен в старом формате (L2). Пожалуйста, пересоберите его, запустив data_processor.py")
+    if expected_dimension is not None and index.d != expected_dimension:
+        raise KnowledgeBaseError(f"Размерность индекса ({index.d}) не совпадает с размерностью модели ({expected_dimension}).")
+
+    try:
+        store = open_kb_store(kb_root)
+    except (OSError, ValueError) as e:
+        raise KnowledgeBaseError(f"Не удалось открыть хранилище чанков: {e}")
+    if store is None:
+        raise KnowledgeBaseError("Хранилище чанков не найдено (возможно, пересборка еще не завершена).")
+    # Индекс возвращает идентификаторы чанков, а не их позиции; чанки читаются из файлов по требованию
+    chunks = store.chunks
+    # Файлы могли быть прочитаны посреди пересборки - проверяем, что индекс и чанки из одной версии
+    if index_meta.get('kb_generation') not in (None, store.generation):
+        raise KnowledgeBaseError("Индекс и чанки не согласованы (возможно, пересборка еще не завершена).")
+    index_ids = faiss.vector_to_array(index.id_map) if isinstance(index, faiss.IndexIDMap) else np.arange(index.ntotal)
+    if not np.array_equal(np.sort(index_ids), chunks.ids):
+        raise KnowledgeBaseError("Индекс и чанки не согласованы (возможно, пересборка еще не завершена).")
+
+    programs_data = None
+    if os.path.exists(data_path):
+        with open(data_path, 'r', encoding='utf-8') as f:
+            programs_data = json.load(f)
+    else:
+        logger.warning("Файл данных программ не найден. Рекомендации будут ограничены.")
+
+    if signature != artifact_signature((index_path, meta_path, current_path, data_path)):
+        raise KnowledgeBaseError("Файлы базы знаний изменились во время загрузки.")
+    if store.lexical_index is None:
+        logger.warning("В базе знаний нет лексического индекса - поиск будет только векторным. Пересоберите базу data_processor.py")
+    return KnowledgeBase(generation, index, index_meta, chunks, programs_data, signature,
+                         embeddings=store.embeddings, lexical_index=store.lexical_index)
+
+
+class KnowledgeBaseManager:
+    """
+    Хранит текущее поколение базы знаний и атомарно подменяет его на новое.
+    Загрузка идет в пуле потоков, модель эмбеддингов при этом не перезагружается.
+    """
+
+    def __init__(self, expected_dimension=None, executor=None, on_swap=None, validator=None, preparer=None):
+        self.expected_dimension = expected_dimension
+        self.executor = executor
+        self.on_swap = on_swap  # вызывается с новым поколением после подмены
+        # Дополнительная проверка поколения перед подменой (в пуле потоков); возвращает список проблем
+        self.validator = validator
+        # Достраивает производные структуры поколения перед подменой (в пуле потоков)
+        self.preparer = preparer
+        self.current = None
+        self._generation = 0
+        self._rejected_signature = None  # версия файлов, не прошедшая проверку validator
+        self._lock = asyncio.Lock()
+        self._watch_task = None
+
+    async def reload(self, force=False, wait_for=None):
+        """
+        Загружает новое поколение, если файлы изменились (или force). Возвращает True при подмене.
+        wait_for - awaitable, которого проверка и подготовка поколения дождутся после чтения файлов:
+        при запуске файлы читаются параллельно с загрузкой модели.
+        """
+        async with self._lock:
+            signature = artifact_signature((FAISS_INDEX_PATH, INDEX_META_PATH, KB_CURRENT_PATH, DATA_FILE_PATH))
+            if not force and self.current is not None and signature in (self.current.signature, self._rejected_signature):
+                return False
+            loop = asyncio.get_running_loop()
+            knowledge_base = await loop.run_in_executor(
+                self.executor, load_knowledge_base, self._generation + 1, self.expected_dimension
+            )
+            if wait_for is not None:
+                await wait_for
+            if self.validator:
+                problems = await loop.run_in_executor(self.executor, self.validator, knowledge_base)
+                if problems:
+                    self._rejected_signature = knowledge_base.signature
+                    raise KnowledgeBaseError("; ".join(problems))
+            if self.preparer:
+                await loop.run_in_executor(self.executor, self.preparer, knowledge_base)
+            self._generation += 1
+            # Подмена ссылки атомарна: новые запросы берут новое поколение, текущие дорабатывают на старом
+            self.current = knowledge_base
+            logger.info(
+                f"Загружено поколение базы знаний #{knowledge_base.generation}: "
+                f"{knowledge_base.index_meta['index_type']}, {knowledge_base.index.ntotal} векторов."
+            )
+            if self.on_swap:
+                self.on_swap(knowledge_base)
+            return True
+
+    async def _watch(self, interval):
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.reload()
+            except KnowledgeBaseError as e:
+                # Скорее всего пересборка еще идет - попробуем на следующей итерации
+                logger.warning(f"Новая версия базы знаний пока не загружена: {e}")
+            except Exception as e:
+                logger.error(f"Ошибка при обновлении базы знаний: {e}", exc_info=True)
+
+    def start_watching(self, interval):
+        """Запускает фоновую проверку файлов models/ раз в interval секунд."""
+        if interval > 0 and self._watch_task is None:
+            self._watch_task = asyncio.create_task(self._watch(interval), name="knowledge-base-watcher")
+
+    async def stop_watching(self):
+        if self._watch_task is not None:
+            self._watch_task.cancel()
+            try:
+                await self._watch_task
+            except asyncio.CancelledError:
+                pass
+            self._watch_task = None
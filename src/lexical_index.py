@@ -0,0 +1,175 @@
+# src/lexical_index.py
+"""
+Лексический индекс BM25 по нормализованным русским токенам.
+Дополняет векторный поиск там, где важны точные совпадения: коды направлений
+(01.04.02), названия компаний, числа.
+"""
+import json
+import logging
+import math
+import os
+import re
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+try:
+    # Необязательная зависимость: полноценный стеммер Портера для русского языка
+    import snowballstemmer
+    _snowball = snowballstemmer.stemmer('russian')
+except ImportError:
+    _snowball = None
+    logger.warning("snowballstemmer не установлен, BM25 использует упрощенный стемминг (pip install snowballstemmer).")
+
+# Коды направлений и числа (01.04.02, 2024, 4,5) остаются одним токеном
+TOKEN_PATTERN = re.compile(r'\d+(?:[.,]\d+)*|[a-zа-я]+')
+
+STOP_WORDS = frozenset((
+    'и', 'в', 'во', 'на', 'по', 'с', 'со', 'к', 'ко', 'о', 'об', 'от', 'до', 'для', 'из', 'у', 'за', 'при', 'про',
+    'а', 'но', 'или', 'ли', 'же', 'бы', 'не', 'ни', 'что', 'как', 'это', 'то', 'так', 'там', 'тут', 'есть',
+    # Вопросительные слова не несут смысла для поиска по тексту программ
+    'какой', 'какая', 'какое', 'какие', 'каких', 'каком', 'сколько', 'где', 'когда', 'кто', 'чем', 'зачем',
+    'я', 'мы', 'вы', 'он', 'она', 'они', 'их', 'его', 'ее', 'мне', 'меня', 'вас', 'вам',
+    'the', 'and', 'of', 'to', 'in', 'a', 'an', 'is', 'for', 'on', 'with',
+))
+
+# Окончания для упрощенного стемминга (если snowballstemmer не установлен), от длинных к коротким
+_RUSSIAN_ENDINGS = tuple(sorted((
+    'иями', 'иям', 'иях', 'ией', 'ии', 'ия', 'ию', 'ями', 'ами', 'ого', 'его', 'ому', 'ему', 'ыми', 'ими',
+    'ой', 'ей', 'ий', 'ый', 'ая', 'яя',
+    'ое', 'ее', 'ие', 'ые', 'ых', 'их', 'ов', 'ев', 'ам', 'ям', 'ах', 'ях', 'ом', 'ем', 'ую', 'юю',
+    'ть', 'ла', 'ло', 'ли', 'ет', 'ит', 'ут', 'ют', 'ат', 'ят',
+    'а', 'я', 'о', 'е', 'ы', 'и', 'у', 'ю', 'ь', 'й',
+), key=len, reverse=True))
+
+# Ограничение числа терминов запроса - стоимость поиска не растет на длинных сообщениях
+MAX_QUERY_TERMS = 32
+
+
+def crude_stem(word):
+    """Отсекает типичное окончание, оставляя основу не короче трех букв."""
+    for ending in _RUSSIAN_ENDINGS:
+        if word.endswith(ending) and len(word) - len(ending) >= 3:
+            return word[:-len(ending)]
+    return word
+
+
+def normalize_token(token):
+    if token[0].isdigit():
+        return token.replace(',', '.')
+    if _snowball is not None:
+        return _snowball.stemWord(token)
+    return crude_stem(token) if 'а' <= token[0] <= 'я' else token
+
+
+def tokenize(text):
+    """Нижний регистр, е вместо ё, стоп-слова отброшены, слова приведены к основе."""
+    text = text.lower().replace('ё', 'е')
+    return [normalize_token(token) for token in TOKEN_PATTERN.findall(text) if token not in STOP_WORDS]
+
+
+class BM25Index:
+    """
+    Инвертированный индекс в виде CSR-массивов: для термина - строки документов и частоты.
+    Массивы хранятся в файлах поколения базы знаний и открываются через memory-map.
+    """
+
+    def __init__(self, terms, offsets, rows, term_frequencies, doc_lengths, ids, k1=1.2, b=0.75):
+        self.terms = {term: i for i, term in enumerate(terms)}
+        self.offsets = offsets
+        self.rows = rows
+        self.term_frequencies = term_frequencies
+        self.doc_lengths = doc_lengths
+        self.ids = ids
+        self.k1 = k1
+        self.b = b
+        self.avg_doc_length = float(np.mean(doc_lengths)) if len(doc_lengths) else 0.0
+        # Знаменатель BM25 без частоты термина не зависит от запроса - считаем один раз
+        self._length_norm = (k1 * (1 - b + b * np.asarray(doc_lengths, dtype='float32') / max(self.avg_doc_length, 1e-9))
+                             if len(doc_lengths) else np.zeros(0, dtype='float32'))
+
+    def __len__(self):
+        return len(self.ids)
+
+    @classmethod
+    def build(cls, texts, ids, k1=1.2, b=0.75):
+        postings = {}
+        doc_lengths = []
+        for row, text in enumerate(texts):
+            tokens = tokenize(text)
+            doc_lengths.append(len(tokens))
+            counts = {}
+            for token in tokens:
+                counts[token] = counts.get(token, 0) + 1
+            for token, count in counts.items():
+                postings.setdefault(token, []).append((row, count))
+
+        terms = sorted(postings)
+        offsets = np.zeros(len(terms) + 1, dtype='int64')
+        offsets[1:] = np.cumsum([len(postings[term]) for term in terms])
+        rows = np.array([row for term in terms for row, _ in postings[term]], dtype='int32')
+        term_frequencies = np.array([count for term in terms for _, count in postings[term]], dtype='uint16')
+        return cls(terms, offsets, rows, term_frequencies, np.array(doc_lengths, dtype='int32'),
+                   np.asarray(ids, dtype='int64'), k1, b)
+
+    def idf(self, term_id):
+        document_frequency = int(self.offsets[term_id + 1] - self.offsets[term_id])
+        return math.log(1 + (len(self.ids) - document_frequency + 0.5) / (document_frequency + 0.5))
+
+    def search(self, query, k):
+        """
+        Возвращает до k документов [(идентификатор чанка, оценка BM25, покрытие)] по убыванию оценки.
+        Покрытие - доля запроса (взвешенная по idf), найденная в документе: 1.0 - все термины на месте.
+        Совпадение кода или числа из запроса (01.04.02) засчитывается как полное покрытие.
+        """
+        query_terms = list(dict.fromkeys(tokenize(query)))[:MAX_QUERY_TERMS]
+        if not query_terms or not len(self.ids):
+            return []
+        scores = np.zeros(len(self.ids), dtype='float32')
+        matched_weight = np.zeros(len(self.ids), dtype='float32')
+        exact_match = np.zeros(len(self.ids), dtype=bool)
+        # Неизвестный индексу термин весит как самый редкий - документ его точно не покрывает
+        total_weight = 0.0
+        for term in query_terms:
+            term_id = self.terms.get(term)
+            if term_id is None:
+                total_weight += math.log(1 + (len(self.ids) + 0.5) / 0.5)
+                continue
+            idf = self.idf(term_id)
+            total_weight += idf
+            start, end = self.offsets[term_id], self.offsets[term_id + 1]
+            rows = self.rows[start:end]
+            tf = self.term_frequencies[start:end].astype('float32')
+            scores[rows] += idf * tf * (self.k1 + 1) / (tf + self._length_norm[rows])
+            matched_weight[rows] += idf
+            if term[0].isdigit():
+                exact_match[rows] = True
+
+        candidates = np.flatnonzero(scores)
+        if len(candidates) > k:
+            candidates = candidates[np.argpartition(-scores[candidates], k - 1)[:k]]
+        candidates = candidates[np.argsort(-scores[candidates], kind='stable')]
+        coverage = np.where(exact_match, 1.0, matched_weight / total_weight)
+        return [(int(self.ids[row]), float(scores[row]), float(coverage[row])) for row in candidates]
+
+    def save(self, directory):
+        with open(os.path.join(directory, 'lexical.json'), 'w', encoding='utf-8') as f:
+            json.dump({"k1": self.k1, "b": self.b, "terms": sorted(self.terms, key=self.terms.get)}, f, ensure_ascii=False)
+        np.save(os.path.join(directory, 'lexical_offsets.npy'), self.offsets)
+        np.save(os.path.join(directory, 'lexical_rows.npy'), self.rows)
+        np.save(os.path.join(directory, 'lexical_tf.npy'), self.term_frequencies)
+        np.save(os.path.join(directory, 'lexical_doc_lengths.npy'), self.doc_lengths)
+        np.save(os.path.join(directory, 'lexical_ids.npy'), self.ids)
+
+    @classmethod
+    def load(cls, directory):
+        with open(os.path.join(directory, 'lexical.json'), 'r', encoding='utf-8') as f:
+            params = json.load(f)
+
+        def load_array(name):
+            return np.load(os.path.join(directory, name), mmap_mode='r')
+
+        return cls(params['terms'], load_array('lexical_offsets.npy'), load_array('lexical_rows.npy'),
+                   load_array('lexical_tf.npy'), load_array('lexical_doc_lengths.npy'), load_array('lexical_ids.npy'),
+                   params['k1'], params['b'])
@@ -0,0 +1,219 @@
+# src/llm_gateway.py
+"""
+Обертка над клиентом OpenAI: дедлайн на весь вызов, повторы с экспоненциальной
+задержкой и джиттером, предохранитель (circuit breaker) и необязательные
+"страхующие" (hedged) запросы для медленных ответов.
+"""
+import asyncio
+import logging
+import random
+import time
+from collections import deque
+
+from openai import APIConnectionError, APITimeoutError, InternalServerError
+
+logger = logging.getLogger(__name__)
+
+# Ошибки, после которых имеет смысл повторить запрос; 429 не повторяется - бот деградирует сам
+RETRYABLE_ERRORS = (APITimeoutError, APIConnectionError, InternalServerError, asyncio.TimeoutError)
+
+
+class LLMUnavailableError(Exception):
+    """LLM не ответила в пределах дедлайна и повторов или предохранитель разомкнут."""
+
+
+class CircuitOpenError(LLMUnavailableError):
+    """Предохранитель разомкнут: запросы к LLM временно не отправляются."""
+
+
+class CircuitBreaker:
+    """
+    closed - запросы идут; после failure_threshold неудач подряд - open (запросы сразу отклоняются);
+    через reset_timeout - half-open: один пробный запрос решает, замкнуться или снова разомкнуться.
+    """
+
+    def __init__(self, failure_threshold=5, reset_timeout=30.0, clock=time.monotonic):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.clock = clock
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self.times_opened = 0
+        self._probe_in_flight = False
+
+    def allow(self):
+        if self.state == "closed":
+            return True
+        if self.state == "open" and self.clock() - self.opened_at >= self.reset_timeout:
+            self.state = "half-open"
+            self._probe_in_flight = False
+        if self.state == "half-open" and not self._probe_in_flight:
+            self._probe_in_flight = True
+            return True
+        return False
+
+    def record_success(self):
+        if self.state != "closed":
+            logger.info("Предохранитель LLM замкнут: сервис снова отвечает.")
+        self.state = "closed"
+        self.failures = 0
+        self._probe_in_flight = False
+
+    def release(self):
+        """Запрос завершился ошибкой, не говорящей о доступности сервиса - пробный слот освобождается."""
+        self._probe_in_flight = False
+
+    def record_failure(self):
+        self.failures += 1
+        if self.state == "half-open" or self.failures >= self.failure_threshold:
+            if self.state != "open":
+                self.times_opened += 1
+                logger.warning(f"Предохранитель LLM разомкнут после {self.failures} неудач подряд.")
+            self.state = "open"
+            self.opened_at = self.clock()
+            self._probe_in_flight = False
+
+
+class LLMGateway:
+    """Единая точка вызова chat completions с политиками отказоустойчивости."""
+
+    def __init__(self, client, model, deadline_seconds=30.0, attempt_timeout=20.0, max_retries=2,
+                 backoff_base=0.5, backoff_max=4.0, breaker=None, hedge_percentile=0.0,
+                 hedge_min_samples=20, latency_window=200):
+        self.client = client
+        self.model = model
+        self.deadline_seconds = deadline_seconds
+        self.attempt_timeout = attempt_timeout
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.breaker = breaker or CircuitBreaker()
+        # Страхующий запрос отправляется, если первый не ответил за этот перцентиль задержки (0 - отключено)
+        self.hedge_percentile = hedge_percentile
+        self.hedge_min_samples = hedge_min_samples
+        self._latencies = deque(maxlen=latency_window)
+        # Счетчики
+        self.calls = 0
+        self.attempts = 0
+        self.retries = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+        self.failures = 0
+        self.rejected_by_breaker = 0
+        # Число ошибок попыток по классу исключения
+        self.errors = {}
+
+    def _hedge_delay(self):
+        if not self.hedge_percentile or len(self._latencies) < self.hedge_min_samples:
+            return None
+        latencies = sorted(self._latencies)
+        return latencies[min(len(latencies) - 1, int(self.hedge_percentile * len(latencies)))]
+
+    def _backoff(self, attempt):
+        # "Full jitter": случайная задержка от 0 до экспоненциальной границы
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** attempt)))
+
+    def _count_error(self, error):
+        name = type(error).__name__
+        self.errors[name] = self.errors.get(name, 0) + 1
+
+    async def _attempt(self, deadline, **request):
+        timeout = min(self.attempt_timeout, deadline - time.monotonic())
+        if timeout <= 0:
+            raise asyncio.TimeoutError()
+        self.attempts += 1
+        started = time.monotonic()
+        response = await asyncio.wait_for(
+            self.client.chat.completions.create(model=self.model, timeout=timeout, **request), timeout
+        )
+        if not request.get("stream"):
+            self._latencies.append(time.monotonic() - started)
+        return response
+
+    async def _hedged_attempt(self, deadline, **request):
+        """Попытка со страховкой: если ответа нет дольше обычного, параллельно идет второй запрос."""
+        hedge_delay = self._hedge_delay()
+        primary = asyncio.ensure_future(self._attempt(deadline, **request))
+        if hedge_delay is None or request.get("stream"):
+            return await primary
+        done, _ = await asyncio.wait({primary}, timeout=hedge_delay)
+        if done:
+            return primary.result()
+        self.hedges += 1
+        hedge = asyncio.ensure_future(self._attempt(deadline, **request))
+        pending = {primary, hedge}
+        error = None
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is hedge:
+                            self.hedge_wins += 1
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            for task in pending:
+                task.cancel()
+
+    async def _call(self, **request):
+        self.calls += 1
+        if not self.breaker.allow():
+            self.rejected_by_breaker += 1
+            raise CircuitOpenError("Предохранитель LLM разомкнут")
+        deadline = time.monotonic() + self.deadline_seconds
+        last_error = None
+        for attempt in range(self.max_retries + 1):
+            try:
+                response = await self._hedged_attempt(deadline, **request)
+            except RETRYABLE_ERRORS as e:
+                last_error = e
+                self._count_error(e)
+                pause = self._backoff(attempt)
+                if attempt == self.max_retries or time.monotonic() + pause >= deadline:
+                    break
+                self.retries += 1
+                logger.warning(f"Запрос к LLM не удался ({type(e).__name__}), повтор через {pause:.2f} с.")
+                await asyncio.sleep(pause)
+                continue
+            except Exception as e:
+                # Ошибки запроса (авторизация, 429, неверные параметры) повтором не лечатся
+                # и о недоступности сервиса не говорят
+                self._count_error(e)
+                self.breaker.release()
+                raise
+            self.breaker.record_success()
+            return response
+        self.failures += 1
+        self.breaker.record_failure()
+        raise LLMUnavailableError(f"LLM недоступна: {type(last_error).__name__}: {last_error}")
+
+    async def complete(self, messages, max_tokens, temperature=0.2):
+        """Обычный (непотоковый) ответ; возвращает ChatCompletion."""
+        return await self._call(messages=messages, max_tokens=max_tokens, temperature=temperature)
+
+    async def stream(self, messages, max_tokens, temperature=0.2):
+        """
+        Открывает поток ответа. Повторы и дедлайн действуют до получения потока;
+        разрыв посреди генерации не повторяется - часть ответа пользователь уже видит.
+        """
+        return await self._call(messages=messages, max_tokens=max_tokens, temperature=temperature,
+                                stream=True, stream_options={"include_usage": True})
+
+    def stats(self):
+        latencies = sorted(self._latencies)
+        return {
+            "calls": self.calls,
+            "attempts": self.attempts,
+            "retries": self.retries,
+            "hedges": self.hedges,
+            "hedge_wins": self.hedge_wins,
+            "failures": self.failures,
+            "rejected_by_breaker": self.rejected_by_breaker,
+            "breaker_state": self.breaker.state,
+            "breaker_opened": self.breaker.times_opened,
+            "latency_p50_s": latencies[len(latencies) // 2] if latencies else 0.0,
+            "hedge_delay_s": self._hedge_delay(),
+        }
@@ -0,0 +1,301 @@
+# src/load_test.py
+"""
+Нагрузочный тест одного процесса бота без Telegram и OpenAI. Синтетические пользователи
+приходят с заданной интенсивностью (поток Пуассона), пишут /start, задают вопросы из заданного
+набора и проходят диалог /recommend. Обновления идут через то же приложение, что и в бою
+(обработчики, ConversationHandler), ответы бота принимает заглушка Bot API из fake_updates.py,
+а LLM отвечает заглушка stub_llm_server.py с заданной задержкой и долей ошибок.
+
+Отчет (JSON) содержит пропускную способность, исходы вопросов, перцентили задержки ответа
+по типу сообщения и по этапам обработки (из трасс запросов) и задержку event loop - так
+изменения конкурентности и кэширования можно сравнивать от прогона к прогону:
+    python src/load_test.py --rate 5 --users 200 --output load_report.json
+    python src/load_test.py --rate 5 --users 200 --output new.json --baseline load_report.json
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import time
+
+from telegram import Update
+
+from benchmark import percentiles
+from fake_updates import RECOMMEND_ANSWERS, SAMPLE_QUESTIONS, FakeBotAPI, make_message_update
+from stub_llm_server import StubOptions, start_stub_server
+
+DEFAULT_REPORT_PATH = 'load_report.json'
+# Уточняющие вопросы к предыдущему ответу (проверка памяти диалога)
+FOLLOW_UP_QUESTIONS = (
+    "А на второй программе?",
+    "А там есть общежитие?",
+    "А сколько это стоит?",
+)
+# Период проверки задержки event loop (сек.)
+LOOP_LAG_INTERVAL = 0.01
+
+
+def load_questions(path, field=None):
+    """
+    Вопросы из файла: JSON-список строк или объектов либо JSONL (по объекту на строку).
+    Из объекта берется поле field, по умолчанию первое из question, text, title.
+    """
+    with open(path, 'r', encoding='utf-8') as f:
+        if path.endswith('.jsonl'):
+            items = [json.loads(line) for line in f if line.strip()]
+        else:
+            items = json.load(f)
+    questions = []
+    for item in items:
+        if isinstance(item, dict):
+            keys = (field,) if field else ('question', 'text', 'title')
+            item = next((item[key] for key in keys if item.get(key)), None)
+        if isinstance(item, str) and item.strip():
+            questions.append(item.strip())
+    if not questions:
+        raise ValueError(f"В {path} нет вопросов")
+    return questions
+
+
+def user_script(questions, num_questions, recommend, follow_up_share, rng):
+    """Тексты сообщений одного пользователя с типом каждого: start, question, follow_up, recommend."""
+    script = [("start", "/start")]
+    for _ in range(num_questions):
+        script.append(("question", rng.choice(questions)))
+        if rng.random() < follow_up_share:
+            script.append(("follow_up", rng.choice(FOLLOW_UP_QUESTIONS)))
+    if recommend:
+        script.append(("recommend", "/recommend"))
+        script += [("recommend", answer) for answer in RECOMMEND_ANSWERS]
+    return script
+
+
+class TraceCollector(logging.Handler):
+    """Собирает трассы запросов (JSON-строки логгера trace): исходы, полное время и этапы."""
+
+    def __init__(self):
+        super().__init__(logging.INFO)
+        self.outcomes = {}
+        self.totals = {}  # исход -> [сек.]
+        self.stages = {}  # этап -> [сек.]
+        self.rewritten = 0
+
+    def emit(self, record):
+        try:
+            trace = json.loads(record.getMessage())
+        except ValueError:
+            return
+        outcome = trace.get("outcome")
+        self.outcomes[outcome] = self.outcomes.get(outcome, 0) + 1
+        self.totals.setdefault(outcome, []).append(trace["total_ms"] / 1000)
+        for span in trace.get("spans", ()):
+            self.stages.setdefault(span["stage"], []).append(span["duration_ms"] / 1000)
+        self.rewritten += int(bool(trace.get("query_rewritten")))
+
+
+async def monitor_loop_lag(samples, stop_event, interval=LOOP_LAG_INTERVAL):
+    """Задержка event loop: насколько позже заданного просыпается sleep(interval)."""
+    loop = asyncio.get_running_loop()
+    while not stop_event.is_set():
+        started = loop.time()
+        await asyncio.sleep(interval)
+        samples.append(max(0.0, loop.time() - started - interval))
+
+
+async def run_user(app, user_id, script, think_time, rng, latencies, errors):
+    """Проигрывает сессию пользователя: следующее сообщение - после ответа бота и паузы."""
+    for kind, text in script:
+        update = Update.de_json(make_message_update(user_id, text), app.bot)
+        started = time.perf_counter()
+        try:
+            await app.process_update(update)
+        except Exception as e:
+            errors[type(e).__name__] = errors.get(type(e).__name__, 0) + 1
+            continue
+        latencies.setdefault(kind, []).append(time.perf_counter() - started)
+        if think_time > 0:
+            await asyncio.sleep(rng.uniform(0.5, 1.5) * think_time)
+
+
+async def run_load_test(args, questions):
+    # Бот читает настройки при импорте - адреса заглушек задаются до него
+    import bot
+
+    app = bot.build_application(with_updater=False)
+    await app.initialize()
+    await bot.post_init(app)
+    try:
+        await bot.startup_task
+    except Exception:
+        pass
+    if not bot.startup.ready:
+        raise RuntimeError(f"Бот не запустился: {bot.startup.error}")
+
+    rng = random.Random(args.seed)
+    collector = TraceCollector()
+    trace_logger = logging.getLogger("trace")
+    trace_logger.addHandler(collector)
+    trace_logger.setLevel(logging.INFO)
+    trace_logger.propagate = args.verbose
+
+    latencies, errors, loop_lag = {}, {}, []
+    stop_event = asyncio.Event()
+    lag_task = asyncio.create_task(monitor_loop_lag(loop_lag, stop_event))
+    started = time.perf_counter()
+    sessions = []
+    try:
+        for i in range(args.users):
+            script = user_script(questions, args.questions, rng.random() < args.recommend_share,
+                                 args.follow_up_share, rng)
+            sessions.append(asyncio.create_task(
+                run_user(app, 100000 + i, script, args.think_time, random.Random(rng.random()), latencies, errors)
+            ))
+            # Открытая модель нагрузки: пользователи приходят независимо от скорости ответов
+            if args.rate > 0:
+                await asyncio.sleep(rng.expovariate(args.rate))
+        await asyncio.gather(*sessions)
+    finally:
+        elapsed = time.perf_counter() - started
+        stop_event.set()
+        await lag_task
+        trace_logger.removeHandler(collector)
+        component_stats = {
+            "startup": bot.startup.stats(),
+            "request_queue": bot.request_queue.stats() if bot.request_queue else None,
+            "answer_cache": bot.answer_cache.stats() if bot.answer_cache else None,
+            "embedding_batcher": bot.embedding_batcher.stats() if bot.embedding_batcher else None,
+            "request_coalescer": bot.request_coalescer.stats(),
+            "llm_gateway": bot.llm_gateway.stats() if bot.llm_gateway else None,
+            "conversation_memory": bot.conversation_memory.stats(),
+        }
+        await app.shutdown()
+        await bot.post_shutdown(app)
+
+    updates = sum(len(samples) for samples in latencies.values())
+    answered = sum(count for outcome, count in collector.outcomes.items() if outcome in bot.ANSWERED_OUTCOMES)
+    return {
+        "config": {
+            "users": args.users, "rate": args.rate, "questions_per_user": args.questions,
+            "recommend_share": args.recommend_share, "follow_up_share": args.follow_up_share,
+            "think_time": args.think_time, "question_pool": len(questions), "seed": args.seed,
+            "llm": {"latency_ms": args.llm_latency_ms, "jitter_ms": args.llm_jitter_ms,
+                    "error_rate": args.llm_error_rate, "rate_limit_rate": args.llm_rate_limit_rate},
+            "env": {name: os.environ[name] for name in sorted(os.environ)
+                    if name.startswith(("MAX_", "USER_", "LLM_", "EMBEDDING_", "ANSWER_CACHE", "STREAM_", "MEMORY_"))},
+        },
+        "elapsed_seconds": elapsed,
+        "throughput": {
+            "updates_per_second": updates / elapsed if elapsed else 0.0,
+            "answered_per_second": answered / elapsed if elapsed else 0.0,
+        },
+        "outcomes": collector.outcomes,
+        "queries_rewritten": collector.rewritten,
+        "errors": errors,
+        "latency": {kind: percentiles(samples) for kind, samples in latencies.items()},
+        "request_latency": {outcome: percentiles(samples) for outcome, samples in collector.totals.items()},
+        "stages": {stage: percentiles(samples) for stage, samples in collector.stages.items()},
+        "loop_lag": percentiles(loop_lag) | {"max_ms": max(loop_lag, default=0.0) * 1000},
+        "components": component_stats,
+    }
+
+
+def compare_reports(report, baseline):
+    """Строки сравнения с базовым отчетом: пропускная способность и p95 по типам и этапам."""
+    lines = []
+    for name, value in report["throughput"].items():
+        base = baseline.get("throughput", {}).get(name)
+        if base:
+            lines.append(f"{name}: {base:.2f} -> {value:.2f} ({(value / base - 1) * 100:+.0f}%)")
+    for section in ("latency", "stages", "loop_lag"):
+        current_section = report[section] if section != "loop_lag" else {"loop_lag": report[section]}
+        base_section = baseline.get(section, {}) if section != "loop_lag" else {"loop_lag": baseline.get(section, {})}
+        for name, current in current_section.items():
+            base_p95 = base_section.get(name, {}).get("p95_ms")
+            if base_p95:
+                lines.append(f"{name} p95: {base_p95:.1f} мс -> {current['p95_ms']:.1f} мс "
+                             f"({(current['p95_ms'] / base_p95 - 1) * 100:+.0f}%)")
+    return lines
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description="Нагрузочный тест бота с заглушками Telegram и LLM")
+    arg_parser.add_argument('--users', type=int, default=100, help="Число синтетических пользователей")
+    arg_parser.add_argument('--rate', type=float, default=5.0, help="Новых пользователей в секунду (0 - все сразу)")
+    arg_parser.add_argument('--questions', type=int, default=3, help="Вопросов на пользователя")
+    arg_parser.add_argument('--questions-file', help="JSON или JSONL с вопросами (например, benchmarks/fixtures/questions.json)")
+    arg_parser.add_argument('--questions-field', help="Поле вопроса в объектах файла")
+    arg_parser.add_argument('--recommend-share', type=float, default=0.3, help="Доля пользователей, проходящих /recommend")
+    arg_parser.add_argument('--follow-up-share', type=float, default=0.2, help="Вероятность уточняющего вопроса после вопроса")
+    arg_parser.add_argument('--think-time', type=float, default=1.0, help="Средняя пауза пользователя между сообщениями (сек.)")
+    arg_parser.add_argument('--llm-latency-ms', type=float, default=300.0, help="Задержка заглушки LLM")
+    arg_parser.add_argument('--llm-jitter-ms', type=float, default=200.0, help="Случайная добавка к задержке LLM")
+    arg_parser.add_argument('--llm-token-delay-ms', type=float, default=20.0, help="Пауза между фрагментами потока")
+    arg_parser.add_argument('--llm-error-rate', type=float, default=0.0, help="Доля ответов LLM 500")
+    arg_parser.add_argument('--llm-rate-limit-rate', type=float, default=0.0, help="Доля ответов LLM 429")
+    arg_parser.add_argument('--seed', type=int, default=0)
+    arg_parser.add_argument('--output', default=DEFAULT_REPORT_PATH, help="Куда сохранить JSON-отчет")
+    arg_parser.add_argument('--baseline', help="Отчет прошлого прогона для сравнения")
+    arg_parser.add_argument('--verbose', action='store_true', help="Не скрывать журнал бота и трассы запросов")
+    args = arg_parser.parse_args()
+
+    questions = load_questions(args.questions_file, args.questions_field) if args.questions_file else list(SAMPLE_QUESTIONS)
+
+    # Заглушки на свободных портах; бот подключается к ним через переменные окружения
+    llm_server = start_stub_server(port=0, options=StubOptions(
+        args.llm_latency_ms, args.llm_jitter_ms, args.llm_token_delay_ms, args.llm_error_rate,
+        args.llm_rate_limit_rate,
+    ))
+    bot_api = FakeBotAPI().start(port=0)
+    os.environ.update(
+        OPENAI_BASE_URL=f"http://127.0.0.1:{llm_server.server_address[1]}/v1",
+        TELEGRAM_API_URL=f"http://127.0.0.1:{bot_api.server.server_address[1]}/bot",
+    )
+    os.environ.setdefault("TELEGRAM_BOT_TOKEN", "123456:load-test")
+    os.environ.setdefault("OPENAI_API_KEY", "stub")
+    # Без записи состояния на диск и без эндпоинта метрик - они не относятся к измеряемому пути
+    os.environ.setdefault("PERSISTENCE_PATH", "")
+    os.environ.setdefault("METRICS_PORT", "0")
+    # Синтетические пользователи пишут чаще живых: лимит на пользователя измерял бы сам себя
+    os.environ.setdefault("USER_RATE_PER_MINUTE", "0")
+
+    try:
+        import bot  # noqa: F401 - настраивает журнал при импорте
+        if not args.verbose:
+            logging.getLogger().setLevel(logging.WARNING)
+            logging.getLogger("httpx").setLevel(logging.WARNING)
+        report = asyncio.run(run_load_test(args, questions))
+    finally:
+        bot_api.stop()
+        llm_server.shutdown()
+        llm_server.server_close()
+
+    os.makedirs(os.path.dirname(args.output) or '.', exist_ok=True)
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=4)
+
+    print(f"Пользователей: {args.users}, сообщений обработано за {report['elapsed_seconds']:.1f} с: "
+          f"{report['throughput']['updates_per_second']:.2f}/с, ответов на вопросы: "
+          f"{report['throughput']['answered_per_second']:.2f}/с")
+    print(f"Исходы вопросов: {report['outcomes']}, переписано уточнений: {report['queries_rewritten']}")
+    if report["errors"]:
+        print(f"Ошибки обработки: {report['errors']}")
+    for title, section in (("Ответ", report["latency"]), ("Этап", report["stages"])):
+        for name, latency in section.items():
+            print(f"{title} {name}: p50={latency['p50_ms']:.1f} мс, p95={latency['p95_ms']:.1f} мс, "
+                  f"p99={latency['p99_ms']:.1f} мс ({latency['count']})")
+    lag = report["loop_lag"]
+    print(f"Задержка event loop: p50={lag['p50_ms']:.2f} мс, p99={lag['p99_ms']:.2f} мс, max={lag['max_ms']:.2f} мс")
+    print(f"Отчет сохранен в {args.output}")
+
+    if args.baseline:
+        with open(args.baseline, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)
+        print("Сравнение с базовым отчетом:")
+        for line in compare_reports(report, baseline):
+            print(f"  {line}")
+
+
+if __name__ == "__main__":
+    main()
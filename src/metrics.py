@@ -0,0 +1,280 @@
+# src/metrics.py
+"""
+Метрики в текстовом формате Prometheus (счетчики, измерители, гистограммы),
+локальный HTTP-эндпоинт /metrics и трассировка запроса по этапам.
+Все обновления метрик выполняются из event loop бота, поэтому блокировки не нужны.
+"""
+import asyncio
+import contextlib
+import json
+import logging
+import math
+import time
+import uuid
+
+logger = logging.getLogger(__name__)
+# Отдельный логгер для трасс: его уровень и вывод настраиваются независимо от остального лога
+trace_logger = logging.getLogger("trace")
+
+# Границы корзин гистограмм задержек (сек.): от этапов меньше миллисекунды до ответа LLM
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def _format_value(value):
+    value = float(value)
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    if math.isnan(value):
+        return "NaN"
+    return str(int(value)) if value.is_integer() else repr(value)
+
+
+def _escape_label_value(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape_label_value(value)}"' for name, value in labels.items()) + "}"
+
+
+class _Metric:
+    type_name = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"Метрика {self.name} ожидает метки {self.labelnames}, получено {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def _labels(self, key):
+        return dict(zip(self.labelnames, key))
+
+    def samples(self):
+        for key, value in self._values.items():
+            yield self.name, self._labels(key), value
+
+
+class Counter(_Metric):
+    """Монотонно растущий счетчик (имя по соглашению оканчивается на _total)."""
+    type_name = "counter"
+
+    def inc(self, amount=1.0, **labels):
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0.0) + amount
+
+    def value(self, **labels):
+        return self._values.get(self._key(labels), 0.0)
+
+
+class Gauge(_Metric):
+    """Значение, которое может как расти, так и уменьшаться."""
+    type_name = "gauge"
+
+    def set(self, value, **labels):
+        self._values[self._key(labels)] = float(value)
+
+    def inc(self, amount=1.0, **labels):
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0.0) + amount
+
+    def dec(self, amount=1.0, **labels):
+        self.inc(-amount, **labels)
+
+
+class Histogram(_Metric):
+    """Гистограмма с накопительными корзинами: по ней Prometheus считает перцентили (histogram_quantile)."""
+    type_name = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        state = self._values.get(key)
+        if state is None:
+            # Счетчики по корзинам (последняя - +Inf), сумма и число наблюдений
+            state = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        counts = state[0]
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                counts[i] += 1
+                break
+        else:
+            counts[-1] += 1
+        state[1] += value
+        state[2] += 1
+
+    def samples(self):
+        for key, (counts, total, count) in self._values.items():
+            labels = self._labels(key)
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (math.inf,), counts):
+                cumulative += bucket_count
+                yield f"{self.name}_bucket", {**labels, "le": _format_value(float(bound))}, cumulative
+            yield f"{self.name}_sum", labels, total
+            yield f"{self.name}_count", labels, count
+
+
+class Registry:
+    """
+    Набор метрик и сборщиков. Сборщик - функция без аргументов, возвращающая
+    (имя, тип, метки, значение) для снимков, которые компоненты уже считают сами (stats()).
+    """
+
+    def __init__(self):
+        self._metrics = {}
+        self._collectors = []
+
+    def _register(self, metric):
+        if metric.name in self._metrics:
+            raise ValueError(f"Метрика {metric.name} уже зарегистрирована")
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name, documentation, labelnames=()):
+        return self._register(Gauge(name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        return self._register(Histogram(name, documentation, labelnames, buckets))
+
+    def register_collector(self, collector):
+        self._collectors.append(collector)
+
+    def render(self):
+        """Все метрики в текстовом формате Prometheus 0.0.4."""
+        lines = []
+        for metric in self._metrics.values():
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.type_name}")
+            for name, labels, value in metric.samples():
+                lines.append(f"{name}{_format_labels(labels)} {_format_value(value)}")
+
+        # Образцы сборщиков группируются по имени: строка TYPE должна идти один раз перед всеми образцами
+        collected = {}
+        for collector in self._collectors:
+            try:
+                for name, type_name, labels, value in collector():
+                    collected.setdefault(name, (type_name, []))[1].append((labels, value))
+            except Exception as e:
+                logger.error(f"Ошибка сборщика метрик: {e}", exc_info=True)
+        for name, (type_name, samples) in collected.items():
+            lines.append(f"# TYPE {name} {type_name}")
+            for labels, value in samples:
+                lines.append(f"{name}{_format_labels(labels)} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+
+def stats_samples(prefix, stats, labels=None):
+    """Числовые поля снимка stats() как измерители prefix_<поле>; нечисловые поля пропускаются."""
+    for field, value in stats.items():
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            yield f"{prefix}_{field}", "gauge", labels or {}, value
+
+
+async def start_metrics_server(registry, host="127.0.0.1", port=9108):
+    """
+    Минимальный HTTP-сервер на asyncio: GET /metrics - метрики, GET /healthz - проверка живости.
+    Возвращает asyncio.Server (server.close() для остановки).
+    """
+
+    async def handle(reader, writer):
+        try:
+            request_line = await asyncio.wait_for(reader.readline(), timeout=5)
+            # Заголовки запроса не нужны - дочитываем их до пустой строки
+            while (await asyncio.wait_for(reader.readline(), timeout=5)) not in (b"\r\n", b"\n", b""):
+                pass
+            parts = request_line.decode("latin-1").split()
+            path = parts[1].split("?", 1)[0] if len(parts) >= 2 else ""
+            if len(parts) >= 2 and parts[0] != "GET":
+                status, body = "405 Method Not Allowed", b"method not allowed\n"
+            elif path == "/metrics":
+                status, body = "200 OK", registry.render().encode("utf-8")
+            elif path == "/healthz":
+                status, body = "200 OK", b"ok\n"
+            else:
+                status, body = "404 Not Found", b"not found\n"
+            writer.write(
+                f"HTTP/1.1 {status}\r\nContent-Type: {CONTENT_TYPE}\r\n"
+                f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode("latin-1") + body
+            )
+            await writer.drain()
+        except (asyncio.TimeoutError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    return await asyncio.start_server(handle, host, port)
+
+
+class RequestTrace:
+    """
+    Трасса одного запроса: этапы (span) с началом относительно начала запроса и длительностью.
+    Длительность каждого этапа попадает в гистограмму этапов, а по завершении трасса
+    пишется в лог одной JSON-строкой - по ней видно, куда ушло время конкретного медленного запроса.
+    """
+
+    def __init__(self, stage_histogram=None, request_histogram=None, log_threshold_ms=0.0, started_at=None,
+                 **attributes):
+        self.trace_id = uuid.uuid4().hex[:16]
+        self.started_at = started_at if started_at is not None else time.perf_counter()
+        self.stage_histogram = stage_histogram
+        self.request_histogram = request_histogram
+        self.log_threshold_ms = log_threshold_ms
+        self.attributes = attributes
+        self.spans = []
+        self.outcome = None
+
+    @contextlib.contextmanager
+    def span(self, stage, **attributes):
+        """Замер этапа: with trace.span("encode"): ... Исключение записывается в атрибут error."""
+        started = time.perf_counter()
+        try:
+            yield
+        except BaseException as e:
+            attributes["error"] = type(e).__name__
+            raise
+        finally:
+            self.add_span(stage, started, time.perf_counter() - started, **attributes)
+
+    def add_span(self, stage, started, duration, **attributes):
+        """Этап, длительность которого измерена в другом месте (например, этапы hybrid_retrieve)."""
+        self.spans.append({
+            "stage": stage,
+            "start_ms": round((started - self.started_at) * 1000, 3),
+            "duration_ms": round(duration * 1000, 3),
+            **attributes,
+        })
+        if self.stage_histogram is not None:
+            self.stage_histogram.observe(duration, stage=stage)
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def finish(self, outcome):
+        """Завершает трассу один раз: итоговая длительность в гистограмму запросов, трасса - в лог."""
+        if self.outcome is not None:
+            return
+        self.outcome = outcome
+        total = time.perf_counter() - self.started_at
+        if self.request_histogram is not None:
+            self.request_histogram.observe(total, outcome=outcome)
+        if total * 1000 >= self.log_threshold_ms and trace_logger.isEnabledFor(logging.INFO):
+            trace_logger.info(json.dumps({
+                "trace_id": self.trace_id,
+                "outcome": outcome,
+                "total_ms": round(total * 1000, 3),
+                **self.attributes,
+                "spans": self.spans,
+            }, ensure_ascii=False, default=str))
@@ -1,6 +1,14 @@
 # src/parser.py
 import requests
-from bs4 import BeautifulSoup
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from bs4 import BeautifulSoup, Tag
+import lxml.html
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
+import argparse
+import hashlib
+import threading
 import json
 import time
 import re
@@ -9,6 +17,96 @@ import os
 # Убедимся, что папка data существует
 os.makedirs('data', exist_ok=True)
 
+# Список программ по умолчанию; расширенный список можно передать через --programs
+DEFAULT_PROGRAMS = [
+    {
+        "name": "Искусственный интеллект",
+        "url": "https://abit.itmo.ru/program/master/ai"
+    },
+    {
+        "name": "AI и ML в технических системах",
+        "url": "https://abit.itmo.ru/program/master/ai_product"
+    }
+]
+# Кэш страниц: HTML, ETag/Last-Modified и результат разбора
+HTML_CACHE_DIR = 'data/html_cache'
+CRAWL_WORKERS = 8  # Общее число параллельных загрузок
+PER_HOST_CONCURRENCY = 2  # Не больше стольких одновременных запросов к одному хосту
+PER_HOST_DELAY = 0.5  # Минимальная пауза между запросами к одному хосту (сек.)
+REQUEST_TIMEOUT = 20
+USER_AGENT = 'itmo-ai-chatbot-crawler/1.0'
+
+
+class HostThrottle:
+    """Вежливость по отношению к сайту: ограничивает параллельность и частоту запросов к одному хосту."""
+
+    def __init__(self, concurrency=PER_HOST_CONCURRENCY, delay=PER_HOST_DELAY):
+        self.concurrency = concurrency
+        self.delay = delay
+        self._lock = threading.Lock()
+        self._semaphores = {}
+        self._next_request_at = {}
+
+    def _semaphore(self, host):
+        with self._lock:
+            if host not in self._semaphores:
+                self._semaphores[host] = threading.BoundedSemaphore(self.concurrency)
+            return self._semaphores[host]
+
+    def _wait_turn(self, host):
+        with self._lock:
+            now = time.monotonic()
+            request_at = max(now, self._next_request_at.get(host, 0.0))
+            self._next_request_at[host] = request_at + self.delay
+        if request_at > now:
+            time.sleep(request_at - now)
+
+    def request(self, url, fn):
+        """Выполняет fn() с учетом ограничений для хоста url."""
+        host = urlparse(url).netloc
+        with self._semaphore(host):
+            self._wait_turn(host)
+            return fn()
+
+
+class PageCache:
+    """Дисковый кэш страниц с валидаторами для условных запросов."""
+
+    def __init__(self, cache_dir=HTML_CACHE_DIR):
+        self.cache_dir = cache_dir
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _path(self, url, suffix):
+        return os.path.join(self.cache_dir, hashlib.sha1(url.encode('utf-8')).hexdigest() + suffix)
+
+    def load(self, url):
+        """Возвращает (метаданные, html) из кэша или (None, None)."""
+        meta_path, html_path = self._path(url, '.json'), self._path(url, '.html')
+        if not (os.path.exists(meta_path) and os.path.exists(html_path)):
+            return None, None
+        with open(meta_path, 'r', encoding='utf-8') as f:
+            meta = json.load(f)
+        with open(html_path, 'r', encoding='utf-8') as f:
+            html = f.read()
+        return meta, html
+
+    def save(self, url, html, meta):
+        with open(self._path(url, '.html'), 'w', encoding='utf-8') as f:
+            f.write(html)
+        with open(self._path(url, '.json'), 'w', encoding='utf-8') as f:
+            json.dump(meta, f, ensure_ascii=False, indent=4)
+
+
+def create_session(pool_size=CRAWL_WORKERS):
+    """HTTP-сессия с пулом keep-alive соединений и повторами при временных ошибках."""
+    session = requests.Session()
+    retry = Retry(total=3, backoff_factor=0.5, status_forcelist=(429, 500, 502, 503, 504), respect_retry_after_header=True)
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    session.headers['User-Agent'] = USER_AGENT
+    return session
+
 def clean_text(text):
     """Очищает текст от лишних пробелов и символов."""
     if not isinstance(text, str):
@@ -17,163 +115,321 @@ def clean_text(text):
     cleaned = re.sub(r'\s+', ' ', text.strip())
     return cleaned
 
-def parse_program(url, program_name):
+# Схема разделов страницы: заголовок h2 (в нижнем регистре) -> (поле в данных, способ извлечения)
+# text - текст соседних элементов до следующего h2, companies - логотипы компаний,
+# directions - коды и названия направлений подготовки
+SECTION_SCHEMA = {
+    'о программе': ('about', 'text'),
+    'карьера': ('career', 'text'),
+    'ты сможешь работать в компаниях': ('companies', 'companies'),
+    'направления подготовки': ('directions', 'directions'),
+    'стипендии': ('scholarships', 'text'),
+    'международные возможности': ('international', 'text'),
+}
+SECTION_KINDS = ('text', 'companies', 'directions')
+# Ссылки, которые не относятся к содержимому раздела
+SKIP_LINK_TEXT = 'Показать все'
+
+
+class _SoupTree:
+    """Доступ к дереву BeautifulSoup для извлечения разделов."""
+
+    @staticmethod
+    def parse(html):
+        return BeautifulSoup(html, 'lxml')
+
+    @staticmethod
+    def iter_elements(root):
+        return (node for node in root.descendants if isinstance(node, Tag))
+
+    @staticmethod
+    def tag(element):
+        return element.name
+
+    @staticmethod
+    def parent_key(element):
+        return id(element.parent)
+
+    @staticmethod
+    def text(element):
+        return element.get_text(strip=False)
+
+    @staticmethod
+    def stripped_text(element):
+        return element.get_text(strip=True)
+
+    @staticmethod
+    def parent(element):
+        return element.find_parent()
+
+    @staticmethod
+    def find_code(element):
+        return element.find(['h5', 'strong'])
+
+
+class _LxmlTree:
+    """Быстрый путь: чистый lxml без построения дерева BeautifulSoup."""
+
+    @staticmethod
+    def parse(html):
+        return lxml.html.fromstring(html)
+
+    @staticmethod
+    def iter_elements(root):
+        # Комментарии и инструкции обработки имеют нестроковый tag
+        return (element for element in root.iter() if isinstance(element.tag, str))
+
+    @staticmethod
+    def tag(element):
+        return element.tag
+
+    @staticmethod
+    def parent_key(element):
+        # Сам объект-родитель как ключ: lxml переиспользует прокси, пока на него есть ссылка
+        return element.getparent()
+
+    @staticmethod
+    def text(element):
+        return element.text_content()
+
+    @staticmethod
+    def stripped_text(element):
+        return ''.join(piece.strip() for piece in element.itertext())
+
+    @staticmethod
+    def parent(element):
+        return element.getparent()
+
+    @staticmethod
+    def find_code(element):
+        return next(element.iterdescendants('h5', 'strong'), None)
+
+
+PARSER_BACKENDS = {'bs4': _SoupTree, 'lxml': _LxmlTree}
+
+
+def load_section_schema(filepath):
+    """Загружает схему разделов из JSON: {"заголовок": ["поле", "text|companies|directions"], ...}."""
+    with open(filepath, 'r', encoding='utf-8') as f:
+        raw_schema = json.load(f)
+    schema = {}
+    for heading, (field, kind) in raw_schema.items():
+        if kind not in SECTION_KINDS:
+            raise ValueError(f"Неизвестный тип раздела '{kind}' для заголовка '{heading}'")
+        schema[clean_text(heading).lower()] = (field, kind)
+    return schema
+
+def extract_sections(root, tree, schema=SECTION_SCHEMA):
+    """
+    Один проход по документу: каждому h2 из схемы сопоставляются элементы его раздела.
+    Для text/directions это соседи заголовка до следующего h2, для companies - все
+    изображения после заголовка до следующего h2 в порядке документа.
+    Возвращает {поле: (тип, заголовок, [элементы])}.
+    """
+    sections = {}
+    open_by_parent = {}  # родитель -> поле раздела, чей заголовок последним встретился среди его детей
+    document_field = None  # раздел, в котором сейчас находится обход в порядке документа
+    for element in tree.iter_elements(root):
+        tag = tree.tag(element)
+        parent_key = tree.parent_key(element)
+        if tag == 'h2':
+            heading = clean_text(tree.text(element))
+            field, kind = schema.get(heading.lower(), (None, None))
+            if field in sections:
+                field = None  # учитывается только первый заголовок с таким названием
+            elif field:
+                sections[field] = (kind, heading, [])
+            open_by_parent[parent_key] = field
+            document_field = field
+            continue
+
+        field = open_by_parent.get(parent_key)
+        if field and sections[field][0] in ('text', 'directions'):
+            sections[field][2].append(element)
+        if tag == 'img' and document_field and sections[document_field][0] == 'companies':
+            sections[document_field][2].append(element)
+    return sections
+
+def _is_skip_link(tree, element):
+    return tree.tag(element) == 'a' and tree.stripped_text(element) == SKIP_LINK_TEXT
+
+def _section_text(tree, elements):
+    content = []
+    for element in elements:
+        # Исправление: игнорируем ссылки "Показать все"
+        if _is_skip_link(tree, element):
+            continue
+        text = tree.text(element)
+        if text:
+            content.append(text)
+    return clean_text(' '.join(content))
+
+def _section_companies(tree, images, heading):
+    companies = []
+    for img in images:
+        alt_text = img.get('alt')
+        if alt_text:
+            companies.append(clean_text(alt_text))
+        else:
+            # Если нет alt, пробуем найти текст рядом
+            parent_text = tree.stripped_text(tree.parent(img))
+            if parent_text and parent_text != heading:
+                companies.append(clean_text(parent_text))
+    return list(dict.fromkeys(filter(None, companies)))  # Убираем дубликаты и пустые, сохраняя порядок
+
+def _section_directions(tree, elements):
+    directions = []
+    for item in elements:
+        # Исправление: игнорируем ссылки "Показать все"
+        if _is_skip_link(tree, item) or tree.tag(item) not in ('div', 'p'):
+            continue
+        # Ищем код направления (обычно в h5 или strong)
+        code_elem = tree.find_code(item)
+        if code_elem is not None:
+            current_code = clean_text(tree.stripped_text(code_elem))
+            # Простая логика: берем текст после кода
+            full_text = clean_text(tree.stripped_text(item))
+            if current_code and full_text.startswith(current_code):
+                name = full_text[len(current_code):].strip()
+            else:
+                name = "Название не указано"
+            directions.append({"code": current_code, "name": name})
+    return directions
+
+def parse_program(url, program_name, session=None):
     """
     Парсит информацию о магистерской программе с указанного URL.
     """
     print(f"Парсинг {program_name}...")
     try:
-        response = requests.get(url)
+        response = (session or requests).get(url, timeout=REQUEST_TIMEOUT)
         response.raise_for_status()
-        soup = BeautifulSoup(response.text, 'lxml')
     except requests.exceptions.RequestException as e:
         print(f"Ошибка при запросе к {url}: {e}")
         return None
+    return parse_program_html(response.text, url, program_name)
 
+def parse_program_html(html, url, program_name, schema=SECTION_SCHEMA, backend='bs4'):
+    """
+    Извлекает информацию о магистерской программе из HTML страницы за один проход по документу.
+    backend='lxml' разбирает страницу без построения дерева BeautifulSoup.
+    """
+    tree = PARSER_BACKENDS[backend]
+    root = tree.parse(html)
     program_data = {"name": program_name, "url": url}
 
-    # --- Извлечение ключевой информации ---
-    # О программе
-    about_section = soup.find('h2', string='о программе')
-    if about_section:
-        content = []
-        for sibling in about_section.find_next_siblings():
-            if sibling.name == 'h2':
-                break
-            # Исправление: игнорируем ссылки "Показать все"
-            if sibling.name == 'a' and sibling.get_text(strip=True) == 'Показать все':
-                continue
-            text = sibling.get_text(strip=False)
-            if text:
-                content.append(text)
-        program_data['about'] = clean_text(' '.join(content))
-
-    # Карьера
-    career_section = soup.find('h2', string='Карьера')
-    if career_section:
-        content = []
-        for sibling in career_section.find_next_siblings():
-            if sibling.name == 'h2':
-                break
-            # Исправление: игнорируем ссылки "Показать все"
-            if sibling.name == 'a' and sibling.get_text(strip=True) == 'Показать все':
-                continue
-            text = sibling.get_text(strip=False)
-            if text:
-                content.append(text)
-        program_data['career'] = clean_text(' '.join(content))
-
-    # Компании (ты сможешь работать в компаниях)
-    companies_section = soup.find('h2', string='ты сможешь работать в компаниях')
-    if companies_section:
-        companies = []
-        # Ищем все изображения после заголовка
-        for img in companies_section.find_all_next('img'):
-            # Проверяем, что мы все еще в секции компаний (не дошли до следующего h2)
-            current_h2 = img.find_parent()
-            while current_h2 and current_h2.name != 'h2':
-                current_h2 = current_h2.find_parent()
-            if current_h2 and current_h2.get_text() != 'ты сможешь работать в компаниях':
-                break # Вышли за пределы секции
-            
-            alt_text = img.get('alt')
-            if alt_text:
-                companies.append(clean_text(alt_text))
-            else:
-                # Если нет alt, пробуем найти текст рядом
-                parent_text = img.find_parent().get_text(strip=True)
-                if parent_text and parent_text != 'ты сможешь работать в компаниях':
-                     companies.append(clean_text(parent_text))
-                     
-        program_data['companies'] = list(set(filter(None, companies))) # Убираем дубликаты и пустые
-
-    # Направления подготовки
-    directions_section = soup.find('h2', string='направления подготовки')
-    if directions_section:
-        directions = []
-        # Ищем все блоки с направлениями
-        current_code = None
-        for item in directions_section.find_next_siblings():
-             if item.name == 'h2': # Останавливаемся на следующем h2
-                 break
-             # Исправление: игнорируем ссылки "Показать все"
-             if item.name == 'a' and item.get_text(strip=True) == 'Показать все':
-                 continue
-             if item.name in ['div', 'p']:
-                 # Ищем код направления (обычно в h5 или strong)
-                 code_elem = item.find(['h5', 'strong'])
-                 if code_elem:
-                     current_code = clean_text(code_elem.get_text(strip=True))
-                     # Ищем название направления (обычно сразу после кода или в следующем элементе)
-                     # Простая логика: берем текст после кода
-                     full_text = clean_text(item.get_text(strip=True))
-                     if current_code and full_text.startswith(current_code):
-                         name = full_text[len(current_code):].strip()
-                     else:
-                         name = "Название не указано"
-                     directions.append({"code": current_code, "name": name})
-        program_data['directions'] = directions
-
-    # Стипендии
-    scholarships_section = soup.find('h2', string='Стипендии')
-    if scholarships_section:
-        content = []
-        for sibling in scholarships_section.find_next_siblings():
-            if sibling.name == 'h2':
-                break
-            # Исправление: игнорируем ссылки "Показать все"
-            if sibling.name == 'a' and sibling.get_text(strip=True) == 'Показать все':
-                continue
-            text = sibling.get_text(strip=False)
-            if text:
-                content.append(text)
-        program_data['scholarships'] = clean_text(' '.join(content))
-
-    # Международные возможности
-    international_section = soup.find('h2', string='международные возможности')
-    if international_section:
-        content = []
-        for sibling in international_section.find_next_siblings():
-            if sibling.name == 'h2':
-                break
-            # Исправление: игнорируем ссылки "Показать все"
-            if sibling.name == 'a' and sibling.get_text(strip=True) == 'Показать все':
-                continue
-            text = sibling.get_text(strip=False)
-            if text:
-                content.append(text)
-        program_data['international'] = clean_text(' '.join(content))
+    for field, (kind, heading, elements) in extract_sections(root, tree, schema).items():
+        if kind == 'text':
+            program_data[field] = _section_text(tree, elements)
+        elif kind == 'companies':
+            program_data[field] = _section_companies(tree, elements, heading)
+        else:
+            program_data[field] = _section_directions(tree, elements)
 
     print(f"Парсинг {program_name} завершен.")
     return program_data
 
+def parser_signature(schema=SECTION_SCHEMA, backend='bs4'):
+    """Отпечаток настроек разбора: при их смене кэшированные результаты разбираются заново."""
+    payload = json.dumps({"schema": schema, "backend": backend}, ensure_ascii=False, sort_keys=True)
+    return hashlib.sha1(payload.encode('utf-8')).hexdigest()
+
+def fetch_program(session, throttle, cache, program, schema=SECTION_SCHEMA, backend='bs4'):
+    """
+    Загружает страницу программы условным запросом (ETag/Last-Modified).
+    Если страница не изменилась, возвращает сохраненный результат разбора без повторного парсинга.
+    """
+    url, program_name = program["url"], program["name"]
+    meta, cached_html = cache.load(url)
+    signature = parser_signature(schema, backend)
+    if meta and meta.get('parser_signature') != signature:
+        # Изменились схема или способ разбора - ранее разобранный результат не подходит
+        meta['parsed'] = None
+    headers = {}
+    if meta and meta.get('parsed') is not None:
+        if meta.get('etag'):
+            headers['If-None-Match'] = meta['etag']
+        if meta.get('last_modified'):
+            headers['If-Modified-Since'] = meta['last_modified']
+
+    try:
+        response = throttle.request(url, lambda: session.get(url, headers=headers, timeout=REQUEST_TIMEOUT))
+        if response.status_code == 304:
+            print(f"{program_name}: страница не изменилась (304), используется кэш.")
+            return meta['parsed']
+        response.raise_for_status()
+    except requests.exceptions.RequestException as e:
+        print(f"Ошибка при запросе к {url}: {e}")
+        if meta and meta.get('parsed') is not None:
+            print(f"{program_name}: используется ранее сохраненная версия.")
+            return meta['parsed']
+        return None
+
+    if 'charset' not in response.headers.get('Content-Type', '').lower():
+        # Без явной кодировки requests декодирует как ISO-8859-1 и кириллица ломается
+        response.encoding = response.apparent_encoding
+    html = response.text
+    content_hash = hashlib.sha1(html.encode('utf-8')).hexdigest()
+    if meta and meta.get('content_hash') == content_hash and meta.get('parsed') is not None and cached_html is not None:
+        # Сервер не поддерживает условные запросы, но содержимое то же самое
+        print(f"{program_name}: содержимое не изменилось, используется кэш.")
+        parsed = meta['parsed']
+    else:
+        print(f"Парсинг {program_name}...")
+        parsed = parse_program_html(html, url, program_name, schema, backend)
+
+    cache.save(url, html, {
+        "url": url,
+        "etag": response.headers.get('ETag'),
+        "last_modified": response.headers.get('Last-Modified'),
+        "content_hash": content_hash,
+        "fetched_at": time.strftime('%Y-%m-%dT%H:%M:%S'),
+        "parser_signature": signature,
+        "parsed": parsed,
+    })
+    return parsed
+
+def crawl_programs(programs, workers=CRAWL_WORKERS, per_host_concurrency=PER_HOST_CONCURRENCY,
+                   per_host_delay=PER_HOST_DELAY, cache_dir=HTML_CACHE_DIR, schema=SECTION_SCHEMA, backend='bs4'):
+    """Параллельно загружает программы с ограничением частоты запросов к каждому хосту."""
+    session = create_session(pool_size=workers)
+    throttle = HostThrottle(per_host_concurrency, per_host_delay)
+    cache = PageCache(cache_dir)
+    with session, ThreadPoolExecutor(max_workers=workers) as executor:
+        results = executor.map(lambda program: fetch_program(session, throttle, cache, program, schema, backend), programs)
+        # Порядок программ сохраняется
+        return [data for data in results if data]
+
+def load_program_list(filepath):
+    """Загружает список программ (JSON: [{"name": ..., "url": ...}, ...])."""
+    with open(filepath, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
 def main():
     """
     Главная функция для парсинга всех программ и сохранения данных.
     """
-    programs = [
-        {
-            "name": "Искусственный интеллект",
-            "url": "https://abit.itmo.ru/program/master/ai"
-        },
-        {
-            "name": "AI и ML в технических системах",
-            "url": "https://abit.itmo.ru/program/master/ai_product"
-        }
-    ]
-
-    all_programs_data = []
-
-    for prog in programs:
-        data = parse_program(prog["url"], prog["name"])
-        if data:
-            all_programs_data.append(data)
-        # Вежливая задержка между запросами
-        time.sleep(1)
-
-    # Сохранение данных в JSON файл
-    with open('data/programs_data.json', 'w', encoding='utf-8') as f:
+    arg_parser = argparse.ArgumentParser(description="Сбор информации о магистерских программах")
+    arg_parser.add_argument('--programs', help="JSON-файл со списком программ (по умолчанию - две программы AI)")
+    arg_parser.add_argument('--workers', type=int, default=CRAWL_WORKERS, help="Число параллельных загрузок")
+    arg_parser.add_argument('--per-host', type=int, default=PER_HOST_CONCURRENCY, help="Одновременных запросов к одному хосту")
+    arg_parser.add_argument('--delay', type=float, default=PER_HOST_DELAY, help="Пауза между запросами к одному хосту (сек.)")
+    arg_parser.add_argument('--schema', help="JSON-файл со схемой разделов (заголовок h2 -> [поле, тип])")
+    arg_parser.add_argument('--fast', action='store_true', help="Разбирать страницы чистым lxml, без BeautifulSoup")
+    args = arg_parser.parse_args()
+
+    programs = load_program_list(args.programs) if args.programs else DEFAULT_PROGRAMS
+    schema = load_section_schema(args.schema) if args.schema else SECTION_SCHEMA
+    backend = 'lxml' if args.fast else 'bs4'
+
+    started = time.perf_counter()
+    all_programs_data = crawl_programs(programs, args.workers, args.per_host, args.delay, schema=schema, backend=backend)
+    print(f"Обработано {len(all_programs_data)} из {len(programs)} программ за {time.perf_counter() - started:.1f} с")
+
+    # Сохранение данных в JSON файл (через временный файл - бот может читать его на лету)
+    with open('data/programs_data.json.tmp', 'w', encoding='utf-8') as f:
         json.dump(all_programs_data, f, ensure_ascii=False, indent=4)
+    os.replace('data/programs_data.json.tmp', 'data/programs_data.json')
     print("Все данные успешно сохранены в data/programs_data.json")
 
 if __name__ == "__main__":
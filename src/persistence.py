@@ -0,0 +1,134 @@
+# src/persistence.py
+"""
+Хранение состояния диалогов (/recommend) и context.user_data в SQLite.
+Один файл базы разделяют процессы-воркеры одного хоста, поэтому после перезапуска
+или перераспределения чатов между ними любой воркер продолжает диалог пользователя.
+Воркеры на разных хостах этот файл не видят: для них нужен общий бэкенд -
+любой наследник telegram.ext.BasePersistence.
+"""
+import asyncio
+import json
+import logging
+import os
+import sqlite3
+import threading
+
+from telegram.ext import BasePersistence, PersistenceInput
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_PERSISTENCE_PATH = 'data/bot_state.sqlite3'
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS user_data (user_id INTEGER PRIMARY KEY, data TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS chat_data (chat_id INTEGER PRIMARY KEY, data TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS bot_data (id INTEGER PRIMARY KEY CHECK (id = 0), data TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS conversations (
+    name TEXT NOT NULL, conversation_key TEXT NOT NULL, state TEXT NOT NULL,
+    PRIMARY KEY (name, conversation_key)
+);
+"""
+
+
+class SQLitePersistence(BasePersistence):
+    """
+    Данные хранятся в JSON (в user_data допустимы только JSON-совместимые значения).
+    Запросы к SQLite выполняются в отдельном потоке, чтобы не блокировать event loop.
+
+    refresh_* намеренно ничего не делают: обновления одного чата всегда приходят в один воркер
+    (маршрутизация по chat id), и его копия в памяти новее записанной в базу.
+    """
+
+    def __init__(self, path=DEFAULT_PERSISTENCE_PATH, store_data=None, update_interval=5.0):
+        super().__init__(
+            store_data=store_data or PersistenceInput(bot_data=False, chat_data=False, callback_data=False),
+            update_interval=update_interval,
+        )
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, timeout=30, check_same_thread=False, isolation_level=None)
+        # WAL: читатели не блокируют писателя, несколько процессов работают с одним файлом
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.executescript(_SCHEMA)
+
+    def _execute(self, sql, parameters=()):
+        with self._lock:
+            return self._connection.execute(sql, parameters).fetchall()
+
+    async def _run(self, sql, parameters=()):
+        return await asyncio.to_thread(self._execute, sql, parameters)
+
+    async def _load_mapping(self, table, key_column):
+        rows = await self._run(f"SELECT {key_column}, data FROM {table}")
+        return {key: json.loads(data) for key, data in rows}
+
+    # --- Данные пользователей и чатов ---
+    async def get_user_data(self):
+        return await self._load_mapping("user_data", "user_id")
+
+    async def update_user_data(self, user_id, data):
+        await self._run("INSERT OR REPLACE INTO user_data (user_id, data) VALUES (?, ?)",
+                        (user_id, json.dumps(data, ensure_ascii=False)))
+
+    async def drop_user_data(self, user_id):
+        await self._run("DELETE FROM user_data WHERE user_id = ?", (user_id,))
+
+    async def refresh_user_data(self, user_id, user_data):
+        pass
+
+    async def get_chat_data(self):
+        return await self._load_mapping("chat_data", "chat_id")
+
+    async def update_chat_data(self, chat_id, data):
+        await self._run("INSERT OR REPLACE INTO chat_data (chat_id, data) VALUES (?, ?)",
+                        (chat_id, json.dumps(data, ensure_ascii=False)))
+
+    async def drop_chat_data(self, chat_id):
+        await self._run("DELETE FROM chat_data WHERE chat_id = ?", (chat_id,))
+
+    async def refresh_chat_data(self, chat_id, chat_data):
+        pass
+
+    # --- Общие данные бота и кэш callback-данных ---
+    async def get_bot_data(self):
+        rows = await self._run("SELECT data FROM bot_data WHERE id = 0")
+        return json.loads(rows[0][0]) if rows else {}
+
+    async def update_bot_data(self, data):
+        await self._run("INSERT OR REPLACE INTO bot_data (id, data) VALUES (0, ?)",
+                        (json.dumps(data, ensure_ascii=False),))
+
+    async def refresh_bot_data(self, bot_data):
+        pass
+
+    async def get_callback_data(self):
+        # Кнопки с произвольными callback-данными бот не использует
+        return None
+
+    async def update_callback_data(self, data):
+        pass
+
+    # --- Состояния ConversationHandler ---
+    async def get_conversations(self, name):
+        rows = await self._run("SELECT conversation_key, state FROM conversations WHERE name = ?", (name,))
+        # Ключ диалога - кортеж (chat_id, user_id); в JSON он хранится списком
+        return {tuple(json.loads(key)): json.loads(state) for key, state in rows}
+
+    async def update_conversation(self, name, key, new_state):
+        if new_state is None:
+            await self._run("DELETE FROM conversations WHERE name = ? AND conversation_key = ?",
+                            (name, json.dumps(list(key))))
+        else:
+            await self._run(
+                "INSERT OR REPLACE INTO conversations (name, conversation_key, state) VALUES (?, ?, ?)",
+                (name, json.dumps(list(key)), json.dumps(new_state)),
+            )
+
+    async def flush(self):
+        """Вызывается при остановке приложения: все изменения уже записаны, закрываем соединение."""
+        with self._lock:
+            self._connection.close()
@@ -0,0 +1,197 @@
+# src/rag_pipeline.py
+import time
+from collections import deque
+
+import numpy as np
+
+from context_builder import choose_max_tokens, dedupe_chunks, pack_context
+from vector_store import search
+
+# Константа сглаживания reciprocal rank fusion (стандартное значение из литературы)
+RRF_K = 60
+
+# Бюджеты по умолчанию (токены): контекст и лимиты длины ответа
+DEFAULT_CONTEXT_TOKEN_BUDGET = 1500
+DEFAULT_ANSWER_MIN_TOKENS = 200
+DEFAULT_ANSWER_MAX_TOKENS = 800
+DEFAULT_NO_CONTEXT_ANSWER_TOKENS = 150
+
+# Системный промпт для LLM. Он не меняется от запроса к запросу (все переменные данные -
+# в сообщении пользователя), поэтому префикс запроса кэшируется на стороне провайдера
+SYSTEM_PROMPT = (
+    "Вы являетесь полезным помощником для абитуриентов, выбирающих магистерские программы "
+    "ИТМО 'Искусственный интеллект' и 'AI и ML в технических системах'. "
+    "Ваша задача - отвечать на вопросы абитуриентов на основе предоставленной информации. "
+    "Информация будет содержаться в разделе 'Контекст'. "
+    "Если в 'Контексте' нет информации для ответа на вопрос, вежливо сообщите, что не знаете ответа. "
+    "Всегда отвечайте на русском языке. "
+    "Не придумывайте факты, которых нет в контексте. "
+    "Если вопрос не по теме программ ИТМО, вежливо укажите на это. "
+    "Отвечай приветливо и вежливо. "
+    "Отвечайте, используя только информацию из контекста; если контекст не позволяет ответить, "
+    "скажите, что информации недостаточно."
+)
+# Сообщение собирается один раз при импорте
+SYSTEM_MESSAGE = {"role": "system", "content": SYSTEM_PROMPT}
+
+
+def retrieve_chunks(index, chunks, question_embedding, top_k, min_similarity):
+    """
+    Ищет чанки, близкие к вопросу. Возвращает список (чанк, косинусная близость)
+    только для чанков, прошедших порог релевантности.
+    """
+    hits = search(index, question_embedding, top_k)[0]
+    # Фильтрация по релевантности (косинусная близость не зависит от типа индекса)
+    return [(chunks[idx], similarity) for idx, similarity in hits if similarity >= min_similarity]
+
+
+def reciprocal_rank_fusion(rankings, k=RRF_K):
+    """
+    Объединяет несколько ранжированных списков идентификаторов: оценка документа -
+    сумма 1 / (k + ранг) по спискам. Шкалы оценок разных поисков при этом не важны.
+    """
+    scores = {}
+    for ranking in rankings:
+        for rank, chunk_id in enumerate(ranking, start=1):
+            scores[chunk_id] = scores.get(chunk_id, 0.0) + 1.0 / (k + rank)
+    return sorted(scores.items(), key=lambda item: item[1], reverse=True)
+
+
+def hybrid_retrieve(index, chunks, embeddings, lexical_index, question, question_embedding, candidates,
+                    min_similarity, lexical_min_coverage, timings=None):
+    """
+    Гибридный поиск: векторный (FAISS) и лексический (BM25) списки кандидатов объединяются RRF.
+    Кандидат проходит, если его косинусная близость не ниже порога или BM25 нашел в нем
+    большую часть запроса (точные коды направлений, названия компаний, числа).
+    Возвращает список (чанк, косинусная близость) в порядке объединенного ранга;
+    в timings записывается длительность этапов (сек.).
+    """
+    timings = {} if timings is None else timings
+    started = time.perf_counter()
+    dense_hits = search(index, question_embedding, candidates)[0]
+    timings["dense"] = time.perf_counter() - started
+
+    lexical_hits = []
+    if lexical_index is not None:
+        started = time.perf_counter()
+        lexical_hits = lexical_index.search(question, candidates)
+        timings["lexical"] = time.perf_counter() - started
+
+    started = time.perf_counter()
+    similarities = dict(dense_hits)
+    coverage = {chunk_id: chunk_coverage for chunk_id, _, chunk_coverage in lexical_hits}
+    fused = reciprocal_rank_fusion([[chunk_id for chunk_id, _ in dense_hits],
+                                    [chunk_id for chunk_id, _, _ in lexical_hits]])
+    # Косинусная близость найденных только BM25 чанков считается по сохраненным эмбеддингам
+    lexical_only = [chunk_id for chunk_id, _ in fused if chunk_id not in similarities]
+    if lexical_only and embeddings is not None:
+        rows = [chunks.row_of(chunk_id) for chunk_id in lexical_only]
+        lexical_similarities = np.asarray(embeddings[rows], dtype='float32') @ np.asarray(question_embedding[0], dtype='float32')
+        similarities.update(zip(lexical_only, lexical_similarities.tolist()))
+
+    results = []
+    for chunk_id, _ in fused:
+        similarity = similarities.get(chunk_id, 0.0)
+        if similarity >= min_similarity or coverage.get(chunk_id, 0.0) >= lexical_min_coverage:
+            results.append((chunks[chunk_id], similarity))
+    timings["fusion"] = time.perf_counter() - started
+    return results
+
+
+class StageTimings:
+    """Скользящее окно задержек этапов поиска и счетчики превышения их бюджетов."""
+
+    def __init__(self, budgets_ms, window=1000):
+        self.budgets_ms = budgets_ms  # этап -> бюджет в мс (None - без бюджета)
+        self._samples = {}
+        self.over_budget = {}
+        self.skipped = {}
+        self.window = window
+
+    def record(self, timings):
+        for stage, seconds in timings.items():
+            self._samples.setdefault(stage, deque(maxlen=self.window)).append(seconds)
+            budget = self.budgets_ms.get(stage)
+            if budget is not None and seconds * 1000 > budget:
+                self.over_budget[stage] = self.over_budget.get(stage, 0) + 1
+
+    def record_skip(self, stage):
+        """Этап пропущен, потому что не уложился в бюджет."""
+        self.skipped[stage] = self.skipped.get(stage, 0) + 1
+
+    def stats(self):
+        result = {}
+        for stage, samples in self._samples.items():
+            values = sorted(samples)
+            result[stage] = {
+                "count": len(values),
+                "p50_ms": values[int(0.50 * (len(values) - 1))] * 1000,
+                "p95_ms": values[int(0.95 * (len(values) - 1))] * 1000,
+                "p99_ms": values[int(0.99 * (len(values) - 1))] * 1000,
+                "max_ms": values[-1] * 1000,
+                "budget_ms": self.budgets_ms.get(stage),
+                "over_budget": self.over_budget.get(stage, 0),
+                "skipped": self.skipped.get(stage, 0),
+            }
+        return result
+
+
+def build_user_prompt(user_question, context_parts):
+    """Формирует сообщение пользователя для LLM из вопроса и отформатированных фрагментов контекста."""
+    if not context_parts:
+        # Контекст не найден - сообщаем LLM, что информации нет
+        return (
+            f"Вопрос абитуриента: {user_question}\n\n"
+            f"Контекст: Информация по данному вопросу в базе данных не найдена. "
+            f"Пожалуйста, вежливо сообщите абитуриенту, что вы не можете ответить на этот вопрос, "
+            f"так как он не относится к программам магистратуры ИТМО по ИИ. "
+            f"Предложите задать вопросы о программах 'Искусственный интеллект' или 'AI и ML в технических системах'."
+        )
+
+    # Контекст найден - инструкции уже в системном промпте, здесь только данные
+    context_text = "\n\n---\n\n".join(context_parts)
+    return f"Контекст:\n{context_text}\n\nВопрос абитуриента: {user_question}"
+
+
+EXTRACTIVE_ANSWER_HEADER = "⚡ Сейчас очень много вопросов, поэтому отвечаю выдержкой из материалов программ:"
+
+
+def build_extractive_answer(relevant_chunks, max_fragments=2, max_chars=600, header=None):
+    """
+    Ответ без LLM для режима деградации: выдержки из самых релевантных фрагментов.
+    Возвращает None, если показывать нечего.
+    """
+    chunks = dedupe_chunks(relevant_chunks)[:max_fragments]
+    if not chunks:
+        return None
+    parts = [header or EXTRACTIVE_ANSWER_HEADER]
+    for chunk in chunks:
+        text = chunk['text']
+        if len(text) > max_chars:
+            text = text[:max_chars].rsplit(' ', 1)[0] + '…'
+        parts.append(f"📌 {chunk['source']} ({chunk['field']}):\n{text}")
+    return "\n\n".join(parts)
+
+
+def build_llm_request(user_question, relevant_chunks, context_token_budget=DEFAULT_CONTEXT_TOKEN_BUDGET,
+                      min_answer_tokens=DEFAULT_ANSWER_MIN_TOKENS, max_answer_tokens=DEFAULT_ANSWER_MAX_TOKENS,
+                      no_context_answer_tokens=DEFAULT_NO_CONTEXT_ANSWER_TOKENS, model_name='gpt-4o-mini',
+                      history=None):
+    """
+    Сообщения для chat completions API и лимит длины ответа.
+    Чанки (в порядке релевантности) очищаются от повторов и упаковываются в бюджет токенов.
+    history - предыдущие сообщения диалога; они идут после системного сообщения,
+    поэтому неизменный префикс промпта по-прежнему попадает в кэш провайдера.
+    Возвращает (messages, max_tokens, число токенов контекста).
+    """
+    context_parts, context_tokens = pack_context(dedupe_chunks(relevant_chunks), context_token_budget, model_name)
+    messages = [SYSTEM_MESSAGE, *(history or ()),
+                {"role": "user", "content": build_user_prompt(user_question, context_parts)}]
+    max_tokens = choose_max_tokens(context_tokens, bool(context_parts), min_answer_tokens, max_answer_tokens,
+                                   no_context_answer_tokens)
+    return messages, max_tokens, context_tokens
+
+
+def build_messages(user_question, relevant_chunks, context_token_budget=DEFAULT_CONTEXT_TOKEN_BUDGET):
+    """Сообщения для chat completions API."""
+    return build_llm_request(user_question, relevant_chunks, context_token_budget)[0]
@@ -0,0 +1,154 @@
+# src/rate_limiter.py
+"""
+Защита от перегрузки: token bucket на пользователя и глобальные бюджеты обращений к LLM,
+ограниченная очередь запросов со сбросом лишней нагрузки.
+"""
+import asyncio
+import time
+from collections import OrderedDict
+
+
+class TokenBucket:
+    """Классический token bucket: rate токенов в секунду, не больше capacity."""
+
+    def __init__(self, rate, capacity, clock=time.monotonic):
+        self.rate = rate
+        self.capacity = capacity
+        self.clock = clock
+        self.tokens = float(capacity)
+        self.updated_at = clock()
+
+    def _refill(self):
+        now = self.clock()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def try_acquire(self, amount=1.0):
+        self._refill()
+        if self.tokens >= amount:
+            self.tokens -= amount
+            return True
+        return False
+
+    def retry_after(self, amount=1.0):
+        """Через сколько секунд будет доступно amount токенов."""
+        self._refill()
+        if self.tokens >= amount or self.rate <= 0:
+            return 0.0
+        return (min(amount, self.capacity) - self.tokens) / self.rate
+
+    def drain(self):
+        """Обнуляет запас - например, после ответа 429 от провайдера."""
+        self._refill()
+        self.tokens = 0.0
+
+
+class UserRateLimiter:
+    """
+    Token bucket на каждого пользователя. Неактивные пользователи вытесняются (LRU),
+    чтобы словарь не рос бесконечно.
+    """
+
+    def __init__(self, rate_per_minute, burst, max_users=10000, clock=time.monotonic):
+        self.rate = rate_per_minute / 60.0
+        self.burst = burst
+        self.max_users = max_users
+        self.clock = clock
+        self._buckets = OrderedDict()
+        self.rejected = 0
+
+    def try_acquire(self, user_id):
+        """Возвращает 0.0, если запрос разрешен, иначе - сколько секунд подождать."""
+        if self.rate <= 0:
+            return 0.0
+        bucket = self._buckets.pop(user_id, None)
+        if bucket is None:
+            bucket = TokenBucket(self.rate, self.burst, self.clock)
+        self._buckets[user_id] = bucket
+        if len(self._buckets) > self.max_users:
+            self._buckets.popitem(last=False)
+        if bucket.try_acquire():
+            return 0.0
+        self.rejected += 1
+        return bucket.retry_after()
+
+    def stats(self):
+        return {"users": len(self._buckets), "rejected": self.rejected}
+
+
+class LLMBudget:
+    """
+    Глобальные бюджеты запросов и токенов в минуту - ниже лимитов тарифа OpenAI,
+    чтобы при всплеске бот деградировал сам, а не получал ошибки 429.
+    """
+
+    def __init__(self, requests_per_minute, tokens_per_minute, clock=time.monotonic):
+        # Нулевой бюджет - ограничение отключено
+        self.requests = (TokenBucket(requests_per_minute / 60.0, requests_per_minute, clock)
+                         if requests_per_minute > 0 else None)
+        self.tokens = (TokenBucket(tokens_per_minute / 60.0, tokens_per_minute, clock)
+                       if tokens_per_minute > 0 else None)
+        self.granted = 0
+        self.denied = 0
+
+    def try_acquire(self, estimated_tokens):
+        # Сначала проверяем оба бюджета, чтобы не списать запрос без токенов
+        if self.requests is not None and self.requests.retry_after(1) > 0:
+            self.denied += 1
+            return False
+        if self.tokens is not None and not self.tokens.try_acquire(estimated_tokens):
+            self.denied += 1
+            return False
+        if self.requests is not None:
+            self.requests.try_acquire(1)
+        self.granted += 1
+        return True
+
+    def drain(self):
+        """Провайдер ответил 429 - до восстановления бюджета новые запросы деградируют сразу."""
+        for bucket in (self.requests, self.tokens):
+            if bucket is not None:
+                bucket.drain()
+
+    def stats(self):
+        return {"granted": self.granted, "denied": self.denied}
+
+
+class QueueFullError(Exception):
+    """Очередь ожидающих запросов заполнена - запрос отклоняется сразу."""
+
+
+class AdmissionQueue:
+    """
+    Не больше max_concurrent запросов в обработке и не больше max_waiting в очереди.
+    Запрос сверх очереди отклоняется немедленно (QueueFullError), а не копится в памяти.
+    """
+
+    def __init__(self, max_concurrent, max_waiting):
+        self.max_concurrent = max_concurrent
+        self.max_waiting = max_waiting
+        self._semaphore = asyncio.Semaphore(max_concurrent)
+        self.waiting = 0
+        self.in_flight = 0
+        self.shed = 0
+
+    async def __aenter__(self):
+        if self._semaphore.locked() and self.waiting >= self.max_waiting:
+            self.shed += 1
+            raise QueueFullError()
+        self.waiting += 1
+        try:
+            await self._semaphore.acquire()
+        finally:
+            self.waiting -= 1
+        self.in_flight += 1
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.in_flight -= 1
+        self._semaphore.release()
+        return False
+
+    def stats(self):
+        return {"in_flight": self.in_flight, "waiting": self.waiting, "shed": self.shed,
+                "max_concurrent": self.max_concurrent, "max_waiting": self.max_waiting}
@@ -0,0 +1,135 @@
+# src/recommender.py
+"""
+Рекомендация программы по ответам абитуриента. Профиль программы - фрагменты ее разделов
+(о программе, карьера, направления, компании), закодированные один раз при загрузке
+базы знаний. Ответы сравниваются со всеми программами одним матричным умножением,
+а причины рекомендации берутся из самых близких к ответам фрагментов.
+"""
+import re
+
+import numpy as np
+
+from vector_store import encode_passages
+
+# Разделы programs_data, из которых строится профиль программы
+PROFILE_FIELDS = ('about', 'career', 'directions', 'companies')
+FIELD_TITLES = {
+    'about': 'О программе',
+    'career': 'Карьера',
+    'directions': 'Направления подготовки',
+    'companies': 'Компании-партнеры',
+}
+# Ответы абитуриента в порядке вопросов /recommend (ключи context.user_data)
+ANSWER_KEYS = ('background', 'interests', 'career_goal')
+ANSWER_TITLES = {'background': 'бэкграунд', 'interests': 'интересы', 'career_goal': 'карьерная цель'}
+# Вес раздела для каждого ответа (строки - ANSWER_KEYS, столбцы - PROFILE_FIELDS):
+# карьерную цель сравниваем прежде всего с разделом "Карьера" и компаниями, бэкграунд - с описанием и направлениями
+ANSWER_FIELD_WEIGHTS = np.array([
+    [1.0, 0.5, 1.0, 0.3],
+    [1.0, 0.7, 0.8, 0.3],
+    [0.6, 1.0, 0.4, 0.8],
+], dtype='float32')
+
+# Длинные разделы делятся на фрагменты - причина рекомендации цитирует самый близкий из них
+MAX_PASSAGE_CHARS = 300
+_SENTENCE_END = re.compile(r'(?<=[.!?])\s+')
+
+
+def section_text(value):
+    """Текст раздела: строки как есть, направления - "код название", списки - через запятую."""
+    if isinstance(value, str):
+        return value.strip()
+    if isinstance(value, list):
+        items = [
+            f"{item.get('code', '')} {item.get('name', '')}".strip() if isinstance(item, dict) else str(item)
+            for item in value
+        ]
+        return ", ".join(item for item in items if item)
+    return ""
+
+
+def split_passages(text, max_chars=MAX_PASSAGE_CHARS):
+    """Делит текст на фрагменты по границам предложений (предложение длиннее max_chars - отдельный фрагмент)."""
+    passages = []
+    current = ""
+    for sentence in _SENTENCE_END.split(text):
+        if current and len(current) + len(sentence) + 1 > max_chars:
+            passages.append(current)
+            current = sentence
+        else:
+            current = f"{current} {sentence}".strip()
+    if current:
+        passages.append(current)
+    return passages
+
+
+class ProgramRecommender:
+    """
+    Матрица эмбеддингов фрагментов профилей всех программ; фрагменты одной программы идут подряд,
+    поэтому лучший фрагмент каждой программы находится одним np.maximum.reduceat.
+    """
+
+    def __init__(self, programs, passage_programs, passage_fields, passages, embeddings):
+        self.programs = programs  # [{"name", "url"}] в порядке групп фрагментов
+        self.passage_programs = np.asarray(passage_programs, dtype='int32')
+        self.passage_fields = np.asarray(passage_fields, dtype='int32')
+        self.passages = passages
+        self.embeddings = np.ascontiguousarray(embeddings, dtype='float32')
+        # Начало группы фрагментов каждой программы
+        self.program_starts = np.flatnonzero(np.r_[True, self.passage_programs[1:] != self.passage_programs[:-1]])
+
+    def __len__(self):
+        return len(self.programs)
+
+    @classmethod
+    def build(cls, programs_data, model, batch_size=32):
+        """Кодирует профили программ (блокирующая функция - вызывается в пуле потоков)."""
+        programs, passage_programs, passage_fields, passages = [], [], [], []
+        for program in programs_data:
+            program_passages = [
+                (field_id, passage)
+                for field_id, field in enumerate(PROFILE_FIELDS)
+                for passage in split_passages(section_text(program.get(field)))
+            ]
+            if not program_passages:
+                continue
+            for field_id, passage in program_passages:
+                passage_programs.append(len(programs))
+                passage_fields.append(field_id)
+                passages.append(passage)
+            programs.append({"name": program['name'], "url": program.get('url')})
+        if not passages:
+            return None
+        embeddings = encode_passages(model, passages, batch_size=batch_size)
+        return cls(programs, passage_programs, passage_fields, passages, embeddings)
+
+    def recommend(self, answer_embeddings, top_n=3):
+        """
+        answer_embeddings - нормированные эмбеддинги ответов в порядке ANSWER_KEYS (матрица 3 x d).
+        Оценка программы - среднее по ответам взвешенной близости лучшего фрагмента ее профиля.
+        Возвращает до top_n программ по убыванию оценки:
+        [{"name", "url", "score", "reasons": [{"answer", "field", "text", "similarity"}]}].
+        """
+        similarities = np.asarray(answer_embeddings, dtype='float32') @ self.embeddings.T
+        weighted = similarities * ANSWER_FIELD_WEIGHTS[:len(similarities), self.passage_fields]
+        best_per_program = np.maximum.reduceat(weighted, self.program_starts, axis=1)
+        scores = best_per_program.mean(axis=0)
+
+        program_ends = np.r_[self.program_starts[1:], len(self.passages)]
+        results = []
+        for program_id in np.argsort(-scores, kind='stable')[:top_n]:
+            start, end = self.program_starts[program_id], program_ends[program_id]
+            best_passages = start + np.argmax(weighted[:, start:end], axis=1)
+            reasons = [
+                {
+                    "answer": ANSWER_KEYS[answer_id],
+                    "field": PROFILE_FIELDS[self.passage_fields[passage_id]],
+                    "text": self.passages[passage_id],
+                    "similarity": float(similarities[answer_id, passage_id]),
+                }
+                for answer_id, passage_id in enumerate(best_passages)
+            ]
+            # Самые весомые совпадения - первыми
+            reasons.sort(key=lambda reason: reason["similarity"], reverse=True)
+            results.append({**self.programs[program_id], "score": float(scores[program_id]), "reasons": reasons})
+        return results
@@ -0,0 +1,26 @@
+# src/reranker.py
+"""Необязательный переранжировщик кандидатов cross-encoder моделью на CPU."""
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Компактная многоязычная модель; подойдет любая CrossEncoder-модель с поддержкой русского
+DEFAULT_RERANKER_MODEL = 'cross-encoder/mmarco-mMiniLMv2-L12-H384-v1'
+
+
+def load_reranker(model_name=DEFAULT_RERANKER_MODEL, max_length=512):
+    # Тяжелый импорт - только если переранжировщик включен
+    from sentence_transformers import CrossEncoder
+    return CrossEncoder(model_name, device='cpu', max_length=max_length)
+
+
+def rerank(model, question, candidates):
+    """
+    Переупорядочивает кандидатов [(чанк, близость)] по оценке cross-encoder для пары (вопрос, текст).
+    Близость в результатах остается косинусной, чтобы пороги не зависели от переранжировщика.
+    """
+    if len(candidates) < 2:
+        return candidates
+    scores = model.predict([(question, chunk['text']) for chunk, _ in candidates])
+    order = sorted(range(len(candidates)), key=lambda i: float(scores[i]), reverse=True)
+    return [candidates[i] for i in order]
@@ -0,0 +1,130 @@
+# src/startup.py
+"""
+Состояние запуска бота. Тяжелые этапы (модель эмбеддингов, база знаний, переранжировщик)
+грузятся в фоне параллельно, а бот тем временем уже принимает обновления: /start и шаги /recommend
+отвечают сразу, а вопросы, пришедшие до готовности поиска, недолго ждут ее, а не отклоняются.
+"""
+import asyncio
+import logging
+import os
+import time
+
+logger = logging.getLogger(__name__)
+
+STARTING, READY, FAILED = 'starting', 'ready', 'failed'
+
+_imported_at = time.perf_counter()
+
+
+def process_started_at():
+    """
+    Момент запуска процесса на шкале time.perf_counter(): по /proc на Linux (учитывает запуск
+    интерпретатора и импорты), иначе - момент импорта этого модуля.
+    """
+    try:
+        with open('/proc/self/stat') as f:
+            # Поле starttime (22-е) - в тиках с загрузки системы; имя процесса в скобках может содержать пробелы
+            start_ticks = int(f.read().rsplit(')', 1)[1].split()[19])
+        with open('/proc/uptime') as f:
+            uptime = float(f.read().split()[0])
+        age = uptime - start_ticks / os.sysconf('SC_CLK_TCK')
+    except (OSError, ValueError, IndexError):
+        return _imported_at
+    return time.perf_counter() - max(age, 0.0)
+
+
+class StartupState:
+    """
+    Явное состояние готовности: starting -> ready или failed. Хранит длительности этапов,
+    время от запуска процесса до готовности и до первого ответа пользователю.
+    """
+
+    def __init__(self, max_waiting=64):
+        self.status = STARTING
+        self.error = None
+        self.started_at = process_started_at()
+        self.stage_seconds = {}
+        self.ready_seconds = None
+        self.first_answer_seconds = None
+        self.max_waiting = max_waiting
+        self.waiting = 0
+        self.queued = 0  # вопросов, дождавшихся готовности
+        self.rejected = 0  # вопросов, не дождавшихся (таймаут, ошибка запуска или переполнение)
+        self._done = asyncio.Event()
+
+    @property
+    def ready(self):
+        return self.status == READY
+
+    @property
+    def starting(self):
+        return self.status == STARTING
+
+    def elapsed(self):
+        """Секунд с запуска процесса."""
+        return time.perf_counter() - self.started_at
+
+    async def run_stage(self, name, awaitable):
+        """Выполняет этап запуска, записывая его длительность; исключение этапа пробрасывается."""
+        started = time.perf_counter()
+        try:
+            return await awaitable
+        finally:
+            self.stage_seconds[name] = time.perf_counter() - started
+            logger.info(f"Этап запуска '{name}': {self.stage_seconds[name]:.2f} с.")
+
+    def mark_ready(self):
+        self.status = READY
+        self.ready_seconds = self.elapsed()
+        self._done.set()
+        logger.info(f"Поиск готов через {self.ready_seconds:.2f} с после запуска процесса (этапы: "
+                    + ", ".join(f"{name} {seconds:.2f} с" for name, seconds in self.stage_seconds.items()) + ").")
+
+    def mark_failed(self, error):
+        self.status = FAILED
+        self.error = str(error)
+        self._done.set()
+        logger.error(f"Запуск не завершен: {error}")
+
+    async def wait_ready(self, timeout):
+        """
+        Ждет готовности не дольше timeout. Возвращает True, если бот готов; False - если запуск
+        завершился ошибкой, не уложился в timeout или ожидающих вопросов уже max_waiting.
+        """
+        if self.status != STARTING:
+            return self.ready
+        if self.waiting >= self.max_waiting:
+            self.rejected += 1
+            return False
+        self.waiting += 1
+        try:
+            await asyncio.wait_for(self._done.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            self.waiting -= 1
+        if self.ready:
+            self.queued += 1
+        else:
+            self.rejected += 1
+        return self.ready
+
+    def record_first_answer(self):
+        """Запоминает время от запуска процесса до первого ответа (только первый вызов)."""
+        if self.first_answer_seconds is None:
+            self.first_answer_seconds = self.elapsed()
+            logger.info(f"Первый ответ пользователю через {self.first_answer_seconds:.2f} с после запуска процесса.")
+
+    def stats(self):
+        stats = {
+            "status": self.status,
+            "ready": int(self.ready),
+            "waiting": self.waiting,
+            "queued": self.queued,
+            "rejected": self.rejected,
+        }
+        if self.ready_seconds is not None:
+            stats["ready_seconds"] = self.ready_seconds
+        if self.first_answer_seconds is not None:
+            stats["first_answer_seconds"] = self.first_answer_seconds
+        return stats
@@ -0,0 +1,151 @@
+# src/stub_llm_server.py
+"""
+Локальная заглушка OpenAI-совместимого API (chat completions, в том числе потоковые)
+для проверки бота и LLM-шлюза без сети: задержки, ошибки 5xx и 429 задаются параметрами.
+Бот подключается к ней через OPENAI_BASE_URL=http://127.0.0.1:8089/v1.
+"""
+import argparse
+import json
+import random
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class StubLLM:
+    """Заглушка LLM: отвечает началом первого фрагмента контекста, без сетевых вызовов."""
+
+    def complete(self, messages):
+        user_prompt = messages[-1]['content']
+        marker = "Информация: "
+        start = user_prompt.find(marker)
+        return user_prompt[start + len(marker):start + len(marker) + 200] if start != -1 else "Информации недостаточно."
+
+
+class StubOptions:
+    def __init__(self, latency_ms=300.0, jitter_ms=200.0, token_delay_ms=20.0, error_rate=0.0, rate_limit_rate=0.0):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.token_delay_ms = token_delay_ms
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+
+
+class _StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    llm = StubLLM()
+
+    def log_message(self, format, *args):
+        # Журнал запросов не нужен - при нагрузочном тесте он только мешает
+        pass
+
+    def _send_json(self, status, payload):
+        body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path.rstrip('/').endswith('/models'):
+            self._send_json(200, {"object": "list", "data": [
+                {"id": "gpt-4o-mini", "object": "model", "created": 0, "owned_by": "stub"}
+            ]})
+        else:
+            self._send_json(404, {"error": {"message": "not found", "type": "invalid_request_error"}})
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        request = json.loads(self.rfile.read(length) or b"{}")
+        if not self.path.rstrip('/').endswith('/chat/completions'):
+            self._send_json(404, {"error": {"message": "not found", "type": "invalid_request_error"}})
+            return
+
+        options = self.server.options
+        time.sleep((options.latency_ms + random.uniform(0, options.jitter_ms)) / 1000)
+        roll = random.random()
+        if roll < options.rate_limit_rate:
+            self._send_json(429, {"error": {"message": "stub rate limit", "type": "rate_limit_error"}})
+            return
+        if roll < options.rate_limit_rate + options.error_rate:
+            self._send_json(500, {"error": {"message": "stub server error", "type": "server_error"}})
+            return
+
+        content = self.llm.complete(request.get("messages", [{"content": ""}]))
+        completion_id = f"chatcmpl-stub-{uuid.uuid4().hex[:12]}"
+        prompt_tokens = sum(len(message.get("content", "")) for message in request.get("messages", [])) // 3
+        usage = {"prompt_tokens": prompt_tokens, "completion_tokens": len(content) // 3,
+                 "total_tokens": prompt_tokens + len(content) // 3}
+        model = request.get("model", "gpt-4o-mini")
+
+        if not request.get("stream"):
+            self._send_json(200, {
+                "id": completion_id, "object": "chat.completion", "created": int(time.time()), "model": model,
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+                "usage": usage,
+            })
+            return
+
+        # Потоковый ответ в формате server-sent events, по слову в фрагменте
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Connection", "close")
+        self.end_headers()
+
+        def send_event(payload):
+            self.wfile.write(f"data: {json.dumps(payload, ensure_ascii=False)}\n\n".encode('utf-8'))
+            self.wfile.flush()
+
+        base = {"id": completion_id, "object": "chat.completion.chunk", "created": int(time.time()), "model": model}
+        words = content.split(' ')
+        for i, word in enumerate(words):
+            delta = {"content": word if i == len(words) - 1 else word + ' '}
+            if i == 0:
+                delta["role"] = "assistant"
+            send_event({**base, "choices": [{"index": 0, "delta": delta, "finish_reason": None}]})
+            time.sleep(options.token_delay_ms / 1000)
+        send_event({**base, "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}]})
+        if (request.get("stream_options") or {}).get("include_usage"):
+            send_event({**base, "choices": [], "usage": usage})
+        self.wfile.write(b"data: [DONE]\n\n")
+        self.wfile.flush()
+        self.close_connection = True
+
+
+def start_stub_server(host='127.0.0.1', port=8089, options=None):
+    """Запускает заглушку в фоновом потоке; возвращает сервер (server.shutdown() для остановки)."""
+    server = ThreadingHTTPServer((host, port), _StubHandler)
+    server.daemon_threads = True
+    server.options = options or StubOptions()
+    threading.Thread(target=server.serve_forever, name="stub-llm-server", daemon=True).start()
+    return server
+
+
+def main():
+    arg_parser = argparse.ArgumentParser(description="Заглушка OpenAI API для локальных проверок и нагрузочных тестов")
+    arg_parser.add_argument('--host', default='127.0.0.1')
+    arg_parser.add_argument('--port', type=int, default=8089)
+    arg_parser.add_argument('--latency-ms', type=float, default=300.0, help="Задержка перед ответом")
+    arg_parser.add_argument('--jitter-ms', type=float, default=200.0, help="Случайная добавка к задержке")
+    arg_parser.add_argument('--token-delay-ms', type=float, default=20.0, help="Пауза между фрагментами потока")
+    arg_parser.add_argument('--error-rate', type=float, default=0.0, help="Доля ответов 500")
+    arg_parser.add_argument('--rate-limit-rate', type=float, default=0.0, help="Доля ответов 429")
+    args = arg_parser.parse_args()
+
+    options = StubOptions(args.latency_ms, args.jitter_ms, args.token_delay_ms, args.error_rate, args.rate_limit_rate)
+    server = ThreadingHTTPServer((args.host, args.port), _StubHandler)
+    server.daemon_threads = True
+    server.options = options
+    print(f"Заглушка LLM слушает http://{args.host}:{args.port}/v1 (OPENAI_BASE_URL)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
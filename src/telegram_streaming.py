@@ -0,0 +1,113 @@
+# src/telegram_streaming.py
+import asyncio
+import logging
+import time
+
+from telegram.error import BadRequest, RetryAfter
+
+logger = logging.getLogger(__name__)
+
+# Максимальная длина одного сообщения Telegram
+TELEGRAM_MESSAGE_LIMIT = 4096
+
+
+class StreamInterruptedError(Exception):
+    """Поток ответа оборвался, когда часть ответа уже была показана; причина - в __cause__."""
+
+
+class StreamingMessage:
+    """
+    Постепенно выводит ответ LLM в одно сообщение Telegram.
+    Токены накапливаются между правками, а сами правки не чаще edit_interval секунд,
+    чтобы не упираться в ограничения Telegram на редактирование сообщений.
+    """
+
+    def __init__(self, bot, chat_id, edit_interval=1.0, min_chars_delta=20, cursor=" ▌", started_at=None):
+        self.bot = bot
+        self.chat_id = chat_id
+        self.edit_interval = edit_interval
+        self.min_chars_delta = min_chars_delta
+        self.cursor = cursor
+        self.started_at = started_at if started_at is not None else time.perf_counter()
+
+        self.text = ""
+        self.message = None
+        self._sent_text = ""
+        self._offset = 0  # начало текущего сообщения в self.text (длинные ответы делятся на несколько)
+        self._next_edit_at = 0.0
+        self.edits = 0
+        # Суммарное время вызовов Telegram API (отправка, правки и паузы по RetryAfter)
+        self.send_seconds = 0.0
+        # Время от начала обработки до первого видимого пользователю текста
+        self.time_to_first_visible = None
+
+    async def append(self, delta):
+        """Добавляет фрагмент ответа и при необходимости обновляет сообщение."""
+        if not delta:
+            return
+        self.text += delta
+        now = time.perf_counter()
+        pending = len(self.text) - self._offset - len(self._sent_text.removesuffix(self.cursor))
+        if self.message is None or (now >= self._next_edit_at and pending >= self.min_chars_delta):
+            flush_started = time.perf_counter()
+            await self._flush(final=False)
+            self.send_seconds += time.perf_counter() - flush_started
+
+    async def finish(self):
+        """Выводит окончательный текст без курсора и возвращает полный ответ."""
+        if self.text:
+            flush_started = time.perf_counter()
+            await self._flush(final=True)
+            self.send_seconds += time.perf_counter() - flush_started
+        return self.text
+
+    async def abort(self, note):
+        """
+        Завершает оборванный ответ: убирает курсор и дописывает note в то же сообщение.
+        Возвращает False, если пользователь еще ничего не видел (сообщение об ошибке отправляет вызывающий).
+        """
+        if self.message is None and self._offset == 0:
+            return False
+        self.text += f"\n\n{note}"
+        await self.finish()
+        return True
+
+    async def _flush(self, final):
+        visible = self.text[self._offset:]
+        # Текст не помещается в одно сообщение - фиксируем текущее и начинаем новое
+        while len(visible) + len(self.cursor) > TELEGRAM_MESSAGE_LIMIT:
+            head = visible[:TELEGRAM_MESSAGE_LIMIT]
+            await self._render(head, must_deliver=True)
+            self._offset += len(head)
+            self.message = None
+            self._sent_text = ""
+            visible = self.text[self._offset:]
+        if not visible:
+            return
+        await self._render(visible if final else visible + self.cursor, must_deliver=final)
+
+    async def _render(self, text, must_deliver=False):
+        if text == self._sent_text:
+            return
+        try:
+            if self.message is None:
+                self.message = await self.bot.send_message(chat_id=self.chat_id, text=text)
+                if self.time_to_first_visible is None:
+                    self.time_to_first_visible = time.perf_counter() - self.started_at
+            else:
+                await self.message.edit_text(text)
+                self.edits += 1
+            self._sent_text = text
+        except RetryAfter as e:
+            # Telegram просит подождать - откладываем следующую правку, текст накопится
+            retry_after = e.retry_after.total_seconds() if hasattr(e.retry_after, "total_seconds") else e.retry_after
+            logger.warning(f"Ограничение Telegram на редактирование, пауза {retry_after} с")
+            self._next_edit_at = time.perf_counter() + retry_after
+            if must_deliver or self.message is None:
+                await asyncio.sleep(retry_after)
+                await self._render(text, must_deliver)
+            return
+        except BadRequest as e:
+            if "not modified" not in str(e).lower():
+                raise
+        self._next_edit_at = time.perf_counter() + self.edit_interval
@@ -0,0 +1,178 @@
+# src/vector_store.py
+import json
+import logging
+import os
+import time
+
+# faiss импортируется при первом использовании, чтобы импорт модуля не задерживал запуск бота
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+FAISS_INDEX_PATH = 'models/faiss_index.bin'
+INDEX_META_PATH = 'models/index_meta.json'
+
+# Префиксы, с которыми обучалась модель e5: вопросы и документы кодируются по-разному
+QUERY_PREFIX = 'query: '
+PASSAGE_PREFIX = 'passage: '
+
+INDEX_TYPES = ('auto', 'flat', 'hnsw', 'ivfpq')
+
+# Параметры построения и поиска по умолчанию для каждого типа индекса
+DEFAULT_INDEX_PARAMS = {
+    'flat': {},
+    'hnsw': {'M': 32, 'ef_construction': 200, 'ef_search': 64},
+    'ivfpq': {'nlist': 1024, 'pq_m': 64, 'pq_nbits': 8, 'nprobe': 16, 'k_factor': 4},
+}
+
+# Начиная с этого числа векторов 'auto' выбирает HNSW вместо полного перебора
+AUTO_HNSW_THRESHOLD = 20000
+
+
+def encode_queries(model, texts, **kwargs):
+    """Кодирует вопросы пользователей в нормированные эмбеддинги (префикс 'query: ')."""
+    embeddings = model.encode([QUERY_PREFIX + text for text in texts], normalize_embeddings=True, **kwargs)
+    return np.asarray(embeddings, dtype='float32')
+
+
+def encode_passages(model, texts, **kwargs):
+    """Кодирует фрагменты базы знаний в нормированные эмбеддинги (префикс 'passage: ')."""
+    embeddings = model.encode([PASSAGE_PREFIX + text for text in texts], normalize_embeddings=True, **kwargs)
+    return np.asarray(embeddings, dtype='float32')
+
+
+def resolve_index_type(index_type, num_vectors):
+    """Определяет тип индекса; для IVF-PQ на маленьком корпусе откатывается на более простой."""
+    if index_type not in INDEX_TYPES:
+        raise ValueError(f"Неизвестный тип индекса '{index_type}'. Допустимые значения: {', '.join(INDEX_TYPES)}")
+    if index_type == 'auto':
+        return 'hnsw' if num_vectors >= AUTO_HNSW_THRESHOLD else 'flat'
+    if index_type == 'ivfpq' and num_vectors < 2 ** DEFAULT_INDEX_PARAMS['ivfpq']['pq_nbits'] * 39:
+        # Для обучения PQ нужно хотя бы ~39 точек на центроид
+        logger.warning(f"Слишком мало векторов ({num_vectors}) для обучения IVF-PQ, используется HNSW.")
+        return 'hnsw'
+    return index_type
+
+
+def build_index(embeddings, index_type='auto', params=None, ids=None):
+    """
+    Строит FAISS индекс по скалярному произведению нормированных векторов (= косинусная близость).
+    Индекс хранит идентификаторы чанков (IndexIDMap2), а не их позиции, что позволяет
+    удалять и добавлять отдельные чанки. Возвращает индекс и фактически использованные параметры.
+    """
+    import faiss
+    embeddings = np.ascontiguousarray(embeddings, dtype='float32')
+    if ids is None:
+        ids = np.arange(len(embeddings), dtype='int64')
+    num_vectors, dimension = embeddings.shape
+    index_type = resolve_index_type(index_type, num_vectors)
+    params = {**DEFAULT_INDEX_PARAMS[index_type], **(params or {})}
+
+    if index_type == 'flat':
+        index = faiss.IndexFlatIP(dimension)
+    elif index_type == 'hnsw':
+        index = faiss.IndexHNSWFlat(dimension, params['M'], faiss.METRIC_INNER_PRODUCT)
+        index.hnsw.efConstruction = params['ef_construction']
+    else:
+        # Число списков не больше, чем позволяет объем обучающей выборки
+        params['nlist'] = max(1, min(params['nlist'], num_vectors // 39))
+        quantizer = faiss.IndexFlatIP(dimension)
+        ivfpq = faiss.IndexIVFPQ(quantizer, dimension, params['nlist'], params['pq_m'], params['pq_nbits'],
+                                 faiss.METRIC_INNER_PRODUCT)
+        ivfpq.train(embeddings)
+        # Точное пересчитывание близости для top-k кандидатов, чтобы порог релевантности не зависел от сжатия
+        index = faiss.IndexRefineFlat(ivfpq)
+
+    index = faiss.IndexIDMap2(index)
+    index.add_with_ids(embeddings, np.asarray(ids, dtype='int64'))
+    apply_search_params(index, index_type, params)
+    return index, index_type, params
+
+
+def update_index(index, remove_ids, add_embeddings, add_ids):
+    """
+    Удаляет и добавляет чанки в существующем индексе без его пересборки.
+    Возвращает False, если тип индекса не поддерживает удаление (HNSW, IVF-PQ с уточнением).
+    """
+    try:
+        if len(remove_ids):
+            index.remove_ids(np.asarray(remove_ids, dtype='int64'))
+    except RuntimeError:
+        return False
+    if len(add_ids):
+        index.add_with_ids(np.ascontiguousarray(add_embeddings, dtype='float32'), np.asarray(add_ids, dtype='int64'))
+    return True
+
+
+def apply_search_params(index, index_type, params):
+    """Устанавливает параметры поиска (efSearch для HNSW, nprobe для IVF)."""
+    import faiss
+    parameter_space = faiss.ParameterSpace()
+    if index_type == 'hnsw':
+        parameter_space.set_index_parameter(index, 'efSearch', params['ef_search'])
+    elif index_type == 'ivfpq':
+        parameter_space.set_index_parameter(index, 'nprobe', params['nprobe'])
+        parameter_space.set_index_parameter(index, 'k_factor_rf', params['k_factor'])
+
+
+def save_index(index, meta, index_path=FAISS_INDEX_PATH, meta_path=INDEX_META_PATH):
+    """Сохраняет индекс и рядом с ним JSON с параметрами построения."""
+    import faiss
+    # Запись через временный файл, чтобы работающий бот никогда не прочитал файл наполовину
+    faiss.write_index(index, index_path + '.tmp')
+    os.replace(index_path + '.tmp', index_path)
+    with open(meta_path + '.tmp', 'w', encoding='utf-8') as f:
+        json.dump(meta, f, ensure_ascii=False, indent=4)
+    os.replace(meta_path + '.tmp', meta_path)
+
+
+def make_index_meta(model_name, index_type, params, num_vectors, dimension, **extra):
+    """Описание индекса, по которому бот восстанавливает параметры поиска."""
+    return {
+        **extra,
+        "model_name": model_name,
+        "index_type": index_type,
+        "metric": "cosine",
+        "normalized": True,
+        "query_prefix": QUERY_PREFIX,
+        "passage_prefix": PASSAGE_PREFIX,
+        "dimension": dimension,
+        "num_vectors": num_vectors,
+        "params": params,
+        "built_at": time.strftime('%Y-%m-%dT%H:%M:%S'),
+    }
+
+
+def load_index(index_path=FAISS_INDEX_PATH, meta_path=INDEX_META_PATH, mmap=False):
+    """
+    Загружает индекс и его параметры; параметры поиска применяются сразу.
+    С mmap=True векторы индекса не копируются в память процесса, а отображаются из файла
+    (только для чтения) - несколько процессов бота делят одни страницы.
+    """
+    import faiss
+    index = None
+    if mmap:
+        try:
+            index = faiss.read_index(index_path, faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY)
+        except RuntimeError:
+            # Не все типы индексов поддерживают отображение - читаем обычным способом
+            index = None
+    if index is None:
+        index = faiss.read_index(index_path)
+    if os.path.exists(meta_path):
+        with open(meta_path, 'r', encoding='utf-8') as f:
+            meta = json.load(f)
+        apply_search_params(index, meta['index_type'], meta['params'])
+    else:
+        # Индекс старого формата (L2 по ненормированным векторам) - порог близости к нему неприменим
+        meta = None
+    return index, meta
+
+
+def search(index, query_embeddings, k):
+    """Возвращает косинусные близости и идентификаторы чанков; отсутствующие результаты (-1) отбрасываются."""
+    similarities, ids = index.search(np.ascontiguousarray(query_embeddings, dtype='float32'), k)
+    return [
+        [(int(idx), float(sim)) for sim, idx in zip(row_sims, row_ids) if idx != -1]
+        for row_sims, row_ids in zip(similarities, ids)
+    ]
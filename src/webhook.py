@@ -0,0 +1,206 @@
+# src/webhook.py
+"""
+Режим webhook с несколькими воркерами. Фронтальный диспетчер принимает обновления Telegram,
+проверяет секретный токен и пересылает каждое обновление воркеру, выбранному по chat id:
+все сообщения одного чата попадают в один процесс и обрабатываются по порядку.
+Воркеры - отдельные процессы с собственной моделью; базу знаний они открывают через memory-map
+и делят одну копию страниц в памяти. Состояние диалогов (SQLite persistence) общее только для
+воркеров одного хоста; воркеры на других хостах требуют общего бэкенда persistence.
+"""
+import asyncio
+import ipaddress
+import json
+import logging
+import time
+import urllib.error
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit
+
+from telegram import Update
+
+logger = logging.getLogger(__name__)
+
+SECRET_TOKEN_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+# Путь, по которому воркер принимает пересланные обновления
+WORKER_UPDATE_PATH = "/update"
+# Максимальный размер тела запроса: обновления Telegram намного меньше
+MAX_BODY_BYTES = 1024 * 1024
+
+
+def routing_key(update_data):
+    """
+    Ключ маршрутизации обновления: chat id (или id пользователя для обновлений без чата).
+    Обновления одного чата всегда уходят одному воркеру.
+    """
+    for field, value in update_data.items():
+        if field == "update_id" or not isinstance(value, dict):
+            continue
+        chat = value.get("chat") or (value.get("message") or {}).get("chat")
+        if chat and "id" in chat:
+            return int(chat["id"])
+        sender = value.get("from") or value.get("user")
+        if sender and "id" in sender:
+            return int(sender["id"])
+    return int(update_data.get("update_id", 0))
+
+
+class _DispatcherHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _reply(self, status, body=b""):
+        self.send_response(status)
+        self.send_header("Content-Type", "text/plain; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        try:
+            self.wfile.write(body)
+        except (BrokenPipeError, ConnectionResetError):
+            # Клиент не дождался ответа - например, проверка готовности с коротким таймаутом
+            pass
+
+    def do_GET(self):
+        if self.path == "/healthz":
+            self._reply(200, b"ok\n")
+        else:
+            self._reply(404, b"not found\n")
+
+    def do_POST(self):
+        server = self.server
+        if self.path.split("?", 1)[0] != server.webhook_path:
+            self._reply(404, b"not found\n")
+            return
+        if server.secret_token and self.headers.get(SECRET_TOKEN_HEADER) != server.secret_token:
+            logger.warning("Обновление с неверным секретным токеном отклонено.")
+            self._reply(403, b"forbidden\n")
+            return
+        length = int(self.headers.get("Content-Length", 0))
+        if length <= 0 or length > MAX_BODY_BYTES:
+            self._reply(400, b"bad request\n")
+            return
+        body = self.rfile.read(length)
+        try:
+            update_data = json.loads(body)
+        except ValueError:
+            self._reply(400, b"bad request\n")
+            return
+
+        worker_url = server.worker_urls[routing_key(update_data) % len(server.worker_urls)]
+        request = urllib.request.Request(
+            worker_url.rstrip("/") + WORKER_UPDATE_PATH, data=body, method="POST",
+            headers={"Content-Type": "application/json", SECRET_TOKEN_HEADER: server.secret_token or ""},
+        )
+        try:
+            with urllib.request.urlopen(request, timeout=server.forward_timeout) as response:
+                response.read()
+        except (urllib.error.URLError, OSError) as e:
+            # Telegram повторит доставку, если получит ошибку; переключение на другой воркер
+            # нарушило бы порядок сообщений чата
+            logger.error(f"Воркер {worker_url} недоступен: {e}")
+            self._reply(502, b"worker unavailable\n")
+            return
+        self._reply(200, b"ok\n")
+
+
+def create_dispatcher(host, port, worker_urls, webhook_path="/telegram", secret_token=None, forward_timeout=5.0):
+    """HTTP-сервер диспетчера (server.serve_forever() для запуска)."""
+    if not worker_urls:
+        raise ValueError("Не задано ни одного воркера для диспетчера webhook")
+    server = ThreadingHTTPServer((host, port), _DispatcherHandler)
+    server.daemon_threads = True
+    server.worker_urls = list(worker_urls)
+    server.webhook_path = webhook_path
+    server.secret_token = secret_token
+    server.forward_timeout = forward_timeout
+    return server
+
+
+def remote_worker_urls(worker_urls):
+    """Адреса воркеров не на этом хосте (не localhost и не loopback)."""
+    remote = []
+    for worker_url in worker_urls:
+        hostname = urlsplit(worker_url).hostname or ""
+        if hostname == "localhost":
+            continue
+        try:
+            if ipaddress.ip_address(hostname).is_loopback:
+                continue
+        except ValueError:
+            pass
+        remote.append(worker_url)
+    return remote
+
+
+def wait_for_workers(worker_urls, timeout=300.0, interval=1.0):
+    """Ждет, пока все воркеры начнут отвечать на /healthz; возвращает список так и не ответивших."""
+    deadline = time.monotonic() + timeout
+    pending = list(worker_urls)
+    while pending and time.monotonic() < deadline:
+        for worker_url in list(pending):
+            try:
+                with urllib.request.urlopen(worker_url.rstrip("/") + "/healthz", timeout=interval) as response:
+                    if response.status == 200:
+                        pending.remove(worker_url)
+            except (urllib.error.URLError, OSError):
+                pass
+        if pending:
+            time.sleep(interval)
+    return pending
+
+
+async def _read_http_request(reader):
+    """Минимальный разбор HTTP-запроса: (метод, путь, заголовки, тело)."""
+    request_line = await asyncio.wait_for(reader.readline(), timeout=10)
+    parts = request_line.decode("latin-1").split()
+    if len(parts) < 2:
+        raise ValueError("Некорректная строка запроса")
+    headers = {}
+    while True:
+        line = await asyncio.wait_for(reader.readline(), timeout=10)
+        if line in (b"\r\n", b"\n", b""):
+            break
+        name, _, value = line.decode("latin-1").partition(":")
+        headers[name.strip().lower()] = value.strip()
+    length = int(headers.get("content-length", 0))
+    if length > MAX_BODY_BYTES:
+        raise ValueError("Слишком большое тело запроса")
+    body = await asyncio.wait_for(reader.readexactly(length), timeout=10) if length else b""
+    return parts[0], parts[1].split("?", 1)[0], headers, body
+
+
+async def start_update_listener(application, host, port, secret_token=None):
+    """HTTP-сервер воркера на asyncio: POST /update кладет обновление в очередь приложения, GET /healthz - 200."""
+
+    async def handle(reader, writer):
+        status, body = "200 OK", b"ok\n"
+        try:
+            method, path, headers, payload = await _read_http_request(reader)
+            if method == "POST" and path == WORKER_UPDATE_PATH:
+                if secret_token and headers.get(SECRET_TOKEN_HEADER.lower()) != secret_token:
+                    status, body = "403 Forbidden", b"forbidden\n"
+                else:
+                    update = Update.de_json(json.loads(payload), application.bot)
+                    await application.update_queue.put(update)
+            elif not (method == "GET" and path == "/healthz"):
+                status, body = "404 Not Found", b"not found\n"
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError):
+            writer.close()
+            return
+        except (ValueError, KeyError, TypeError) as e:
+            logger.warning(f"Некорректный запрос к воркеру: {e}")
+            status, body = "400 Bad Request", b"bad request\n"
+        try:
+            writer.write(
+                f"HTTP/1.1 {status}\r\nContent-Type: text/plain; charset=utf-8\r\n"
+                f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode("latin-1") + body
+            )
+            await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    return await asyncio.start_server(handle, host, port)